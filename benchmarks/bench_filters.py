@@ -0,0 +1,84 @@
+"""Micro-benchmark of the chat filters of a feed's entries.
+
+Compares matching every entry once against all the filters of a feed, with
+filters.FilterMatcher, to checking each filter separately, and checks that both
+agree:
+
+    python benchmarks/bench_filters.py
+"""
+
+import argparse
+import random
+import time
+
+from feedsbot.filters import FilterMatcher, parse_filter
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor"
+    " incididunt ut labore et dolore magna aliqua python rust release security"
+).split()
+
+
+def make_text(size: int, rnd: random.Random) -> str:
+    words: list[str] = []
+    length = 0
+    while length < size:
+        words.append(rnd.choice(WORDS))
+        length += len(words[-1])
+    return " ".join(words)
+
+
+def make_filter(rnd: random.Random) -> str:
+    terms = rnd.sample(WORDS, rnd.randint(1, 3))
+    if rnd.random() < 0.3:
+        terms.append("-" + rnd.choice(WORDS))
+    if rnd.random() < 0.1:
+        terms.append(f'"{rnd.choice(WORDS)} {rnd.choice(WORDS)}"')
+    return " ".join(terms)
+
+
+def match_each(filters: list, text: str) -> set:
+    """Check each filter on its own, scanning the text once per keyword."""
+    folded = text.casefold()
+    matched = set()
+    for filter_ in filters:
+        compiled = parse_filter(filter_)
+        if (
+            all(keyword in folded for keyword in compiled.keywords)
+            and not any(keyword in folded for keyword in compiled.excluded)
+            and all(pattern.search(text) for pattern in compiled.patterns)
+            and not any(pattern.search(text) for pattern in compiled.excluded_patterns)
+        ):
+            matched.add(filter_)
+    return matched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--entries", type=int, default=100, help="entries per feed")
+    parser.add_argument("--size", type=int, default=2000, help="characters per entry")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    texts = [make_text(args.size, rnd) for _ in range(args.entries)]
+
+    print(f"{'filters':>8} {'each':>12} {'matcher':>12} {'speedup':>8}")
+    for count in (1, 10, 100, 1000):
+        filters = list({make_filter(rnd) for _ in range(count)})
+        start = time.perf_counter()
+        expected = [match_each(filters, text) for text in texts]
+        each = time.perf_counter() - start
+        start = time.perf_counter()
+        matcher = FilterMatcher(filters)
+        results = [matcher.match(text) for text in texts]
+        grouped = time.perf_counter() - start
+        if results != expected:
+            raise SystemExit(f"mismatch with {count} filters")
+        print(
+            f"{len(filters):>8} {each * 1000:>10.2f}ms {grouped * 1000:>10.2f}ms"
+            f" {each / grouped:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Micro-benchmark of the rendering of feed entries.
+
+Compares render_entry() with the previous html5lib-based implementation on
+entries with large content:encoded bodies, and checks that both produce the
+same HTML for a regression corpus. Requires beautifulsoup4 and html5lib:
+
+    pip install beautifulsoup4 html5lib
+    python benchmarks/bench_render.py
+"""
+
+import argparse
+import random
+import time
+
+import bs4
+
+from feedsbot.util import render_entry
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod".split()
+FRAGMENTS = [
+    "Hello",
+    "world.",
+    "<b>bold</b>",
+    "&amp;",
+    "&amp",
+    "&notit;",
+    "&#128;",
+    "<br>",
+    "<br/>",
+    "</br>",
+    "\n",
+    "\r\n",
+    "<p>para</p>",
+    "x<i>y</i>z",
+    "&lt;tag&gt;",
+    "Title.",
+    "<script>s<b>x</b></script>",
+    "<style>c</style>",
+    "<!-- c -->",
+    "<![CDATA[z]]>",
+    "<img src='a.png'>",
+    "&#8217;",
+    "<a href='u>'>link</a>",
+    "...",
+    "a < b",
+    "<3",
+    "<textarea>t</textarea>",
+    "<div",
+    "</p>",
+    "<!DOCTYPE html>",
+]
+
+
+def html5lib_render(entry) -> str:
+    """The rendering of entries before html5lib was replaced, used as reference."""
+    title = entry.get("title") or ""
+    pub_date = entry.get("published") or ""
+    desc = ""
+    if entry.get("content"):
+        for c in entry.get("content"):
+            if c.get("type") == "text/html":
+                desc += c["value"]
+    if not desc:
+        desc = entry.get("description") or ""
+
+    if title:
+        desc_soup = bs4.BeautifulSoup(desc, "html5lib")
+        for tag in desc_soup("br"):
+            tag.replace_with("\n")
+        title_soup = bs4.BeautifulSoup(title.rstrip("."), "html5lib")
+        if " ".join(desc_soup.get_text().split()).startswith(
+            " ".join(title_soup.get_text().split())
+        ):
+            title = ""
+
+    if title:
+        title = f'<a href="{entry.get("link") or ""}"><h3>{title}</h3></a>'
+    elif pub_date:
+        pub_date = f'<a href="{entry.get("link") or ""}">{pub_date}</a>'
+    elif desc:
+        desc = f'<a href="{entry.get("link") or ""}">{desc}</a>'
+
+    if pub_date:
+        pub_date = f"<p>📆 <small><em>{pub_date}</em></small></p>"
+
+    return title + pub_date + desc
+
+
+def make_regression_corpus(count: int, rnd: random.Random) -> list:
+    """Entries built from small, often malformed, HTML fragments."""
+
+    def fragment(max_parts: int) -> str:
+        return "".join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(0, max_parts)))
+
+    entries = []
+    for _ in range(count):
+        title = fragment(3)
+        desc = fragment(10)
+        if rnd.random() < 0.3:
+            desc = title.rstrip(".") + desc
+        entry: dict = {
+            "title": title,
+            "link": "https://example.com/post",
+            "published": rnd.choice(["", "Mon, 06 Sep 2021 16:45:00 +0000"]),
+        }
+        if rnd.random() < 0.5:
+            entry["content"] = [{"type": "text/html", "value": desc}]
+        else:
+            entry["description"] = desc
+        entries.append(entry)
+    return entries
+
+
+def make_large_entry(size: int, rnd: random.Random, duplicated_title: bool) -> dict:
+    """An entry with a content:encoded body of about `size` characters."""
+    paragraphs = []
+    total = 0
+    while total < size:
+        words = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 80)))
+        paragraph = (
+            f'<p>{words} <a href="https://example.com/{total}">link</a> '
+            f"&amp; <b>{rnd.choice(WORDS)}</b><br/>"
+            f'<img src="https://example.com/{total}.png" alt="image"></p>\n'
+        )
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+    body = "".join(paragraphs)
+    title = bs4.BeautifulSoup(paragraphs[0], "html5lib").get_text()[:60]
+    if not duplicated_title:
+        title = "Weekly digest: " + title
+    return {
+        "title": title,
+        "link": "https://example.com/post",
+        "published": "Mon, 06 Sep 2021 16:45:00 +0000",
+        "content": [{"type": "text/html", "value": body}],
+    }
+
+
+def measure(func, entries: list, min_time: float = 0.5) -> float:
+    """Get the average time in seconds that func takes to process an entry."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for entry in entries:
+            func(entry)
+        count += len(entries)
+        took = time.perf_counter() - start
+        if took >= min_time:
+            return took / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--corpus", type=int, default=5000, help="regression entries")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    mismatches = 0
+    for entry in make_regression_corpus(args.corpus, rnd):
+        if render_entry(entry).html != html5lib_render(entry):
+            mismatches += 1
+    print(f"regression corpus: {args.corpus} entries, {mismatches} mismatches")
+
+    print(
+        f"{'body size':>10} {'title':>10} {'html5lib':>12} {'feedsbot':>12} {'speedup':>8}"
+    )
+    for size in (1_000, 10_000, 100_000, 1_000_000):
+        for duplicated in (True, False):
+            entries = [make_large_entry(size, rnd, duplicated) for _ in range(3)]
+            for entry in entries:
+                assert render_entry(entry).html == html5lib_render(entry)
+            old = measure(html5lib_render, entries)
+            new = measure(render_entry, entries)
+            label = "in body" if duplicated else "distinct"
+            print(
+                f"{size:>10} {label:>10} {old * 1000:>10.2f}ms {new * 1000:>10.2f}ms"
+                f" {old / new:>7.0f}x"
+            )
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
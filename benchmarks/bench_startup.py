@@ -0,0 +1,125 @@
+"""Benchmark the cold start of the bot process, up to the first event.
+
+Each run starts a new process that imports feedsbot and runs the bot's
+on_start hook with a fake bot, like a restarted bot does before processing its
+first event, against a database with the given number of feeds. The time to
+start the deltachat-rpc-server is not included. The runs are repeated with
+the database schema version reset, to measure the schema setup done by the
+restarts of older versions and by upgrades:
+
+    python benchmarks/bench_startup.py --feeds 10000 --output before.json
+    git checkout my-branch
+    python benchmarks/bench_startup.py --feeds 10000 --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# the dependencies that should be imported only when first needed
+HEAVY_MODULES = ("feedparser", "requests", "sqlalchemy", "aiohttp", "cProfile")
+
+
+def child(config_dir: str) -> None:
+    """Start the bot in this process and print the measurements as JSON."""
+    start = time.perf_counter()
+    # pylint: disable=C0415
+    from fakebot import FakeBot
+
+    from feedsbot.hooks import cli, on_start
+
+    imported = time.perf_counter()
+    args = cli._parser.parse_args(["--config-dir", config_dir])  # pylint: disable=W0212
+    on_start(FakeBot(), args)
+    ready = time.perf_counter()
+    result = {
+        "import": imported - start,
+        "on_start": ready - imported,
+        "modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+    print(json.dumps(result), flush=True)
+    os._exit(0)  # don't wait for the worker threads
+
+
+def populate(config_dir: Path, count: int) -> None:
+    # pylint: disable=C0415
+    from feedsbot.orm import Fchat, Feed, init, session_scope
+
+    init(f"sqlite:///{config_dir / 'sqlite.db'}")
+    # due later, so the worker doesn't start downloading them
+    next_check = time.time() + 60 * 60
+    with session_scope() as session:
+        for number in range(count):
+            url = f"http://127.0.0.1:1/feed/{number}.xml"
+            session.add(Feed(url=url, next_check=next_check, interval=60 * 60))
+            session.add(Fchat(accid=1, gid=number % 100 + 10, feed_url=url, filter=""))
+
+
+def start_bot(config_dir: Path, reset_schema: bool) -> dict:
+    if reset_schema:
+        with sqlite3.connect(config_dir / "sqlite.db") as conn:
+            conn.execute("PRAGMA user_version = 0")
+    script = Path(__file__).resolve()
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, str(script), "--child", str(config_dir)],
+        capture_output=True,
+        check=True,
+        text=True,
+        cwd=script.parent,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--feeds", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare with")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_dir = Path(tmp_dir)
+        populate(config_dir, args.feeds)
+        for name, reset_schema in (("restart", False), ("upgrade", True)):
+            runs = [start_bot(config_dir, reset_schema) for _ in range(args.runs)]
+            results[name] = {
+                key: statistics.median(run[key] for run in runs)
+                for key in ("process", "import", "on_start")
+            }
+            results[name]["modules"] = runs[-1]["modules"]
+
+    print(f"{args.feeds} feeds, median of {args.runs} runs")
+    print(f"{'':>8} {'process':>10} {'import':>10} {'on_start':>10}  imported")
+    for name, result in results.items():
+        line = f"{name:>8}"
+        for key in ("process", "import", "on_start"):
+            line += f" {result[key] * 1000:>8.1f}ms"
+        print(f"{line}  {', '.join(result['modules'])}")
+        if name in baseline:
+            line = f"{'before':>8}"
+            for key in ("process", "import", "on_start"):
+                line += f" {baseline[name][key] * 1000:>8.1f}ms"
+            print(f"{line}  {', '.join(baseline[name]['modules'])}")
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
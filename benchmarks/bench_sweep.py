@@ -0,0 +1,264 @@
+"""Benchmark full sweeps of the feed worker against a local stub server.
+
+For each number of feeds, a fresh database is filled with feeds served by
+benchmarks/stub_server.py and one sweep checking all of them is run with a
+fake bot, in a separate process so the peak RSS of each size is measured on
+its own. Nothing leaves the machine. db_seconds is the time spent inside
+database sessions summed over all threads. Results can be saved as JSON to
+compare them across commits:
+
+    python benchmarks/bench_sweep.py --feeds 100 1000 10000 --output before.json
+    git checkout my-branch
+    python benchmarks/bench_sweep.py --feeds 100 1000 10000 --baseline before.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, fields
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+from fakebot import FakeBot
+from stub_server import FeedConfig, entry_date, serve
+
+from feedsbot import orm, registry, util
+from feedsbot.delivery import DeliveryOptions, DeliveryQueue
+from feedsbot.memory import MemoryBudget
+from feedsbot.orm import Fchat, Feed, session_scope
+from feedsbot.registry import FeedRegistry
+from feedsbot.scheduler import Scheduler
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Probe:
+    """Measure the time spent per feed and in database sessions during a sweep."""
+
+    def __init__(self) -> None:
+        self.latencies: list = []
+        self.db_time = 0.0
+        self._lock = threading.Lock()
+
+    def install(self) -> None:
+        check_feed_task = util._check_feed_task  # pylint: disable=W0212
+
+        def timed_check_feed_task(*args, **kwargs) -> None:
+            start = time.perf_counter()
+            try:
+                check_feed_task(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.latencies.append(time.perf_counter() - start)
+
+        scope = orm.session_scope
+
+        @contextmanager
+        def timed_session_scope(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with scope(*args, **kwargs) as session:
+                    yield session
+            finally:
+                with self._lock:
+                    self.db_time += time.perf_counter() - start
+
+        util._check_feed_task = timed_check_feed_task  # pylint: disable=W0212
+        orm.session_scope = timed_session_scope
+        util.session_scope = timed_session_scope
+        registry.session_scope = timed_session_scope
+
+
+def populate(db_path: Path, base_url: str, count: int, args) -> None:
+    orm.init(f"sqlite:///{db_path}", pool_size=args.parallel)
+    # entries newer than this date are new for the bot
+    latest = " ".join(map(str, time.gmtime(entry_date(args.new_entries))))
+    with session_scope() as session:
+        for number in range(count):
+            url = f"{base_url}/feed/{number}.xml"
+            session.add(Feed(url=url, etag='"benchmark"', latest=latest, next_check=0))
+            for chat in range(args.chats):
+                filter_ = "lorem" if chat < args.filtered_chats else ""
+                session.add(Fchat(accid=1, gid=chat + 10, feed_url=url, filter=filter_))
+
+
+def make_check_context(args) -> util.CheckContext:
+    """The engines of the worker, with the feeds loaded as when the bot starts."""
+    budget = MemoryBudget(args.memory_budget * 1024**2)
+    context = util.CheckContext(Scheduler(60 * 60, 60 * 60), FeedRegistry(), budget)
+    if args.engine == "async":
+        from feedsbot.aio import AsyncFetcher  # pylint: disable=C0415
+
+        context.fetcher = AsyncFetcher(
+            args.connections, args.host_connections, budget=budget
+        )
+    if args.parse_workers:
+        context.parser = ProcessPoolExecutor(args.parse_workers)
+    # loaded once when the bot starts, not on every sweep
+    context.registry.load()
+    return context
+
+
+def close_check_context(context: util.CheckContext) -> None:
+    if context.parser:
+        context.parser.shutdown()
+    if context.fetcher:
+        context.fetcher.close()
+
+
+def count_failed_feeds() -> int:
+    with session_scope(readonly=True) as session:
+        return session.query(Feed).filter(Feed.errors != 0).count()
+
+
+def run_sweep(base_url: str, count: int, args) -> dict:
+    """Check `count` feeds once and return the measurements."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        populate(Path(tmp_dir) / "sqlite.db", base_url, count, args)
+        log_level = logging.INFO if args.verbose else logging.CRITICAL
+        bot = FakeBot(args.rpc_latency, log_level)
+        context = make_check_context(args)
+        probe = Probe()
+        probe.install()
+        urls = [f"{base_url}/feed/{number}.xml" for number in range(count)]
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        delivery = DeliveryQueue(bot, DeliveryOptions(args.send_rate))
+        with ThreadPool(args.parallel) as pool:
+            util.check_due_feeds(bot, context, pool, delivery, urls)
+        delivery.join()
+        took = time.perf_counter() - start
+        failed = count_failed_feeds()
+        close_check_context(context)
+
+    return {
+        "feeds": count,
+        "seconds": round(took, 3),
+        "feeds_per_sec": round(count / took, 1),
+        "p50_ms": round(percentile(probe.latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(probe.latencies, 99) * 1000, 2),
+        "db_seconds": round(probe.db_time, 3),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "rss_before_sweep_mb": round(rss_before / 1024, 1),
+        "failed_feeds": failed,
+        "sent_msgs": bot.rpc.sent_msgs,
+        "sent_mb": round(bot.rpc.sent_bytes / 1024**2, 2),
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_results(results: list, baseline: dict) -> None:
+    columns = ["feeds", "seconds", "feeds_per_sec", "p50_ms", "p99_ms"]
+    columns += ["db_seconds", "peak_rss_mb", "failed_feeds", "sent_msgs"]
+    print(" ".join(f"{col:>13}" for col in columns))
+    for result in results:
+        print(" ".join(f"{result[col]:>13}" for col in columns))
+        old = baseline.get(result["feeds"])
+        if old:
+            changes = []
+            for col in columns[1:]:
+                if old.get(col):
+                    changes.append(f"{(result[col] - old[col]) / old[col]:>+13.1%}")
+                else:
+                    changes.append(f"{'-':>13}")
+            print(f"{'vs baseline':>13} " + " ".join(changes))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--feeds", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--parallel", type=int, default=10)
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--host-connections", type=int, default=100)
+    parser.add_argument("--parse-workers", type=int, default=0)
+    parser.add_argument("--new-entries", type=int, default=2, help="per feed")
+    parser.add_argument("--chats", type=int, default=1, help="per feed")
+    parser.add_argument("--filtered-chats", type=int, default=0, help="per feed")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--send-rate", type=float, default=0.0, help="per account")
+    parser.add_argument("--memory-budget", type=int, default=0, help="MB, 0: no limit")
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the bot logs")
+    for field in fields(FeedConfig):
+        parser.add_argument(
+            f"--{field.name.replace('_', '-')}",
+            type=type(field.default),
+            default=field.default,
+            help="stub server option",
+        )
+    return parser.parse_args()
+
+
+def run_sweeps(config: FeedConfig, args: argparse.Namespace) -> list:
+    """Run a sweep for each number of feeds against a stub server process."""
+    ctx = multiprocessing.get_context("spawn")
+    port_queue = ctx.Queue()
+    server = ctx.Process(target=serve, args=(config, 0, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get()}"
+
+    results = []
+    for count in args.feeds:
+        # a new process for each size, so peak RSS is not shared
+        with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+            results.append(executor.submit(run_sweep, base_url, count, args).result())
+    server.terminate()
+    return results
+
+
+def main() -> None:
+    args = parse_args()
+    config = FeedConfig(
+        **{field.name: getattr(args, field.name) for field in fields(FeedConfig)}
+    )
+    results = run_sweeps(config, args)
+
+    baseline = {}
+    if args.baseline:
+        for result in json.loads(args.baseline.read_text())["results"]:
+            baseline[result["feeds"]] = result
+    print_results(results, baseline)
+
+    if args.output:
+        options = {key: str(value) for key, value in vars(args).items()}
+        report = {
+            "commit": get_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "options": options,
+            "server": asdict(config),
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Stand-in for deltachat2's Bot so the worker can run without Delta Chat accounts."""
+
+import logging
+import time
+from threading import Lock
+
+
+class FakeRpc:
+    """Record the sent messages instead of sending them, other calls do nothing."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.sent_msgs = 0
+        self.sent_bytes = 0
+        self._lock = Lock()
+
+    def send_msg(self, _accid: int, _chatid: int, msg) -> int:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent_msgs += 1
+            self.sent_bytes += len(msg.html or "") + len(msg.text or "")
+            return self.sent_msgs
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: None
+
+
+class FakeBot:
+    def __init__(self, rpc_latency: float = 0.0, log_level: int = logging.WARNING):
+        self.rpc = FakeRpc(rpc_latency)
+        self.logger = logging.getLogger("feedsbot-benchmark")
+        self.logger.setLevel(log_level)
+
+    def add_hook(self, *_args, **_kwargs) -> None:
+        """The fake bot receives no events, so the hooks are never called."""
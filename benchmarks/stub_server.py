@@ -0,0 +1,203 @@
+"""Local HTTP server serving synthetic RSS/Atom feeds for benchmarks.
+
+Feed number N is served at /feed/N.xml, its content only depends on N and
+the server options, so it is the same in every request. Run it alone to test
+the bot against it:
+
+    python benchmarks/stub_server.py --port 8080 --latency 0.05 --errors 0.05
+"""
+
+import argparse
+import email.utils
+import hashlib
+import random
+import time
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod".split()
+# the date of the newest entry of every feed
+NEWEST_DATE = 1_700_000_000
+
+
+@dataclass(frozen=True)
+class FeedConfig:
+    """How the synthetic feeds look like and how the server behaves."""
+
+    entries: int = 20  # entries per feed
+    entry_size: int = 1000  # approximate size of the entries' content in bytes
+    format: str = "mixed"  # rss, atom or mixed
+    latency: float = 0.0  # seconds to wait before answering
+    not_modified: float = 0.0  # fraction of feeds answering 304 to conditional requests
+    errors: float = 0.0  # fraction of feeds answering with HTTP 500
+    slow: float = 0.0  # fraction of feeds sending their body in slow small chunks
+    drip_delay: float = 0.05  # seconds between chunks of the slow feeds
+    drip_chunks: int = 10
+
+    def kind(self, number: int) -> str:
+        """Get how the server treats the feed with the given number."""
+        value = random.Random(number).random()
+        for kind in ("errors", "not_modified", "slow"):
+            rate = getattr(self, kind)
+            if value < rate:
+                return kind
+            value -= rate
+        return "normal"
+
+
+def entry_date(index: int) -> float:
+    """Get the publication date of the entry with the given index, 0 is the newest."""
+    return NEWEST_DATE - index * 3600
+
+
+@lru_cache(maxsize=1024)
+def make_feed(config: FeedConfig, number: int) -> bytes:
+    rnd = random.Random(number)
+    fmt = config.format
+    if fmt == "mixed":
+        fmt = "atom" if number % 2 else "rss"
+
+    def words(count: int) -> str:
+        return " ".join(rnd.choice(WORDS) for _ in range(count))
+
+    def content() -> str:
+        paragraphs = []
+        size = 0
+        while size < config.entry_size:
+            paragraph = (
+                f'<p>{words(rnd.randint(10, 40))} <a href="https://example.com/'
+                f'{rnd.randint(0, 10**6)}">link</a> &amp; <b>{words(2)}</b></p>'
+            )
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        return "".join(paragraphs)
+
+    def escape(text: str) -> str:
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+    items = []
+    for index in range(config.entries):
+        title = words(rnd.randint(3, 8)).capitalize()
+        link = f"https://example.com/{number}/{index}"
+        if fmt == "atom":
+            date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry_date(index)))
+            items.append(
+                f"<entry><title>{title}</title><link href='{link}'/><id>{link}</id>"
+                f"<updated>{date}</updated><published>{date}</published>"
+                f"<content type='html'>{escape(content())}</content></entry>"
+            )
+        else:
+            date = email.utils.formatdate(entry_date(index), usegmt=True)
+            items.append(
+                f"<item><title>{title}</title><link>{link}</link><guid>{link}</guid>"
+                f"<pubDate>{date}</pubDate>"
+                f"<description>{escape(content())}</description></item>"
+            )
+    if fmt == "atom":
+        feed = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            f"<title>Feed {number}</title><id>urn:feed:{number}</id>"
+            f"{''.join(items)}</feed>"
+        )
+    else:
+        feed = (
+            '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+            f"<title>Feed {number}</title><link>https://example.com/{number}</link>"
+            f"<description>Synthetic feed</description>{''.join(items)}</channel></rss>"
+        )
+    return feed.encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FeedServer"
+
+    def log_message(self, format, *args) -> None:  # noqa  # pylint: disable=W0622
+        pass
+
+    def do_GET(self) -> None:  # noqa  # pylint: disable=C0103
+        config = self.server.config
+        number = self._get_feed_number()
+        if config.latency:
+            time.sleep(config.latency)
+        if number is None:
+            self._send_empty(404)
+            return
+        kind = config.kind(number)
+        if kind == "errors":
+            self._send_empty(500)
+            return
+        body = make_feed(config, number)
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'  # nosec
+        # any conditional request is considered up to date, so clients don't need
+        # to download the feed first to get its ETag
+        if kind == "not_modified" and (
+            self.headers.get("if-none-match") or self.headers.get("if-modified-since")
+        ):
+            self._send_empty(304, {"etag": etag})
+            return
+        self.send_response(200)
+        self.send_header("content-type", "application/xml; charset=utf-8")
+        self.send_header("content-length", str(len(body)))
+        self.send_header("etag", etag)
+        self.end_headers()
+        if kind == "slow":
+            step = max(len(body) // config.drip_chunks, 1)
+            for i in range(0, len(body), step):
+                self.wfile.write(body[i : i + step])
+                self.wfile.flush()
+                time.sleep(config.drip_delay)
+        else:
+            self.wfile.write(body)
+
+    def _get_feed_number(self) -> Optional[int]:
+        path = self.path.split("?")[0]
+        if path.startswith("/feed/") and path.endswith(".xml"):
+            number = path[len("/feed/") : -len(".xml")]
+            if number.isdigit():
+                return int(number)
+        return None
+
+    def _send_empty(self, status: int, headers: Optional[dict] = None) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("content-length", "0")
+        self.end_headers()
+
+
+class FeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int, config: FeedConfig) -> None:
+        super().__init__(("127.0.0.1", port), FeedHandler)
+        self.config = config
+
+
+def serve(config: FeedConfig, port: int = 0, port_queue=None) -> None:
+    """Serve the feeds forever, the listening port is put in port_queue."""
+    with FeedServer(port, config) as server:
+        if port_queue is not None:
+            port_queue.put(server.server_address[1])
+        server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--port", type=int, default=8080)
+    for key, value in asdict(FeedConfig()).items():
+        parser.add_argument(
+            f"--{key.replace('_', '-')}", type=type(value), default=value
+        )
+    args = vars(parser.parse_args())
+    port = args.pop("port")
+    print(f"Serving feeds at http://127.0.0.1:{port}/feed/N.xml")
+    serve(FeedConfig(**args), port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Asynchronous fetch engine, requires the optional aiohttp dependency"""
+
+import asyncio
+import time
+from concurrent.futures import Future, as_completed
+from threading import Thread
+from typing import Iterable, Iterator, Optional
+
+import aiohttp
+
+from .hosts import HostLimiter
+from .memory import MemoryBudget
+from .metrics import DOWNLOADED_BYTES, FETCH_SECONDS
+from .registry import FeedRecord
+from .stream import EntryScanner
+from .util import (
+    MAX_FEED_SIZE,
+    USER_AGENT,
+    FeedResponse,
+    decode_content,
+    get_permanent_redirect,
+    get_request_headers,
+    get_scanner,
+    make_feed_response,
+)
+
+
+class AsyncFetcher:
+    """Download feeds concurrently on a single event loop running in a background thread.
+
+    Connections are pooled and kept alive, and DNS lookups are cached. At most
+    `limit` connections are open at the same time, and at most `limit_per_host`
+    to the same host, other requests wait for a free connection. If a host
+    limiter is given, the downloads of the same host are spaced and paused when
+    the host asks to wait. If a memory budget is given, the downloads wait for
+    it, since the downloaded feeds can pile up faster than they are processed.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        limit_per_host: int,
+        dns_ttl: int = 300,
+        hosts: Optional[HostLimiter] = None,
+        budget: Optional[MemoryBudget] = None,
+    ) -> None:
+        self.hosts = hosts
+        self.budget = budget
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_forever, daemon=True).start()
+        self._session = self._run(
+            self._create_session(limit, limit_per_host, dns_ttl)
+        ).result()
+
+    async def _create_session(
+        self, limit: int, limit_per_host: int, dns_ttl: int
+    ) -> aiohttp.ClientSession:
+        # idle connections are kept longer than the default 15 seconds, so
+        # they are still open for the next feed of the same host
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=dns_ttl,
+            keepalive_timeout=60,
+        )
+        # same as the 15 seconds timeout of the requests session, there is no total
+        # timeout since requests can wait in the connector's queue for a long time
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=15)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={"user-agent": USER_AGENT},
+            trace_configs=[_get_trace_config()],
+        )
+
+    def _run(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def fetch_all(self, feeds: Iterable[FeedRecord]) -> Iterator[tuple]:
+        """Start downloading all the given feeds at once.
+
+        Yield (feed, fetch) tuples in the order the downloads finish, where
+        fetch() returns the FeedResponse or raises the download error.
+        """
+        futures = {
+            self.submit(f.url, f.etag, f.modified, get_scanner(f)): f for f in feeds
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result
+
+    def submit(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+        modified: Optional[str] = None,
+        scanner: Optional[EntryScanner] = None,
+    ) -> Future:
+        """Schedule the download of a feed in the event loop."""
+        return self._run(self.fetch(url, etag, modified, scanner))
+
+    async def fetch(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+        modified: Optional[str] = None,
+        scanner: Optional[EntryScanner] = None,
+    ) -> FeedResponse:
+        if self.budget:
+            await self.budget.wait(url)
+        if self.hosts:
+            await asyncio.sleep(self.hosts.reserve(url))
+            self.hosts.check_paused(url)
+            start = time.perf_counter()
+            try:
+                return await self._fetch(url, etag, modified, scanner)
+            except aiohttp.ClientResponseError as ex:
+                throttled = self.hosts.throttle(url, ex)
+                if throttled:
+                    raise throttled from ex
+                raise
+            finally:
+                self.hosts.observe(url, time.perf_counter() - start)
+        return await self._fetch(url, etag, modified, scanner)
+
+    async def _fetch(
+        self,
+        url: str,
+        etag: Optional[str],
+        modified: Optional[str],
+        scanner: Optional[EntryScanner],
+    ) -> FeedResponse:
+        headers = get_request_headers(etag, modified)
+        async with self._session.get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            start = time.perf_counter()
+            text = await get_response_text(resp, MAX_FEED_SIZE, scanner)
+            FETCH_SECONDS.observe(time.perf_counter() - start, stage="body")
+            if self.budget:
+                self.budget.hold(url, len(text))
+            feed_resp = make_feed_response(
+                str(resp.url), resp.status, resp.headers, text, headers
+            )
+            feed_resp.truncated = scanner is not None and scanner.done
+            statuses = [r.status for r in resp.history]
+            feed_resp.redirect = get_permanent_redirect(url, str(resp.url), statuses)
+            return feed_resp
+
+    def close(self) -> None:
+        self._run(self._session.close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+async def get_response_text(
+    resp: aiohttp.ClientResponse,
+    max_size: int,
+    scanner: Optional[EntryScanner] = None,
+) -> str:
+    """Same as util.get_response_text() but for aiohttp responses."""
+    if (resp.content_length or -1) > max_size and scanner is None:
+        return ""  # skip reading the body
+
+    content = bytearray()
+    async for chunk in resp.content.iter_chunked(102400):  # 100KB chunks
+        DOWNLOADED_BYTES.inc(len(chunk))
+        if scanner is not None:
+            scanner.feed(chunk)
+            if scanner.done:
+                content.extend(chunk)
+                return decode_content(scanner.truncate(content), resp.charset)
+        if len(content) + len(chunk) > max_size:
+            return ""  # limit exceeded, discard
+        content.extend(chunk)
+
+    return decode_content(content, resp.charset)
+
+
+def _get_trace_config() -> aiohttp.TraceConfig:
+    """Measure the stages of the requests, the time spent waiting in the
+    connector's queue for a free connection is not included.
+    """
+
+    async def on_request_start(_session, ctx, _params) -> None:
+        ctx.start = time.perf_counter()
+        ctx.queued = 0.0
+
+    async def on_queued_start(_session, ctx, _params) -> None:
+        ctx.queued_start = time.perf_counter()
+
+    async def on_queued_end(_session, ctx, _params) -> None:
+        ctx.queued += time.perf_counter() - ctx.queued_start
+
+    async def on_dns_start(_session, ctx, _params) -> None:
+        ctx.dns_start = time.perf_counter()
+
+    async def on_dns_end(_session, ctx, _params) -> None:
+        FETCH_SECONDS.observe(time.perf_counter() - ctx.dns_start, stage="dns")
+
+    async def on_connect_start(_session, ctx, _params) -> None:
+        ctx.connect_start = time.perf_counter()
+
+    async def on_connect_end(_session, ctx, _params) -> None:
+        FETCH_SECONDS.observe(time.perf_counter() - ctx.connect_start, stage="connect")
+
+    async def on_request_end(_session, ctx, _params) -> None:
+        took = time.perf_counter() - ctx.start - ctx.queued
+        FETCH_SECONDS.observe(took, stage="ttfb")
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_queued_start.append(on_queued_start)
+    trace.on_connection_queued_end.append(on_queued_end)
+    trace.on_dns_resolvehost_start.append(on_dns_start)
+    trace.on_dns_resolvehost_end.append(on_dns_end)
+    trace.on_connection_create_start.append(on_connect_start)
+    trace.on_connection_create_end.append(on_connect_end)
+    trace.on_request_end.append(on_request_end)
+    return trace
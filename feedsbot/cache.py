@@ -0,0 +1,100 @@
+"""Short-lived cache of downloaded feeds shared by the commands and the worker"""
+
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Optional
+
+from .metrics import FETCH_CACHE
+
+if TYPE_CHECKING:
+    from .util import FeedResponse
+
+
+class FetchCache:
+    """Remember the complete downloads of feeds for `ttl` seconds, keeping at most
+    `max_size` characters of feed bodies and dropping the least recently used.
+
+    Concurrent requests for the same URL share a single download, so a feed that
+    is subscribed to by many chats at once is downloaded only once.
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, "FeedResponse"]] = OrderedDict()
+        self._size = 0
+        self._inflight: dict[str, Future] = {}
+        self._lock = Lock()
+
+    def get(self, url: str, fetch: Callable[[], "FeedResponse"]) -> "FeedResponse":
+        """Get the cached download of the feed, or call fetch() to download it.
+
+        If the feed is already being downloaded, wait for that download instead.
+        Partial downloads, ex. 304 responses or feeds truncated at the old entries,
+        are returned only to the caller that started them.
+        """
+        with self._lock:
+            resp = self._get_fresh(url)
+            if resp is not None:
+                FETCH_CACHE.inc(result="hit")
+                return resp
+            future = self._inflight.get(url)
+            if future is None:
+                future = self._inflight[url] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            try:
+                resp = future.result()
+            except Exception:  # noqa
+                resp = None
+            if resp is not None and _is_complete(resp):
+                FETCH_CACHE.inc(result="coalesced")
+                return resp
+            FETCH_CACHE.inc(result="miss")
+            return fetch()
+
+        FETCH_CACHE.inc(result="miss")
+        try:
+            resp = fetch()
+        except BaseException as ex:
+            with self._lock:
+                del self._inflight[url]
+            future.set_exception(ex)
+            raise
+        with self._lock:
+            del self._inflight[url]
+            self._put(url, resp)
+        future.set_result(resp)
+        return resp
+
+    def _get_fresh(self, url: str) -> Optional["FeedResponse"]:
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(url)
+            return None
+        self._entries.move_to_end(url)
+        return entry[1]
+
+    def _put(self, url: str, resp: "FeedResponse") -> None:
+        if self.ttl <= 0 or not _is_complete(resp) or len(resp.text) > self.max_size:
+            return
+        if url in self._entries:
+            self._remove(url)
+        self._entries[url] = (time.monotonic() + self.ttl, resp)
+        self._size += len(resp.text)
+        while self._size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, url: str) -> None:
+        _, resp = self._entries.pop(url)
+        self._size -= len(resp.text)
+
+
+def _is_complete(resp: "FeedResponse") -> bool:
+    return resp.status == 200 and not resp.truncated and bool(resp.text)
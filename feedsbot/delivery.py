@@ -0,0 +1,275 @@
+"""Outgoing messages: per-chat digests sent from the persistent outbox"""
+
+import itertools
+import time
+from dataclasses import dataclass
+from html import escape
+from queue import SimpleQueue
+from threading import Condition, Lock, Thread
+from typing import Optional
+
+from deltachat2 import Bot, JsonRpcError, MsgData
+from sqlalchemy import Select, delete, func, select, update
+
+from .metrics import (
+    DELIVERED_ENTRIES,
+    DIGEST_PARTS,
+    SEND_ERRORS,
+    SEND_RETRIES,
+    SEND_SECONDS,
+    SENT_MESSAGES,
+)
+from .orm import Fchat, Outbox, session_scope
+from .registry import FeedRegistry
+
+# how many messages an account can send at once before being rate-limited
+SEND_BURST = 10
+# how many times to try to send a message before giving up
+MAX_SEND_ATTEMPTS = 8
+# seconds to wait before the first retry, doubled after each failed attempt
+RETRY_DELAY = 30
+
+
+@dataclass(frozen=True)
+class DeliveryOptions:
+    """How a DeliveryQueue sends the messages.
+
+    The entries of all the feeds a chat is subscribed to are merged into messages
+    of at most `max_size` characters of HTML. They are collected until flush() is
+    called at the end of a check or, if `window` is set, for `window` seconds since
+    the chat's oldest message in the outbox. Each chat is sent by one of `workers`
+    threads at a time, at most `rate` messages per second for each account
+    (0 means no limit).
+
+    Failed messages are retried after `retry_delay` seconds, doubled after each
+    failed attempt, and given up after `max_attempts` attempts.
+
+    If the feeds are checked by other processes, set `poll` to check the outbox
+    for their messages every `poll` seconds, they are sent as soon as they are
+    found unless they are collected for a time window.
+    """
+
+    rate: float
+    window: float = 0
+    max_size: int = 100_000
+    workers: int = 4
+    poll: float = 0
+    max_attempts: int = MAX_SEND_ATTEMPTS
+    retry_delay: float = RETRY_DELAY
+
+
+class DeliveryQueue:
+    """Send the messages of the outbox, merging the new entries of each chat
+    into digest messages, see DeliveryOptions.
+
+    A message is removed from the outbox only after it was sent, so messages are
+    sent at least once even if the bot stops in the middle. Failed messages are
+    retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        options: DeliveryOptions,
+        registry: Optional[FeedRegistry] = None,
+    ) -> None:
+        self.bot = bot
+        self.options = options
+        self.registry = registry  # to forget the chats unsubscribed on errors
+        # messages left by a previous run are ready to be sent
+        self._flushed = time.time()
+        self._busy: set[tuple[int, int]] = set()
+        # busy chats that had more messages in the last outbox scan
+        self._skipped: set[tuple[int, int]] = set()
+        self._dirty = True  # the outbox needs to be scanned again
+        self._cond = Condition()
+        self._tokens: dict[int, tuple[float, float]] = {}
+        self._tokens_lock = Lock()
+        self._chats: SimpleQueue = SimpleQueue()
+        Thread(target=self._dispatch, daemon=True).start()
+        for _ in range(max(options.workers, 1)):
+            Thread(target=self._work, daemon=True).start()
+
+    def flush(self) -> None:
+        """Send the messages added to the outbox until now, unless they are
+        collected for a time window.
+        """
+        with self._cond:
+            self._flushed = time.time()
+            self._dirty = True
+            self._cond.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all the messages ready to be sent were sent or postponed."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._dirty and not self._busy, timeout
+            )
+
+    def _dispatch(self) -> None:
+        """Give the chats that are ready to be sent to the workers."""
+        stmt: Select = select(
+            Outbox.accid,
+            Outbox.gid,
+            func.min(Outbox.created),
+            func.max(Outbox.next_attempt),
+        ).group_by(Outbox.accid, Outbox.gid)
+        with self._cond:
+            while True:
+                self._dirty = False
+                now = time.time()
+                if self.options.window:
+                    cutoff = now - self.options.window
+                elif self.options.poll:
+                    cutoff = now  # the other processes don't call flush()
+                else:
+                    cutoff = self._flushed
+                with session_scope(readonly=True) as session:
+                    chats = session.execute(stmt).all()
+                timeout = None
+                ready: dict[int, list] = {}
+                for accid, gid, created, next_attempt in chats:
+                    if (accid, gid) in self._busy:
+                        self._skipped.add((accid, gid))
+                        continue
+                    if created <= cutoff and next_attempt <= now:
+                        self._busy.add((accid, gid))
+                        ready.setdefault(accid, []).append(gid)
+                        continue
+                    ready_at = next_attempt
+                    if self.options.window:
+                        ready_at = max(ready_at, created + self.options.window)
+                    if ready_at > now:
+                        delay = ready_at - now
+                        timeout = delay if timeout is None else min(timeout, delay)
+                # interleave the accounts so a rate-limited account doesn't
+                # keep all the workers waiting
+                for gids in itertools.zip_longest(*ready.values()):
+                    for accid, gid in zip(ready, gids):
+                        if gid is not None:
+                            self._chats.put((accid, gid))
+                if self.options.poll:
+                    timeout = min(timeout or self.options.poll, self.options.poll)
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._dirty, timeout)
+
+    def _work(self) -> None:
+        while True:
+            accid, gid = self._chats.get()
+            done = False
+            try:
+                done = self._send_chat(accid, gid)
+            except Exception as ex:  # noqa
+                self.bot.logger.exception(ex)
+            finally:
+                with self._cond:
+                    self._busy.discard((accid, gid))
+                    if not done or (accid, gid) in self._skipped:
+                        self._skipped.discard((accid, gid))
+                        self._dirty = True
+                    self._cond.notify_all()
+
+    def _send_chat(self, accid: int, gid: int) -> bool:
+        """Send the chat's messages, return False if some were postponed."""
+        stmt = (
+            select(Outbox)
+            .where(Outbox.accid == accid, Outbox.gid == gid)
+            .order_by(Outbox.id)
+        )
+        with session_scope(readonly=True) as session:
+            rows = session.execute(stmt).scalars().all()
+        messages = [(MsgData(text=row.text), 0, [row]) for row in rows if row.text]
+        messages += make_digests(
+            [row for row in rows if row.html], self.options.max_size
+        )
+        for i, (msg, entries, msg_rows) in enumerate(messages):
+            self._wait_token(accid)
+            try:
+                with SEND_SECONDS.time():
+                    self.bot.rpc.send_msg(accid, gid, msg)
+            except Exception as ex:  # noqa
+                SEND_ERRORS.inc()
+                self.bot.logger.warning(f"Failed to send message to chat {gid}: {ex}")
+                pending = [row for message in messages[i:] for row in message[2]]
+                self._postpone(accid, gid, pending, isinstance(ex, JsonRpcError))
+                return False
+            SENT_MESSAGES.inc()
+            DELIVERED_ENTRIES.inc(entries)
+            ids = [row.id for row in msg_rows]
+            with session_scope() as session:
+                session.execute(delete(Outbox).where(Outbox.id.in_(ids)))
+        return True
+
+    def _postpone(self, accid: int, gid: int, rows: list, rpc_error: bool) -> None:
+        """Retry sending the messages later, or give up after too many attempts.
+
+        If the chat kept failing with RPC errors, ex. it was deleted, the chat is
+        unsubscribed from its feeds.
+        """
+        attempts = max(row.attempts for row in rows) + 1
+        ids = [row.id for row in rows]
+        with session_scope() as session:
+            if attempts < self.options.max_attempts:
+                SEND_RETRIES.inc()
+                delay = self.options.retry_delay * 2 ** (attempts - 1)
+                stmt = update(Outbox).where(Outbox.id.in_(ids))
+                stmt = stmt.values(attempts=attempts, next_attempt=time.time() + delay)
+                session.execute(stmt)
+                return
+            self.bot.logger.error(
+                f"Giving up sending {len(ids)} messages to chat {gid}"
+            )
+            session.execute(delete(Outbox).where(Outbox.id.in_(ids)))
+            if rpc_error and any(row.html for row in rows):
+                stmt = delete(Fchat).where(Fchat.accid == accid, Fchat.gid == gid)
+                session.execute(stmt)
+                if self.registry is not None:
+                    self.registry.unsubscribe(accid, gid)
+
+    def _wait_token(self, accid: int) -> None:
+        """Wait until the account is allowed to send another message."""
+        rate = self.options.rate
+        if rate <= 0:
+            return
+        while True:
+            with self._tokens_lock:
+                now = time.time()
+                tokens, last = self._tokens.get(accid, (SEND_BURST, now))
+                tokens = min(SEND_BURST, tokens + (now - last) * rate)
+                if tokens >= 1:
+                    self._tokens[accid] = (tokens - 1, now)
+                    return
+                self._tokens[accid] = (tokens, now)
+            time.sleep((1 - tokens) / rate)
+
+
+def make_digests(rows: list, max_size: int) -> list:
+    """Merge the new entries of several feeds for a chat into
+    (MsgData, entries count, outbox rows) tuples.
+
+    A digest has at most max_size characters of HTML unless a single feed's
+    entries are bigger than that.
+    """
+    groups: list[list] = []
+    size = 0
+    for row in rows:
+        if groups and size + len(row.html) <= max_size:
+            groups[-1].append(row)
+            size += len(row.html)
+        else:
+            groups.append([row])
+            size = len(row.html)
+    DIGEST_PARTS.inc(len(rows))
+
+    digests = []
+    for group in groups:
+        entries = sum(row.entries for row in group)
+        if len(group) == 1:
+            msg = MsgData(html=group[0].html, override_sender_name=group[0].sender)
+        else:
+            html = "<br/><hr/>".join(
+                f"<h2>{escape(row.sender or '')}</h2>{row.html}" for row in group
+            )
+            msg = MsgData(html=html)
+        digests.append((msg, entries, group))
+    return digests
@@ -0,0 +1,235 @@
+"""Filters of the feed entries sent to each chat"""
+
+import functools
+import re
+from dataclasses import dataclass
+from re import _parser as sre_parse  # type: ignore # pylint: disable=no-name-in-module
+from typing import Iterable, Optional
+
+# with fewer keywords, searching each of them is faster than the trie
+TRIE_MIN_KEYWORDS = 50
+# regular expressions are run by a backtracking engine, they are limited so that
+# a pathological one, ex. /(a+)+$/, can't stall the checks of the feeds
+MAX_REGEX_LENGTH = 200
+MAX_REGEX_CHOICES = 64  # the paths that can be tried at each position of the text
+UNBOUNDED_CHOICES = 16  # the cost of a repetition like + or *, ex. /a+b/ is 16
+MAX_REGEX_TEXT = 1000  # only the start of the texts is searched
+_SINGLE = (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN)
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+_TERM = re.compile(r'(-?)(?:"([^"]*)"|/((?:[^/\\]|\\.)+)/(?=\s|$)|(\S+))')
+
+
+@dataclass(frozen=True)
+class Filter:
+    """A compiled filter, see parse_filter()."""
+
+    keywords: frozenset  # casefolded, all of them must be in the entry
+    excluded: frozenset  # casefolded, none of them can be in the entry
+    patterns: tuple  # regular expressions, all of them must match
+    excluded_patterns: tuple  # regular expressions, none of them can match
+
+    def matches(self, found: set, matched: set) -> bool:
+        """Check the filter given the keywords found in the entry and the
+        patterns that matched it.
+        """
+        return (
+            self.keywords <= found
+            and self.excluded.isdisjoint(found)
+            and all(pattern in matched for pattern in self.patterns)
+            and not any(pattern in matched for pattern in self.excluded_patterns)
+        )
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_filter(filter_: str) -> Filter:
+    """Compile a chat's filter, raise ValueError if it is invalid.
+
+    The filter is a list of terms separated by spaces, an entry matches if its
+    title or description contain all the terms, ignoring case. A term can be a
+    word, a "quoted phrase" or a /regular expression/, and terms starting with
+    "-" exclude the entries containing them.
+
+    Regular expressions can only repeat single characters, with few
+    repetitions and alternatives, and they are searched in the first
+    MAX_REGEX_TEXT characters, so that they can't take long to search.
+    """
+    keywords: set[str] = set()
+    excluded: set[str] = set()
+    patterns: list[re.Pattern] = []
+    excluded_patterns: list[re.Pattern] = []
+    for match in _TERM.finditer(filter_):
+        negated, phrase, regex, word = match.groups()
+        if regex is not None:
+            try:
+                _check_regex(regex)
+                pattern = re.compile(regex, re.IGNORECASE)
+            except re.error as ex:
+                raise ValueError(f"Invalid regular expression /{regex}/: {ex}") from ex
+            (excluded_patterns if negated else patterns).append(pattern)
+        else:
+            term = (phrase if phrase is not None else word).casefold()
+            if term:
+                (excluded if negated else keywords).add(term)
+    return Filter(
+        frozenset(keywords),
+        frozenset(excluded),
+        tuple(patterns),
+        tuple(excluded_patterns),
+    )
+
+
+class FilterMatcher:
+    """Match texts against many filters at once.
+
+    Each distinct keyword and regular expression of the filters is searched
+    once per text, no matter how many filters share it. With many keywords,
+    they are searched with a single regular expression shaped like a trie of
+    the keywords, so each text is scanned once in total instead of once per
+    keyword, like with the Aho-Corasick algorithm.
+    """
+
+    def __init__(self, filters: Iterable[str]) -> None:
+        self.filters = {filter_: _compile(filter_) for filter_ in set(filters)}
+        keywords: set = set()
+        patterns: set = set()
+        for compiled in self.filters.values():
+            keywords |= compiled.keywords | compiled.excluded
+            patterns.update(compiled.patterns + compiled.excluded_patterns)
+        self._patterns = tuple(patterns)
+        self._keywords = tuple(keywords)
+        # the filters that can match only if the text contains the keyword
+        self._index: dict[str, list] = {}
+        self._unindexed = []  # the filters without required keywords
+        for filter_, compiled in self.filters.items():
+            if compiled.keywords:
+                keyword = min(compiled.keywords)  # any of them works
+                self._index.setdefault(keyword, []).append(filter_)
+            else:
+                self._unindexed.append(filter_)
+        self._regex: Optional[re.Pattern] = None
+        self._contained: dict[str, set] = {}
+        if keywords and len(keywords) >= TRIE_MIN_KEYWORDS:
+            # the lookahead finds the longest keyword starting at every position,
+            # the shorter ones starting there are contained in it
+            self._regex = re.compile(f"(?=({_get_trie_regex(keywords)}))")
+            self._contained = {
+                keyword: {other for other in keywords if other in keyword}
+                for keyword in keywords
+            }
+
+    def match(self, text: str) -> set:
+        """Get the filters matching the given text."""
+        folded = text.casefold()
+        found: set = set()
+        if self._regex:
+            for keyword in set(self._regex.findall(folded)):
+                found |= self._contained[keyword]
+        else:
+            found.update(keyword for keyword in self._keywords if keyword in folded)
+        matched = {
+            pattern
+            for pattern in self._patterns
+            if pattern.search(text, 0, MAX_REGEX_TEXT)
+        }
+        candidates = list(self._unindexed)
+        for keyword in found:
+            candidates.extend(self._index.get(keyword, ()))
+        return {
+            filter_
+            for filter_ in candidates
+            if self.filters[filter_].matches(found, matched)
+        }
+
+
+def quote_filter(text: str) -> str:
+    """Get the filter matching the entries that contain the given text, ex. a
+    filter stored before the filters had a syntax, that meant the whole text.
+    """
+    if not text:
+        return ""
+    if '"' not in text:
+        return f'"{text}"'
+    return "/" + re.escape(text).replace("/", r"\/") + "/"
+
+
+def _check_regex(regex: str) -> None:
+    """Raise ValueError if the regular expression can take long to search, ex.
+    /(a+)+$/ that backtracks exponentially, raise re.error if it is invalid.
+    """
+    if len(regex) > MAX_REGEX_LENGTH:
+        raise ValueError(
+            f"Regular expression /{regex}/ is too long,"
+            f" the maximum is {MAX_REGEX_LENGTH} characters"
+        )
+    choices = 1
+    items = list(sre_parse.parse(regex))
+    while items:
+        opcode, arg = items.pop()
+        if opcode in _REPEATS:
+            _, maximum, body = arg
+            if len(body) != 1 or body[0][0] not in _SINGLE:
+                raise ValueError(
+                    f"Regular expression /{regex}/ is not supported,"
+                    " only single characters or [classes] can be repeated"
+                )
+            if maximum == sre_parse.MAXREPEAT:
+                choices *= UNBOUNDED_CHOICES
+            else:
+                choices *= maximum + 1
+        elif opcode is sre_parse.BRANCH:
+            choices *= len(arg[1])
+            for branch in arg[1]:
+                items.extend(branch)
+        elif opcode is sre_parse.SUBPATTERN:
+            items.extend(arg[-1])
+        elif opcode not in _SINGLE and opcode is not sre_parse.AT:
+            raise ValueError(
+                f"Regular expression /{regex}/ is not supported,"
+                " backreferences and lookarounds can't be used"
+            )
+    if choices > MAX_REGEX_CHOICES:
+        raise ValueError(
+            f"Regular expression /{regex}/ is too complex,"
+            " use fewer repetitions or alternatives"
+        )
+
+
+def _compile(filter_: str) -> Filter:
+    try:
+        return parse_filter(filter_)
+    except ValueError:  # stored before filters were validated, match it literally
+        return Filter(frozenset([filter_.casefold()]), frozenset(), (), ())
+
+
+@functools.lru_cache(maxsize=1024)
+def get_matcher(filters: frozenset) -> FilterMatcher:
+    """Get the matcher of a feed's filters, reused while they don't change."""
+    return FilterMatcher(filters)
+
+
+def _get_trie_regex(keywords: Iterable[str]) -> str:
+    """Get a regular expression matching the longest of the keywords, with the
+    common prefixes of the keywords merged, ex. "java(?:script)?".
+    """
+    trie: dict = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}  # the end of a keyword
+
+    def build(node: dict) -> str:
+        parts = []
+        # chains of single characters are common, build them without recursion
+        while len(node) == 1 and "" not in node:
+            char, node = next(iter(node.items()))
+            parts.append(re.escape(char))
+        branches = [
+            re.escape(char) + build(child) for char, child in node.items() if char
+        ]
+        if branches:
+            group = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+            parts.append(f"(?:{group})?" if "" in node else group)
+        return "".join(parts)
+
+    return build(trie)
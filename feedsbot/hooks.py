@@ -1,8 +1,16 @@
 """Event Hooks"""
 
+import sys
+import time
+import tracemalloc
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from threading import Thread
+from typing import TYPE_CHECKING, Callable, Optional
 
 from deltabot_cli import BotCli
 from deltachat2 import (
@@ -10,41 +18,208 @@ from deltachat2 import (
     ChatType,
     CoreEvent,
     EventType,
+    Message,
     MsgData,
     NewMsgEvent,
     SpecialContactId,
     SystemMessageType,
     events,
 )
-from feedparser import FeedParserDict
 from rich.logging import RichHandler
-from sqlalchemy import delete, func, select
+from sqlalchemy import Select, delete, func, or_, select
 
+from . import metrics
 from ._version import __version__
+from .cache import FetchCache
+from .delivery import DeliveryOptions, DeliveryQueue
+from .filters import parse_filter
+from .hosts import HostLimiter, interleave_hosts
+from .images import ImageCache
+from .memory import MemoryBudget
+from .opml import format_opml, parse_opml
 from .orm import Fchat, Feed, init, session_scope
+from .registry import FeedRegistry
+from .scheduler import Scheduler
+from .shard import Shard
 from .util import (
+    CheckContext,
+    TaskQueue,
     check_feeds,
+    discover_feed,
+    fetch_feed,
     format_entries,
     get_latest_date,
     get_old_entries,
+    merge_duplicate_feeds,
     normalize_url,
-    parse_feed,
+    quote_legacy_filters,
+    render_entries,
     set_group_image,
+    update_seen_entries,
 )
 
+if TYPE_CHECKING:
+    from feedparser import FeedParserDict
+
+MAX_OPML_SIZE = 1024**2 * 5  # 5MB
 cli = BotCli("feedsbot")
 cli.add_generic_option("-v", "--version", action="version", version=__version__)
 cli.add_generic_option(
     "--interval",
     type=int,
     default=60 * 20,
-    help="how many seconds to sleep before checking the feeds again (default: %(default)s)",
+    help="the minimum number of seconds to wait before checking a feed again (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--max-interval",
+    type=int,
+    default=60 * 60 * 6,
+    help="the maximum number of seconds to wait before checking a feed again, feeds that are rarely updated are checked less often (default: %(default)s)",
 )
 cli.add_generic_option(
     "--parallel",
     type=int,
     default=10,
-    help="how many feeds to check in parallel (default: %(default)s)",
+    help="how many feeds to check in parallel, with the async engine this is how many downloaded feeds are processed in parallel (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--engine",
+    choices=["threads", "async"],
+    default="threads",
+    help="how to download the feeds: with one thread per parallel download, or with an "
+    "asyncio event loop (requires aiohttp) that can handle thousands of "
+    "downloads at once (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--connections",
+    type=int,
+    default=500,
+    help="the maximum number of simultaneous connections of the async engine (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--host-connections",
+    type=int,
+    default=4,
+    help="the maximum number of feeds of the same host downloaded at once (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--host-delay",
+    type=float,
+    default=0.25,
+    help="the minimum number of seconds between the starts of two downloads from the "
+    "same host, hosts answering 429, or 503 with Retry-After, are paused as long "
+    "as they ask (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--parse-workers",
+    type=int,
+    default=0,
+    help="how many processes to use to parse the downloaded feeds, by default: 0 (parse in the same threads that download the feeds)",
+)
+cli.add_generic_option(
+    "--memory-budget",
+    type=int,
+    default=512,
+    help="the memory in MB the downloaded feeds waiting to be processed can use, "
+    "estimated from their size, new downloads wait while it is exceeded, 0 means "
+    "no limit (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--max-entries",
+    type=int,
+    default=100,
+    help="the maximum number of new entries of a feed sent at once, the older ones are skipped (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--max-html-size",
+    type=int,
+    default=1_000_000,
+    help="the maximum size in characters of the new entries of a feed sent in a "
+    "message, the older entries that don't fit are skipped, 0 means no limit "
+    "(default: %(default)s)",
+)
+cli.add_generic_option(
+    "--trace-memory",
+    action="store_true",
+    help="trace the memory allocations to log the peak memory of each check of the feeds, this slows down the bot",
+)
+cli.add_generic_option(
+    "--send-rate",
+    type=float,
+    default=5.0,
+    help="the maximum number of messages per second each account sends to the chats, 0 means no limit (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--digest-window",
+    type=int,
+    default=0,
+    help="how many seconds to collect the new entries of a chat before sending them in "
+    "one digest message, by default: 0 (send them after each check of the due "
+    "feeds)",
+)
+cli.add_generic_option(
+    "--digest-size",
+    type=int,
+    default=100_000,
+    help="the maximum size in characters of the digest messages, the new entries of a single feed are never split (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--delivery-workers",
+    type=int,
+    default=4,
+    help="how many chats to send messages to in parallel (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--fetch-cache-ttl",
+    type=int,
+    default=300,
+    help="how many seconds to remember the downloaded feeds, so /sub and the worker "
+    "don't download the same feed again, 0 disables the cache (default: "
+    "%(default)s)",
+)
+cli.add_generic_option(
+    "--fetch-cache-size",
+    type=int,
+    default=50,
+    help="the maximum size in MB of the cached feeds (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--image-cache-size",
+    type=int,
+    default=20,
+    help="the maximum size in MB of the feed images cached in the configuration "
+    "folder, ex. for the avatars of the groups created by /sub (default: "
+    "%(default)s)",
+)
+cli.add_generic_option(
+    "--command-workers",
+    type=int,
+    default=4,
+    help="how many /sub commands to process in parallel, they download the feeds in the background (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--command-queue",
+    type=int,
+    default=100,
+    help="the maximum number of /sub commands waiting to be processed, more are rejected (default: %(default)s)",
+)
+cli.add_generic_option(
+    "--metrics-port",
+    type=int,
+    default=0,
+    help="serve the worker metrics in the Prometheus format at http://127.0.0.1:PORT/metrics, by default: 0 (disabled)",
+)
+cli.add_generic_option(
+    "--database",
+    default="",
+    help="the SQLAlchemy URL of the database, ex. to share it with worker processes in other hosts, by default: sqlite.db in the configuration folder",
+)
+cli.add_generic_option(
+    "--sharded",
+    action="store_true",
+    help="don't check the feeds in the bot process, they are checked by the processes "
+    "started with the worker subcommand, the bot only processes the commands and "
+    "sends the new entries",
 )
 cli.add_generic_option(
     "--max",
@@ -59,6 +234,29 @@ cli.add_generic_option(
 )
 
 
+@dataclass
+class CommandContext:
+    """The state shared by the commands that subscribe the chats to feeds."""
+
+    scheduler: Scheduler
+    max_feeds: int  # the maximum number of stored feeds, -1 means no limit
+    workers: int  # how many feeds to download in parallel, ex. for /import
+    tasks: Optional[TaskQueue] = None  # to process the commands in the background
+    cache: Optional[FetchCache] = None
+    images: Optional[ImageCache] = None
+    # the feeds checked by this process, kept up to date by the commands
+    registry: Optional[FeedRegistry] = None
+
+    def submit(self, func: Callable, *args) -> bool:
+        """Queue func(*args), or without a task queue run it at once, return
+        False if there are too many pending tasks.
+        """
+        if self.tasks is None:
+            func(*args)
+            return True
+        return self.tasks.submit(func, *args)
+
+
 @cli.on_init
 def on_init(bot: Bot, args: Namespace) -> None:
     bot.logger.handlers = [
@@ -75,18 +273,251 @@ def on_init(bot: Bot, args: Namespace) -> None:
 
 @cli.on_start
 def on_start(bot: Bot, args: Namespace) -> None:
+    scheduler = Scheduler(args.interval, args.max_interval)
+    cache = FetchCache(args.fetch_cache_ttl, args.fetch_cache_size * 1024**2)
+    images = ImageCache(
+        Path(args.config_dir) / "images", args.image_cache_size * 1024**2
+    )
+    tasks = TaskQueue(bot, args.command_workers, args.command_queue)
+    # the feeds checked by this process, kept up to date by the commands
+    registry = None if args.sharded else FeedRegistry()
+    commands = CommandContext(
+        scheduler, args.max, args.parallel, tasks, cache, images, registry
+    )
     bot.add_hook(
-        (lambda b, a, e: _sub(args.max, b, a, e)), events.NewMessage(command="/sub")
+        (lambda b, a, e: _sub(commands, b, a, e)),
+        events.NewMessage(command="/sub"),
     )
-    config_dir = Path(args.config_dir)
-    init(f"sqlite:///{config_dir / 'sqlite.db'}")
+    bot.add_hook(
+        (lambda b, a, e: _unsub(registry, b, a, e)),
+        events.NewMessage(command="/unsub"),
+    )
+    bot.add_hook(
+        (lambda b, a, e: _import(commands, b, a, e)),
+        events.NewMessage(command="/import"),
+    )
+    bot.add_hook(
+        (lambda b, a, e: on_memberlist_change(registry, b, a, e)),
+        events.NewMessage(is_info=True),
+    )
+    _init_db(bot, args)
+    _start_metrics(bot, args)
+    options = DeliveryOptions(
+        args.send_rate,
+        args.digest_window,
+        args.digest_size,
+        args.delivery_workers,
+        # poll the outbox for the messages of the worker processes
+        poll=5 if args.sharded else 0,
+    )
+    delivery = DeliveryQueue(bot, options, registry=registry)
+    if registry is None:
+        bot.logger.info("Feeds will be checked by the worker processes")
+        return
+    registry.load()
+    bot.logger.info(f"Loaded {len(registry)} feeds")
+    context = _get_check_context(bot, args, scheduler, cache, registry=registry)
     Thread(
         target=check_feeds,
-        args=(bot, args.interval, args.parallel, config_dir),
+        args=(bot, context, args.parallel, Path(args.config_dir), delivery),
         daemon=True,
     ).start()
 
 
+def _worker_cmd(_cli: BotCli, bot: Bot, args: Namespace) -> None:
+    """check a share of the feeds without serving the accounts. Run several workers
+    sharing the database with a bot started with --sharded, ex. in other hosts with
+    --database, the feeds are split among the live workers.
+    """
+    _init_db(bot, args)
+    _start_metrics(bot, args)
+    scheduler = Scheduler(args.interval, args.max_interval)
+    cache = FetchCache(args.fetch_cache_ttl, args.fetch_cache_size * 1024**2)
+    shard = Shard(bot.logger)
+    context = _get_check_context(
+        bot, args, scheduler, cache, shard=shard, capture=args.capture
+    )
+    bot.logger.info(f"Starting worker {shard.worker_id}")
+    config_dir = Path(args.config_dir)
+    if args.capture:
+        args.capture.mkdir(parents=True, exist_ok=True)
+        bot.logger.info(f"Saving the downloaded feeds in {args.capture}")
+    try:
+        check_feeds(bot, context, args.parallel, config_dir, None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shard.stop()
+
+
+_worker_parser = cli.add_subcommand(_worker_cmd, name="worker")
+_worker_parser.add_argument(
+    "--capture",
+    type=Path,
+    help="save the last download of each feed in the given folder, to replay them with the profile subcommand",
+)
+
+
+def _profile_cmd(_cli: BotCli, bot: Bot, args: Namespace) -> None:
+    """process a feed or the feeds saved by worker --capture like the worker does, and
+    report the time spent in each stage, the memory used and the slowest functions.
+    No account or database is needed.
+    """
+    # pylint: disable=C0415
+    from .replay import ProfileOptions, load_responses, profile_responses
+
+    options = ProfileOptions(args.filter or [""], repeat=args.repeat, top=args.top)
+    if args.source.startswith(("http://", "https://")):
+        start = time.perf_counter()
+        try:
+            responses = [fetch_feed(args.source)]
+        except Exception as ex:
+            bot.logger.error(f"Failed to download {args.source}: {ex}")
+            sys.exit(1)
+        options.fetch_seconds[responses[0].url] = time.perf_counter() - start
+    else:
+        path = Path(args.source)
+        if not path.exists():
+            bot.logger.error(f"{path} doesn't exist")
+            sys.exit(1)
+        responses = load_responses(path)
+    if args.since:
+        options.since = tuple(datetime.fromisoformat(args.since).utctimetuple())
+    try:
+        report = profile_responses(responses, options)
+    except Exception as ex:
+        bot.logger.error(f"Failed to process the feeds: {ex}")
+        sys.exit(1)
+    print(report)
+
+
+_profile_parser = cli.add_subcommand(_profile_cmd, name="profile")
+_profile_parser.add_argument(
+    "source",
+    help="the URL of a feed, or a file or folder with the feeds saved by worker --capture or with feed files",
+)
+_profile_parser.add_argument(
+    "--filter",
+    action="append",
+    help="render the new entries for this filter, can be repeated (default: no filter)",
+)
+_profile_parser.add_argument(
+    "--since",
+    help="the date of the last entry already sent, ex. 2024-01-31, only the entries published after it are new (default: all the entries are new)",
+)
+_profile_parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="process each feed this many times and report the fastest (default: %(default)s)",
+)
+_profile_parser.add_argument(
+    "--top",
+    type=int,
+    default=20,
+    help="how many functions to show, by cumulative time (default: %(default)s)",
+)
+
+
+def _opml_cmd(_cli: BotCli, bot: Bot, args: Namespace) -> None:
+    """import or export the feeds of a group chat as an OPML file. Like the /import
+    command, the new feeds are downloaded to validate them, run it while the bot is
+    stopped.
+    """
+    accounts = [args.account] if args.account else bot.rpc.get_all_account_ids()
+    if len(accounts) != 1:
+        bot.logger.error(
+            "There is more than one account, please provide an account id with -a/--account option"
+        )
+        sys.exit(1)
+    accid = accounts[0]
+    if bot.rpc.get_basic_chat_info(accid, args.chat).chat_type == ChatType.SINGLE:
+        bot.logger.error(f"Chat {args.chat} is not a group chat")
+        sys.exit(1)
+    _init_db(bot, args)
+    if args.action == "export":
+        args.file.write_text(_export_opml(bot, accid, args.chat), encoding="utf-8")
+        return
+    try:
+        feeds = parse_opml(args.file.read_text(encoding="utf-8"))
+    except ValueError as ex:
+        bot.logger.error(str(ex))
+        sys.exit(1)
+    scheduler = Scheduler(args.interval, args.max_interval)
+    context = CommandContext(scheduler, args.max, args.parallel)
+    bot.logger.info(_import_feeds(context, accid, args.chat, feeds))
+
+
+_opml_parser = cli.add_subcommand(_opml_cmd, name="opml")
+_opml_parser.add_argument("action", choices=["import", "export"])
+_opml_parser.add_argument("chat", type=int, help="the ID of the group chat")
+_opml_parser.add_argument("file", type=Path, help="the path of the OPML file")
+
+
+def _init_db(bot: Bot, args: Namespace) -> None:
+    database = args.database or f"sqlite:///{Path(args.config_dir) / 'sqlite.db'}"
+    init(
+        database,
+        pool_size=args.parallel,
+        migrate=lambda: _migrate(bot),
+    )
+
+
+def _migrate(bot: Bot) -> None:
+    merge_duplicate_feeds(bot)
+    quote_legacy_filters(bot)
+
+
+def _start_metrics(bot: Bot, args: Namespace) -> None:
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+        bot.logger.info(
+            f"Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics"
+        )
+
+
+def _get_check_context(
+    bot: Bot, args: Namespace, scheduler: Scheduler, cache: FetchCache, **kwargs
+) -> CheckContext:
+    """Get the context of the checks of the feeds, with the host limiter, the
+    memory budget, and the async fetcher and the parse worker processes if
+    enabled, the other fields of the context can be given as keyword arguments.
+    """
+    hosts = HostLimiter(args.host_connections, args.host_delay)
+    budget = MemoryBudget(
+        args.memory_budget * 1024**2, args.max_entries, args.max_html_size
+    )
+    fetcher = None
+    if args.engine == "async":
+        try:
+            from .aio import AsyncFetcher  # pylint: disable=C0415
+        except ImportError:
+            bot.logger.error(
+                'The async engine requires aiohttp, install it with: pip install "feedsbot[async]"'
+            )
+            sys.exit(1)
+        fetcher = AsyncFetcher(
+            args.connections, args.host_connections, hosts=hosts, budget=budget
+        )
+    parser = None
+    if args.parse_workers > 0:
+        from concurrent.futures import ProcessPoolExecutor  # pylint: disable=C0415
+
+        parser = ProcessPoolExecutor(args.parse_workers)
+    return CheckContext(
+        scheduler,
+        budget=budget,
+        fetcher=fetcher,
+        parser=parser,
+        cache=cache,
+        # the async fetcher limits the hosts itself
+        hosts=None if fetcher else hosts,
+        **kwargs,
+    )
+
+
 @cli.on(events.RawEvent)
 def log_event(bot: Bot, accid: int, event: CoreEvent) -> None:
     if event.kind == EventType.INFO:
@@ -105,8 +536,9 @@ def log_event(bot: Bot, accid: int, event: CoreEvent) -> None:
                 send_help(bot, accid, chatid)
 
 
-@cli.on(events.NewMessage(is_info=True))
-def on_memberlist_change(bot: Bot, accid: int, event: NewMsgEvent) -> None:
+def on_memberlist_change(
+    registry: Optional[FeedRegistry], bot: Bot, accid: int, event: NewMsgEvent
+) -> None:
     if event.msg.system_message_type != SystemMessageType.MEMBER_REMOVED_FROM_GROUP:
         return
     chat_id = event.msg.chat_id
@@ -118,6 +550,8 @@ def on_memberlist_change(bot: Bot, accid: int, event: NewMsgEvent) -> None:
             bot.logger.debug(
                 f"group(id={chat_id}) subscriptions were deleted due to member-removed event"
             )
+        if registry is not None:
+            registry.unsubscribe(accid, chat_id)
 
 
 @cli.after(events.NewMessage)
@@ -148,10 +582,13 @@ def send_help(bot: Bot, accid: int, chat_id: int) -> None:
 
 **Available commands**
 
-/sub URL - Subscribe current chat to the given feed.
+/sub URL [FILTER] - Subscribe current chat to the given feed.
+    The filter is optional, only the entries containing all its words are sent, ignoring case.
+    Use "quotes" for phrases, /slashes/ for regular expressions and -word to exclude entries.
     Examples:
     /sub https://delta.chat/feed.xml
     /sub https://delta.chat/feed.xml keyword
+    /sub https://delta.chat/feed.xml "delta chat" -android /v[0-9]+/
 
 /unsub URL - Unsubscribe current chat from the given feed.
     Example:
@@ -159,6 +596,10 @@ def send_help(bot: Bot, accid: int, chat_id: int) -> None:
 
 /list - List feed subscriptions in the group the command is sent.
 
+/import - Subscribe the group to all the feeds of the OPML file attached to the command.
+
+/export - Get the group's subscriptions as an OPML file.
+
 
 **How to use me?**
 
@@ -167,117 +608,185 @@ Add me to a group then you can use the /sub command there to subscribe the group
     bot.rpc.send_msg(accid, chat_id, MsgData(text=text))
 
 
-def _sub(max_feed_count: int, bot: Bot, accid: int, event: NewMsgEvent) -> None:
+def _sub(context: CommandContext, bot: Bot, accid: int, event: NewMsgEvent) -> None:
     bot.rpc.markseen_msgs(accid, [event.msg.id])
-    chat = bot.rpc.get_basic_chat_info(accid, event.msg.chat_id)
     args = event.payload.split(maxsplit=1)
     url = normalize_url(args[0]) if args else ""
     filter_ = args[1] if len(args) == 2 else ""
-
-    with session_scope() as session:
-        feed = session.execute(select(Feed).where(Feed.url == url)).scalar()
-        if feed:
-            try:
-                d = parse_feed(feed.url)
-            except Exception as ex:
-                reply = MsgData(
-                    text="❌ Invalid feed url.",
-                    quoted_message_id=event.msg.id,
-                )
-                bot.rpc.send_msg(accid, event.msg.chat_id, reply)
-                bot.logger.exception("Invalid feed %s: %s", url, ex)
-                return
+    try:
+        parse_filter(filter_)
+    except ValueError as ex:
+        text = f"❌ Invalid filter: {ex}"
+    else:
+        # downloading the feed can take a while, don't block the other commands
+        if context.submit(_subscribe, context, bot, accid, event.msg, (url, filter_)):
+            text = "⏳ Checking the feed..."
         else:
-            stmt = select(func.count()).select_from(Feed)  # noqa
-            if 0 <= max_feed_count <= session.execute(stmt).scalar_one():
-                reply = MsgData(text="❌ Sorry, maximum number of feeds reached")
-                bot.rpc.send_msg(accid, event.msg.chat_id, reply)
-                return
-            try:
-                d = parse_feed(url)
-                feed = Feed(
-                    url=url,
-                    etag=d.get("etag"),
-                    modified=d.get("modified") or d.get("updated"),
-                    latest=get_latest_date(d.entries),
-                )
-                session.add(feed)
-            except Exception as ex:
-                reply = MsgData(
-                    text="❌ Invalid feed url.",
-                    quoted_message_id=event.msg.id,
-                )
-                bot.rpc.send_msg(accid, event.msg.chat_id, reply)
-                bot.logger.exception("Invalid feed %s: %s", url, ex)
-                return
+            text = "❌ Too many subscriptions in progress, please try again later"
+    reply = MsgData(text=text, quoted_message_id=event.msg.id)
+    bot.rpc.send_msg(accid, event.msg.chat_id, reply)
 
-        if chat.chat_type == ChatType.SINGLE:
-            chat_id = bot.rpc.create_group_chat(
-                accid, d.feed.get("title") or url, False
-            )
-            bot.rpc.add_contact_to_chat(accid, chat_id, event.msg.from_id)
-            url = d.feed.get("image", {}).get("href") or d.feed.get("logo")
-            if url:
-                set_group_image(bot, url, accid, chat_id)
-        else:
-            chat_id = event.msg.chat_id
-            stmt = select(Fchat).where(
-                Fchat.accid == accid, Fchat.gid == chat.id, Fchat.feed_url == feed.url
-            )
-            if session.execute(stmt).scalar():
-                reply = MsgData(
-                    text="❌ Chat already subscribed to that feed.",
-                    quoted_message_id=event.msg.id,
-                )
-                bot.rpc.send_msg(accid, chat_id, reply)
-                return
 
-        session.add(Fchat(accid=accid, gid=chat_id, feed_url=feed.url, filter=filter_))
+def _subscribe(
+    context: CommandContext, bot: Bot, accid: int, msg: Message, feed: tuple
+) -> None:
+    """Subscribe the chat to the given (url, filter) feed."""
+    url, filter_ = feed
+    chat = bot.rpc.get_basic_chat_info(accid, msg.chat_id)
+    try:
+        # the URL can be a web page linking the feed, or redirect to the feed
+        feed_url, d = discover_feed(url, context.cache)
+    except Exception as ex:
+        reply = MsgData(text="❌ Invalid feed url.", quoted_message_id=msg.id)
+        bot.rpc.send_msg(accid, msg.chat_id, reply)
+        bot.logger.exception("Invalid feed %s: %s", url, ex)
+        return
 
-    reply = MsgData(text=_format_feed_info(d, feed.url, filter_))
+    if _is_feed_rejected(context, feed_url):
+        reply = MsgData(text="❌ Sorry, maximum number of feeds reached")
+        bot.rpc.send_msg(accid, msg.chat_id, reply)
+        return
 
-    if d.entries and feed.latest:
-        reply.html = format_entries(
-            get_old_entries(d.entries, tuple(map(int, feed.latest.split())))[:15],
-            filter_,
+    if chat.chat_type == ChatType.SINGLE:
+        chat_id = bot.rpc.create_group_chat(
+            accid, d.feed.get("title") or feed_url, False
+        )
+        bot.rpc.add_contact_to_chat(accid, chat_id, msg.from_id)
+        _set_feed_image(context, bot, accid, chat_id, d)
+    else:
+        chat_id = msg.chat_id
+
+    fchat = {
+        "accid": accid,
+        "gid": chat_id,
+        "feed_url": feed_url,
+        "filter": filter_,
+        "requested_url": url if url != feed_url else None,
+    }
+    stored = _add_subscription(context, fchat, d)
+    if stored is None:
+        reply = MsgData(
+            text="❌ Chat already subscribed to that feed.",
+            quoted_message_id=msg.id,
         )
+        bot.rpc.send_msg(accid, chat_id, reply)
+        return
 
+    reply = MsgData(text=_format_feed_info(d, feed_url, filter_))
+    if d.entries and stored.latest:
+        reply.html = _format_old_entries(d, stored, filter_)
     bot.rpc.send_msg(accid, chat_id, reply)
 
 
-def _format_feed_info(d: FeedParserDict, url: str, filter_: str) -> str:
+def _is_feed_rejected(context: CommandContext, url: str) -> bool:
+    """Check if the feed is new and the maximum number of feeds was reached."""
+    with session_scope(readonly=True) as session:
+        if session.get(Feed, url):
+            return False
+        stmt = select(func.count()).select_from(Feed)  # noqa
+        return 0 <= context.max_feeds <= session.execute(stmt).scalar_one()
+
+
+def _set_feed_image(
+    context: CommandContext, bot: Bot, accid: int, chat_id: int, d: "FeedParserDict"
+) -> None:
+    """Use the feed's image as the avatar of the group created for it."""
+    image_url = d.feed.get("image", {}).get("href") or d.feed.get("logo")
+    if image_url and context.images:
+        context.submit(set_group_image, bot, context.images, image_url, accid, chat_id)
+
+
+def _add_subscription(
+    context: CommandContext, fchat: dict, d: "FeedParserDict"
+) -> Optional[Feed]:
+    """Store the subscription with the given Fchat columns, and the feed if it is
+    new, return the stored feed or None if the chat was already subscribed to it.
+    """
+    url = fchat["feed_url"]
+    next_check = time.time() + context.scheduler.min_interval
+    with session_scope() as session:
+        # the feed could have been added or removed while it was downloaded
+        feed = session.execute(select(Feed).where(Feed.url == url)).scalar()
+        new_feed = feed is None
+        if feed is None:
+            feed = _make_feed(context.scheduler, url, d, next_check)
+            session.add(feed)
+        elif session.get(Fchat, (fchat["accid"], fchat["gid"], url)):
+            return None
+        session.add(Fchat(**fchat))
+
+    if context.registry is not None:
+        if new_feed:
+            context.registry.add(feed)
+        context.registry.subscribe(fchat["accid"], fchat["gid"], url, fchat["filter"])
+    if new_feed:
+        context.scheduler.schedule(url, next_check)
+    return feed
+
+
+def _make_feed(
+    scheduler: Scheduler, url: str, d: "FeedParserDict", next_check: float
+) -> Feed:
+    """Get a new feed, its current entries are not sent to the chats."""
+    return Feed(
+        url=url,
+        etag=d.get("etag"),
+        modified=d.get("modified") or d.get("updated"),
+        latest=get_latest_date(d.entries),
+        seen=update_seen_entries(None, d.entries),
+        interval=scheduler.min_interval,
+        next_check=next_check,
+    )
+
+
+def _format_feed_info(d: "FeedParserDict", url: str, filter_: str) -> str:
     url = f"{url} ({filter_})" if filter_ else url
     title = d.feed.get("title") or "-"
     desc = d.feed.get("description") or "-"
     return f"Title: {title}\n\nURL: {url}\n\nDescription: {desc}"
 
 
-@cli.on(events.NewMessage(command="/unsub"))
-def _unsub(bot: Bot, accid: int, event: NewMsgEvent) -> None:
+def _format_old_entries(d: "FeedParserDict", feed: Feed, filter_: str) -> str:
+    """Get the last entries the feed had before the chat subscribed to it."""
+    old_entries = get_old_entries(d.entries, tuple(map(int, feed.latest.split())))
+    return format_entries(render_entries(old_entries[:15]), filter_)
+
+
+def _unsub(
+    registry: Optional[FeedRegistry], bot: Bot, accid: int, event: NewMsgEvent
+) -> None:
     bot.rpc.markseen_msgs(accid, [event.msg.id])
     if not event.payload:
         _list(bot, accid, event)
         return
 
     msg = event.msg
+    url = normalize_url(event.payload)
     with session_scope() as session:
-        stmt = select(Feed).where(Feed.url == normalize_url(event.payload))
-        feed = session.execute(stmt).scalar()
-        fchat = None
-        if feed:
-            stmt = select(Fchat).where(
-                Fchat.accid == accid,
-                Fchat.gid == msg.chat_id,
-                Fchat.feed_url == feed.url,
+        # the feed can be stored with another URL, ex. the feed linked by a web page
+        stmt: Select = select(Fchat.feed_url).where(
+            Fchat.accid == accid,
+            Fchat.gid == msg.chat_id,
+            or_(Fchat.feed_url == url, Fchat.requested_url == url),
+        )
+        feed_urls = session.execute(stmt).scalars().all()
+        feed_url = url if url in feed_urls else next(iter(feed_urls), None)
+        if feed_url:
+            session.execute(
+                delete(Fchat).where(
+                    Fchat.accid == accid,
+                    Fchat.gid == msg.chat_id,
+                    Fchat.feed_url == feed_url,
+                )
             )
-            fchat = session.execute(stmt).scalar()
-        if fchat:
-            session.delete(fchat)
-            reply = MsgData(text=f"Chat unsubscribed from: {feed.url}")
+            if registry is not None:
+                registry.unsubscribe(accid, msg.chat_id, feed_url)
+            reply = MsgData(text=f"Chat unsubscribed from: {feed_url}")
             bot.rpc.send_msg(accid, msg.chat_id, reply)
         else:
             reply = MsgData(
-                text="❌ This chat is not subscribed to that feed",
+                text="❌ This chat is not subscribed to that feed,"
+                " send /list to see the URLs of its feeds",
                 quoted_message_id=msg.id,
             )
             bot.rpc.send_msg(accid, msg.chat_id, reply)
@@ -295,9 +804,220 @@ def _list(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         )
         reply = MsgData(text=text, quoted_message_id=msg.id)
     else:
-        with session_scope() as session:
+        with session_scope(readonly=True) as session:
             stmt = select(Fchat).where(Fchat.accid == accid, Fchat.gid == msg.chat_id)
             fchats = session.execute(stmt).scalars()
             text = "\n\n".join(fchat.feed_url for fchat in fchats)
         reply = MsgData(text=text or "❌ No feed subscriptions in this chat")
     bot.rpc.send_msg(accid, msg.chat_id, reply)
+
+
+def _import(context: CommandContext, bot: Bot, accid: int, event: NewMsgEvent) -> None:
+    bot.rpc.markseen_msgs(accid, [event.msg.id])
+    msg = event.msg
+    feeds, text = _read_opml(bot, accid, msg)
+    if feeds:
+        if context.submit(_import_task, context, bot, accid, msg, feeds):
+            text = f"⏳ Checking {len(feeds)} feeds..."
+        else:
+            text = "❌ Too many subscriptions in progress, please try again later"
+    reply = MsgData(text=text, quoted_message_id=msg.id)
+    bot.rpc.send_msg(accid, msg.chat_id, reply)
+
+
+def _read_opml(bot: Bot, accid: int, msg: Message) -> tuple[list, str]:
+    """Get the (url, filter) feeds of the OPML file attached to the message, or
+    the error to reply with.
+    """
+    chat = bot.rpc.get_basic_chat_info(accid, msg.chat_id)
+    if chat.chat_type == ChatType.SINGLE:
+        return (
+            [],
+            "❌ You must send that command in the group to subscribe to the feeds",
+        )
+    if not msg.file:
+        return [], "❌ Attach the OPML file with the feeds to the /import command"
+    if Path(msg.file).stat().st_size > MAX_OPML_SIZE:
+        return [], "❌ The OPML file is too big"
+    try:
+        # the file is deleted with the message, so it can't be read in the task
+        feeds = parse_opml(Path(msg.file).read_text(encoding="utf-8"))
+    except (ValueError, UnicodeDecodeError) as ex:
+        return [], f"❌ {ex}"
+    return feeds, "❌ No feeds found in the OPML file"
+
+
+def _import_task(
+    context: CommandContext, bot: Bot, accid: int, msg: Message, feeds: list
+) -> None:
+    summary = _import_feeds(context, accid, msg.chat_id, feeds)
+    reply = MsgData(text=summary, quoted_message_id=msg.id)
+    bot.rpc.send_msg(accid, msg.chat_id, reply)
+
+
+@dataclass
+class _FeedImport:
+    """The progress of the import of a list of feeds, see _import_feeds()."""
+
+    filters: dict  # the filter of each valid feed URL
+    invalid: list  # the URLs of the invalid feeds
+    # the URL in the file of the feeds stored with another, ex. redirected
+    requested: dict = field(default_factory=dict)
+    new_feeds: dict = field(default_factory=dict)  # the downloaded feeds to store
+    added: list = field(default_factory=list)  # the URLs of the feeds stored
+    urls: list = field(default_factory=list)  # the feeds the chat was subscribed to
+    subscribed: int = 0  # the feeds the chat was already subscribed to
+    rejected: int = 0  # the feeds over the maximum number of feeds
+
+    @classmethod
+    def from_feeds(cls, feeds: list) -> "_FeedImport":
+        """Start importing the given (url, filter) feeds."""
+        filters = {normalize_url(url): filter_ for url, filter_ in feeds}
+        invalid = []
+        for url, filter_ in list(filters.items()):
+            try:
+                parse_filter(filter_)
+            except ValueError:
+                invalid.append(url)
+                del filters[url]
+        return cls(filters, invalid)
+
+    def get_summary(self) -> str:
+        lines = [f"✔️ Subscribed to {len(self.urls)} feeds"]
+        if self.subscribed:
+            lines.append(f"Already subscribed to {self.subscribed} feeds")
+        if self.rejected:
+            lines.append(
+                f"❌ {self.rejected} feeds rejected, maximum number of feeds reached"
+            )
+        if self.invalid:
+            lines.append(
+                f"❌ {len(self.invalid)} invalid feeds:\n" + "\n".join(self.invalid)
+            )
+        return "\n\n".join(lines)
+
+
+def _import_feeds(
+    context: CommandContext, accid: int, chat_id: int, feeds: list
+) -> str:
+    """Subscribe the chat to the given (url, filter) feeds and return a summary.
+
+    The feeds not stored yet are downloaded in `context.workers` parallel threads
+    to validate them, then all the subscriptions are added in a single
+    transaction.
+    """
+    state = _FeedImport.from_feeds(feeds)
+    _download_feeds(context, state)
+    _add_subscriptions(context, state, accid, chat_id)
+    for url in state.added:
+        if context.registry is not None:
+            context.registry.add(state.new_feeds[url])
+        context.scheduler.schedule(url, state.new_feeds[url].next_check)
+    if context.registry is not None:
+        for url in state.urls:
+            context.registry.subscribe(accid, chat_id, url, state.filters[url])
+    return state.get_summary()
+
+
+def _download_feeds(context: CommandContext, state: _FeedImport) -> None:
+    """Download the feeds not stored yet, resolving their URLs."""
+    with session_scope(readonly=True) as session:
+        known = _get_stored_feeds(session, list(state.filters))
+    new_urls = [url for url in state.filters if url not in known]
+    next_check = time.time() + context.scheduler.min_interval
+    with ThreadPoolExecutor(max(context.workers, 1)) as pool:
+        # so the threads aren't all waiting for the same server
+        new_urls = interleave_hosts(new_urls, lambda url: url)
+        futures = [pool.submit(discover_feed, url, context.cache) for url in new_urls]
+        for url, future in zip(new_urls, futures):
+            try:
+                feed_url, d = future.result()
+            except Exception:  # noqa
+                state.invalid.append(url)
+                del state.filters[url]
+                continue
+            if feed_url != url:  # the feed was redirected or linked by a web page
+                state.filters.setdefault(feed_url, state.filters.pop(url))
+                state.requested.setdefault(feed_url, url)
+            feed = _make_feed(context.scheduler, feed_url, d, next_check)
+            state.new_feeds[feed_url] = feed
+
+
+def _add_subscriptions(
+    context: CommandContext, state: _FeedImport, accid: int, chat_id: int
+) -> None:
+    """Store the new feeds and subscribe the chat to them in one transaction."""
+    with session_scope() as session:
+        # the feeds could have been added or removed while they were downloaded
+        known = _get_stored_feeds(session, list(state.filters))
+        stmt: Select = select(Fchat.feed_url).where(
+            Fchat.accid == accid, Fchat.gid == chat_id
+        )
+        chat_feeds = set(session.execute(stmt).scalars())
+        count = session.execute(select(func.count()).select_from(Feed)).scalar_one()
+        for url in state.filters:
+            if url in chat_feeds:
+                state.subscribed += 1
+                continue
+            if url not in known:
+                if url not in state.new_feeds:  # removed meanwhile
+                    state.invalid.append(url)
+                    continue
+                if 0 <= context.max_feeds <= count:
+                    state.rejected += 1
+                    continue
+                count += 1
+                state.added.append(url)
+            state.urls.append(url)
+        session.add_all(state.new_feeds[url] for url in state.added)
+        session.add_all(
+            Fchat(
+                accid=accid,
+                gid=chat_id,
+                feed_url=url,
+                filter=state.filters[url],
+                requested_url=state.requested.get(url),
+            )
+            for url in state.urls
+        )
+
+
+def _get_stored_feeds(session, urls: list) -> set:
+    """Get which of the given feeds are stored already."""
+    known: set[str] = set()
+    for i in range(0, len(urls), 500):
+        stmt: Select = select(Feed.url).where(Feed.url.in_(urls[i : i + 500]))
+        known.update(session.execute(stmt).scalars())
+    return known
+
+
+@cli.on(events.NewMessage(command="/export"))
+def _export(bot: Bot, accid: int, event: NewMsgEvent) -> None:
+    bot.rpc.markseen_msgs(accid, [event.msg.id])
+    msg = event.msg
+    chat = bot.rpc.get_basic_chat_info(accid, msg.chat_id)
+    if chat.chat_type == ChatType.SINGLE:
+        text = (
+            "❌ You must send that command in the group where you have the subscriptions.\n"
+            "You can check the groups you share with me in my profile"
+        )
+        reply = MsgData(text=text, quoted_message_id=msg.id)
+        bot.rpc.send_msg(accid, msg.chat_id, reply)
+        return
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "feeds.opml"
+        path.write_text(_export_opml(bot, accid, msg.chat_id), encoding="utf-8")
+        reply = MsgData(file=str(path), quoted_message_id=msg.id)
+        bot.rpc.send_msg(accid, msg.chat_id, reply)
+
+
+def _export_opml(bot: Bot, accid: int, chat_id: int) -> str:
+    name = bot.rpc.get_basic_chat_info(accid, chat_id).name
+    with session_scope(readonly=True) as session:
+        stmt: Select = (
+            select(Fchat.feed_url, Fchat.filter)
+            .where(Fchat.accid == accid, Fchat.gid == chat_id)
+            .order_by(Fchat.feed_url)
+        )
+        feeds = session.execute(stmt).all()
+    return format_opml(f"Feeds of {name}", feeds)
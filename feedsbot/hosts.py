@@ -0,0 +1,160 @@
+"""Politeness towards the servers hosting many of the feeds"""
+
+import itertools
+import time
+from contextlib import contextmanager
+from threading import Condition
+from typing import Callable, Generator, Iterable, Mapping, Optional, TypeVar
+from urllib.parse import urlsplit
+
+from .metrics import HOST_REQUESTS, HOST_SECONDS, HOST_THROTTLED
+from .scheduler import get_retry_delay
+
+# seconds to leave a host alone after 429 responses without Retry-After
+DEFAULT_PAUSE = 60.0
+_THROTTLE_STATUSES = (429, 503)
+T = TypeVar("T")
+
+
+class Throttled(Exception):
+    """The feed's host asked to wait before downloading more feeds."""
+
+    def __init__(self, url: str, delay: float, status: int = 0) -> None:
+        super().__init__(f"{get_host(url)} is rate-limited for {delay:.0f} seconds")
+        self.delay = delay
+        self.status = status  # the 429 or 503 status, 0 if the host was paused already
+
+
+class HostLimiter:
+    """Download at most `connections` feeds of the same host at once, start
+    them at least `spacing` seconds apart and pause the host when it answers
+    429 Too Many Requests, or 503 Service Unavailable with Retry-After.
+    """
+
+    def __init__(self, connections: int, spacing: float) -> None:
+        self.connections = max(connections, 1)
+        self.spacing = spacing
+        self._active: dict[str, int] = {}
+        self._next: dict[str, float] = {}  # when the next download can start
+        self._paused: dict[str, float] = {}
+        self._cond = Condition()
+
+    def fetch(self, url: str, fetch: Callable[[], T]) -> T:
+        """Call fetch() when the host allows it, raise Throttled if it doesn't."""
+        with self.slot(url):
+            try:
+                return fetch()
+            except Exception as ex:
+                throttled = self.throttle(url, ex)
+                if throttled:
+                    raise throttled from ex
+                raise
+
+    @contextmanager
+    def slot(self, url: str) -> Generator[None, None, None]:
+        """Wait for a free connection and the host's spacing, for the threads engine."""
+        host = get_host(url)
+        with self._cond:
+            self._cond.wait_for(lambda: self._active.get(host, 0) < self.connections)
+            self._active[host] = self._active.get(host, 0) + 1
+        try:
+            time.sleep(self.reserve(url))
+            self.check_paused(url)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(url, time.perf_counter() - start)
+        finally:
+            with self._cond:
+                self._active[host] -= 1
+                if not self._active[host]:
+                    del self._active[host]
+                self._cond.notify_all()
+
+    def reserve(self, url: str) -> float:
+        """Reserve the host's next download turn and return how many seconds to
+        wait for it, raise Throttled if the host is paused.
+        """
+        host = get_host(url)
+        now = time.monotonic()
+        with self._cond:
+            self._check_paused(url, now)
+            start = max(now, self._next.get(host, 0))
+            self._next[host] = start + self.spacing
+            if len(self._next) > 10_000:  # forget the hosts that can start at once
+                self._next = {h: t for h, t in self._next.items() if t > now}
+        return start - now
+
+    def check_paused(self, url: str) -> None:
+        """Raise Throttled if the host asked to wait, ex. while waiting for a turn."""
+        with self._cond:
+            self._check_paused(url, time.monotonic())
+
+    def _check_paused(self, url: str, now: float) -> None:
+        host = get_host(url)
+        paused = self._paused.get(host, 0) - now
+        if paused > 0:
+            raise Throttled(url, paused)
+        self._paused.pop(host, None)
+
+    def throttle(self, url: str, err: Exception) -> Optional[Throttled]:
+        """If the download failed with 429 or 503, pause the host as long as it
+        asked with Retry-After and return the error to raise instead.
+
+        A 503 without Retry-After isn't throttling, the host may be down for
+        good, so it counts as an error of the feed.
+        """
+        status = get_error_status(err)
+        if status not in _THROTTLE_STATUSES:
+            return None
+        headers = get_error_headers(err)
+        if status == 503 and not headers.get("retry-after"):
+            return None
+        host = get_host(url)
+        HOST_THROTTLED.inc(host=host)
+        delay = get_retry_delay(headers, time.time()) or DEFAULT_PAUSE
+        with self._cond:
+            until = time.monotonic() + delay
+            self._paused[host] = max(self._paused.get(host, 0), until)
+        return Throttled(url, delay, status)
+
+    def observe(self, url: str, seconds: float) -> None:
+        host = get_host(url)
+        HOST_REQUESTS.inc(host=host)
+        HOST_SECONDS.inc(seconds, host=host)
+
+
+def get_host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def get_error_status(err: Exception) -> Optional[int]:
+    """Get the HTTP status of a failed request."""
+    resp = getattr(err, "response", None)  # requests
+    if resp is not None:
+        return resp.status_code
+    return getattr(err, "status", None)  # aiohttp
+
+
+def get_error_headers(err: Exception) -> Mapping[str, str]:
+    """Get the response headers of a failed HTTP request."""
+    resp = getattr(err, "response", None)  # requests
+    if resp is not None:
+        return resp.headers
+    return getattr(err, "headers", None) or {}  # aiohttp
+
+
+def interleave_hosts(feeds: Iterable[T], get_url: Callable[[T], str]) -> list:
+    """Reorder the feeds so the feeds of the same host are spread out, keeping
+    the order of each host's feeds.
+    """
+    hosts: dict[str, list] = {}
+    for feed in feeds:
+        hosts.setdefault(get_host(get_url(feed)), []).append(feed)
+    return [
+        feed
+        for group in itertools.zip_longest(*hosts.values())
+        for feed in group
+        if feed is not None
+    ]
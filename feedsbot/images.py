@@ -0,0 +1,157 @@
+"""On-disk cache of the feeds' images, ex. the avatars of the groups"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+# images bigger than this are not downloaded
+MAX_IMAGE_SIZE = 1024**2 * 5  # 5MB
+# seconds before a cached image is revalidated with the server
+REVALIDATE_AFTER = 60 * 60 * 24
+# seconds since the last use after which a cached image is removed
+MAX_AGE = 60 * 60 * 24 * 30
+
+
+class ImageCache:
+    """Keep the downloaded images in a folder, so the image of a feed is
+    downloaded again only when it changed.
+
+    The images are stored by the hash of their content, so the same image
+    served at different URLs is stored once. The least recently used images are
+    removed when they take more than `max_size` bytes or weren't used for
+    MAX_AGE seconds.
+    """
+
+    def __init__(self, directory: Path, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._index_path = directory / "index.json"
+        self._lock = Lock()
+        directory.mkdir(parents=True, exist_ok=True)
+        try:
+            self._index: dict[str, dict] = json.loads(
+                self._index_path.read_text(encoding="utf-8")
+            )
+        except (OSError, ValueError):
+            self._index = {}
+        # forget the images whose file is missing and remove the files not indexed
+        self._index = {
+            url: entry
+            for url, entry in self._index.items()
+            if (directory / entry["file"]).exists()
+        }
+        files = {entry["file"] for entry in self._index.values()}
+        for path in directory.iterdir():
+            if path != self._index_path and path.name not in files:
+                path.unlink(missing_ok=True)
+
+    def get(
+        self, url: str, session: "requests.Session", get_ext: Callable
+    ) -> Optional[Path]:
+        """Get the path of the image at the given URL, downloading it if it isn't
+        cached or revalidating it if it is old. Return None if the image can't be
+        downloaded or is too big.
+
+        `get_ext` gets the file extension from the response.
+        """
+        import requests  # pylint: disable=C0415
+
+        now = time.time()
+        with self._lock:
+            entry = dict(self._index.get(url) or {})
+        if entry and now - entry["checked"] < REVALIDATE_AFTER:
+            return self._use(url, now)
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("modified"):
+            headers["If-Modified-Since"] = entry["modified"]
+        try:
+            with session.get(url, headers=headers, stream=True) as resp:
+                resp.raise_for_status()
+                if resp.status_code == 304 and entry:
+                    entry["checked"] = now
+                else:
+                    entry = self._store(resp, get_ext(resp) or "", now)
+        except (requests.RequestException, ValueError):
+            # keep using the cached image while the server fails
+            return self._use(url, now) if entry else None
+        with self._lock:
+            self._index[url] = entry
+        path = self._use(url, now)
+        self._evict(now)
+        return path
+
+    def _store(self, resp: "requests.Response", ext: str, now: float) -> dict:
+        """Save the downloaded image and get its index entry."""
+        if int(resp.headers.get("content-length") or 0) > MAX_IMAGE_SIZE:
+            raise ValueError("Image too big")
+        content = bytearray()
+        for chunk in resp.iter_content(chunk_size=102400):
+            content.extend(chunk)
+            if len(content) > MAX_IMAGE_SIZE:
+                raise ValueError("Image too big")
+        name = hashlib.sha256(content).hexdigest() + ext
+        path = self.directory / name
+        if not path.exists():
+            with NamedTemporaryFile(dir=self.directory, delete=False) as temp_file:
+                temp_file.write(content)
+            os.replace(temp_file.name, path)
+        return {
+            "file": name,
+            "size": len(content),
+            "etag": resp.headers.get("etag"),
+            "modified": resp.headers.get("last-modified"),
+            "checked": now,
+            "used": now,
+        }
+
+    def _use(self, url: str, now: float) -> Optional[Path]:
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is None:
+                return None
+            entry["used"] = now
+            self._save()
+            return self.directory / entry["file"]
+
+    def _evict(self, now: float) -> None:
+        """Remove the least recently used images until they fit in max_size."""
+        with self._lock:
+            files: dict[str, tuple] = {}  # the last use and size of each file
+            for entry in self._index.values():
+                used = files.get(entry["file"], (0.0, 0))[0]
+                files[entry["file"]] = (max(used, entry["used"]), entry["size"])
+            total = sum(size for _, size in files.values())
+            removed = set()
+            for name, (used, size) in sorted(files.items(), key=lambda f: f[1][0]):
+                if total <= self.max_size and now - used < MAX_AGE:
+                    break
+                removed.add(name)
+                total -= size
+            if not removed:
+                return
+            self._index = {
+                url: entry
+                for url, entry in self._index.items()
+                if entry["file"] not in removed
+            }
+            self._save()
+        for name in removed:
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _save(self) -> None:
+        with NamedTemporaryFile(
+            "w", dir=self.directory, delete=False, encoding="utf-8"
+        ) as temp_file:
+            json.dump(self._index, temp_file)
+        os.replace(temp_file.name, self._index_path)
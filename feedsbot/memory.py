@@ -0,0 +1,158 @@
+"""Memory budget of the worker, so big sweeps fit in small machines"""
+
+import tracemalloc
+from collections import deque
+from threading import Condition
+from typing import TYPE_CHECKING, Any, Callable
+
+from .metrics import HELD_BYTES, MEMORY_PEAK
+
+if TYPE_CHECKING:
+    from .util import FeedResponse
+
+# the memory needed to parse and render a feed is about this many times its size,
+# measured with the profile subcommand
+PROCESSING_FACTOR = 15
+# the memory reserved for a download until its size is known
+DOWNLOAD_RESERVE = 1024**2
+
+
+class MemoryBudget:
+    """Limit the memory used by the feeds being downloaded and waiting to be
+    processed.
+
+    A download reserves DOWNLOAD_RESERVE bytes when it starts and, once it
+    ends, PROCESSING_FACTOR times the feed's size instead, until release() is
+    called with the feed's URL after it was processed or discarded. Downloads
+    start only while their reservation fits in `max_bytes`, 0 means no limit, or
+    nothing is held, so the budget is exceeded only by big feeds, it can't stop a
+    download halfway.
+    The downloads of the async engine waiting for the budget are woken in order
+    as the budget is released, without polling.
+
+    The new entries of a feed sent in a message are limited to `max_entries`
+    and their HTML to `max_html_size` characters, the first entry is always
+    sent.
+    """
+
+    def __init__(
+        self, max_bytes: int = 0, max_entries: int = 100, max_html_size: int = 0
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_html_size = max_html_size
+        self.held = 0
+        self._feeds: dict[str, int] = {}  # the bytes held by each feed
+        self._cond = Condition()
+        # the URL, event loop and future of the async downloads waiting for room
+        self._waiters: deque[tuple[str, Any, Any]] = deque()
+
+    def fetch(self, url: str, fetch: Callable[[], "FeedResponse"]) -> "FeedResponse":
+        """Download a feed with fetch() when the budget allows it, for the
+        threads engine.
+        """
+        with self._cond:
+            self._cond.wait_for(self._has_room)
+            self._set(url, DOWNLOAD_RESERVE)
+        resp = fetch()
+        self.hold(url, len(resp.text))
+        return resp
+
+    async def wait(self, url: str) -> None:
+        """Wait until the budget allows downloading the feed, for the async
+        engine, hold() must be called when the download ends.
+        """
+        import asyncio  # pylint: disable=C0415
+
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if not self._waiters and self._has_room():
+                self._set(url, DOWNLOAD_RESERVE)
+                return
+            waiter = (url, loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            # the download's reservation is made by _wake() before the future is done
+            await waiter[2]
+        except asyncio.CancelledError:
+            with self._cond:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:  # woken already
+                    self._set(url, 0)
+                    self._wake()
+            raise
+
+    def hold(self, url: str, size: int) -> None:
+        """Hold the memory needed to process the feed downloaded from the URL,
+        given the feed's size.
+        """
+        with self._cond:
+            self._set(url, size * PROCESSING_FACTOR)
+            self._cond.notify_all()
+            self._wake()
+
+    def release(self, url: str) -> None:
+        """Release the memory held by the feed, if any."""
+        with self._cond:
+            self._set(url, 0)
+            self._cond.notify_all()
+            self._wake()
+
+    def _set(self, url: str, size: int) -> None:
+        old_size = self._feeds.pop(url, 0)
+        if size:
+            self._feeds[url] = size
+        self.held += size - old_size
+        HELD_BYTES.inc(size - old_size)
+
+    def _has_room(self) -> bool:
+        """Check if a download fits in the budget, one always does."""
+        return (
+            not self.max_bytes
+            or not self.held
+            or self.held + DOWNLOAD_RESERVE <= self.max_bytes
+        )
+
+    def _wake(self) -> None:
+        """Reserve the budget for the oldest async downloads waiting for it, while
+        there is room, and wake them up in their event loops.
+        """
+        while self._waiters and self._has_room():
+            url, loop, future = self._waiters.popleft()
+            self._set(url, DOWNLOAD_RESERVE)
+            loop.call_soon_threadsafe(_set_done, future)
+
+
+def _set_done(future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def start_sweep() -> None:
+    """Start measuring the peak memory of a sweep, if tracemalloc is enabled."""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+def get_sweep_report() -> str:
+    """Get the peak and current memory traced by tracemalloc since the sweep
+    started and where most of the current memory was allocated, or an empty
+    string if tracemalloc is disabled.
+    """
+    if not tracemalloc.is_tracing():
+        return ""
+    current, peak = tracemalloc.get_traced_memory()
+    MEMORY_PEAK.set(peak)
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    top = ", ".join(
+        f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}"
+        f"={stat.size / 1024**2:.1f}MB"
+        for stat in snapshot.statistics("lineno")[:3]
+    )
+    return (
+        f"peak: {peak / 1024**2:.1f}MB; current: {current / 1024**2:.1f}MB;"
+        f" largest allocations: {top or '-'}"
+    )
@@ -0,0 +1,303 @@
+"""Worker instrumentation exposed in the Prometheus text format"""
+
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Generator
+
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_registry: list = []
+_last_summary: dict = {}
+
+
+class Counter:
+    """A value that only increases, with optional labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_: str) -> None:
+        self.name = name
+        self.help = help_
+        self._values: dict[tuple, float] = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, ex. the length of a queue."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """Count observed values, ex. durations in seconds, in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_: str, buckets: tuple = _BUCKETS) -> None:
+        self.name = name
+        self.help = help_
+        self.buckets = buckets
+        # labels -> [count per bucket..., count, sum]
+        self._values: dict[tuple, list] = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Generator[None, None, None]:
+        """Observe how long the block takes to run."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels) -> tuple:
+        """Get the number of observed values and their sum."""
+        with self._lock:
+            values = self._values.get(tuple(sorted(labels.items())))
+            return (values[-2], values[-1]) if values else (0, 0.0)
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, values in self._values.items():
+                for bound, count in zip(self.buckets, values):
+                    le_key = key + (("le", str(bound)),)
+                    samples.append((self.name + "_bucket", le_key, count))
+                samples.append(
+                    (self.name + "_bucket", key + (("le", "+Inf"),), values[-2])
+                )
+                samples.append((self.name + "_count", key, values[-2]))
+                samples.append((self.name + "_sum", key, values[-1]))
+        return samples
+
+
+FETCH_SECONDS = Histogram(
+    "feedsbot_fetch_seconds",
+    "Time spent downloading feeds by stage: dns, connect (includes dns),"
+    " ttfb (from sending the request until the response headers arrive, includes"
+    " connecting) and body. dns and connect are only measured by the async engine.",
+)
+PARSE_SECONDS = Histogram("feedsbot_parse_seconds", "Time spent in feedparser.parse()")
+RENDER_SECONDS = Histogram(
+    "feedsbot_render_seconds", "Time spent rendering and filtering the new entries"
+)
+DB_SECONDS = Histogram(
+    "feedsbot_db_session_seconds",
+    "Duration of database sessions, including the wait for the write lock",
+)
+DB_LOCK_SECONDS = Histogram(
+    "feedsbot_db_lock_wait_seconds", "Time spent waiting for the database write lock"
+)
+SEND_SECONDS = Histogram("feedsbot_send_seconds", "Time spent in bot.rpc.send_msg()")
+SWEEP_SECONDS = Histogram(
+    "feedsbot_sweep_seconds",
+    "Duration of each check of the due feeds",
+    (1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600),
+)
+RESPONSES = Counter(
+    "feedsbot_responses_total",
+    "Feed downloads by HTTP status, 'error' if failed or 'throttled' if not"
+    " attempted because the host asked to wait",
+)
+DOWNLOADED_BYTES = Counter(
+    "feedsbot_downloaded_bytes_total", "Bytes of feeds downloaded"
+)
+DELIVERED_ENTRIES = Counter(
+    "feedsbot_delivered_entries_total", "Entries sent to chats, once per chat"
+)
+SENT_MESSAGES = Counter("feedsbot_sent_messages_total", "Messages sent to chats")
+SEND_ERRORS = Counter(
+    "feedsbot_send_errors_total", "Messages that couldn't be sent to chats"
+)
+SEND_RETRIES = Counter(
+    "feedsbot_send_retries_total",
+    "Times a chat's messages were postponed after an error",
+)
+DIGEST_PARTS = Counter(
+    "feedsbot_digest_parts_total",
+    "Feed updates for a chat, merged into digest messages",
+)
+UNCHANGED_FEEDS = Counter(
+    "feedsbot_unchanged_feeds_total",
+    "Feeds not parsed because the body didn't change since the last check",
+)
+TRUNCATED_FEEDS = Counter(
+    "feedsbot_truncated_feeds_total",
+    "Feeds downloaded only until the entries already seen",
+)
+FETCH_CACHE = Counter(
+    "feedsbot_fetch_cache_total",
+    "Feed downloads requested by the commands and the worker, by result: hit"
+    " (cached), coalesced (shared with a download in progress) or miss",
+)
+HOST_REQUESTS = Counter(
+    "feedsbot_host_requests_total", "Feed downloads by host, see _host_seconds_total"
+)
+HOST_SECONDS = Counter(
+    "feedsbot_host_seconds_total",
+    "Time spent downloading the feeds of each host, divide it by"
+    " _host_requests_total to get the average latency",
+)
+HOST_THROTTLED = Counter(
+    "feedsbot_host_throttled_total",
+    "429 and 503 with Retry-After responses by host, the host is paused as asked",
+)
+MOVED_FEEDS = Counter(
+    "feedsbot_moved_feeds_total",
+    "Feeds moved to the URL they were permanently redirected to, or merged into"
+    " the feed already stored with that URL",
+)
+REMOVED_FEEDS = Counter(
+    "feedsbot_removed_feeds_total", "Feeds removed automatically after too many errors"
+)
+
+TASKS = Gauge(
+    "feedsbot_tasks",
+    "Commands' background tasks, ex. /sub downloads, waiting or running",
+)
+HELD_BYTES = Gauge(
+    "feedsbot_held_bytes",
+    "Memory held by the downloaded feeds not processed yet, see --memory-budget",
+)
+MEMORY_PEAK = Gauge(
+    "feedsbot_sweep_memory_peak_bytes",
+    "Peak memory traced during the last check of the due feeds, with --trace-memory",
+)
+
+
+def render() -> str:
+    """Get all the metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                labels_str = ",".join(f'{key}="{val}"' for key, val in labels)
+                name = f"{name}{{{labels_str}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _snapshot() -> dict:
+    return {
+        (name, labels): value
+        for metric in _registry
+        for name, labels, value in metric.samples()
+        if not name.endswith("_bucket")
+    }
+
+
+def format_summary() -> str:
+    """Summarize the changes of the metrics since the previous summary."""
+    global _last_summary  # pylint: disable=W0603
+
+    def delta(name: str, **labels) -> float:
+        key = (name, tuple(sorted(labels.items())))
+        return snapshot_now.get(key, 0) - before.get(key, 0)
+
+    def total_delta(name: str) -> float:
+        """The change of a metric summed over all its labels."""
+        return sum(
+            value - before.get(key, 0)
+            for key, value in snapshot_now.items()
+            if key[0] == name
+        )
+
+    before, snapshot_now = _last_summary, _snapshot()
+    _last_summary = snapshot_now
+    statuses = sorted(
+        {
+            dict(labels)["status"]
+            for name, labels in snapshot_now
+            if name == RESPONSES.name
+        }
+    )
+    responses = ", ".join(
+        f"{status}={delta(RESPONSES.name, status=status):.0f}" for status in statuses
+    )
+    stages = []
+    for label, histogram, labels in (
+        ("ttfb", FETCH_SECONDS, {"stage": "ttfb"}),
+        ("body", FETCH_SECONDS, {"stage": "body"}),
+        ("parse", PARSE_SECONDS, {}),
+        ("render", RENDER_SECONDS, {}),
+        ("db", DB_SECONDS, {}),
+        ("db lock wait", DB_LOCK_SECONDS, {}),
+        ("send", SEND_SECONDS, {}),
+    ):
+        stages.append(f"{label}={delta(histogram.name + '_sum', **labels):.1f}s")
+    downloaded = delta(DOWNLOADED_BYTES.name) / 1024**2
+    cache = {
+        result: delta(FETCH_CACHE.name, result=result)
+        for result in ("hit", "coalesced", "miss")
+    }
+    return (
+        f"responses: {responses or '-'}; downloaded: {downloaded:.1f}MB;"
+        f" unchanged feeds: {delta(UNCHANGED_FEEDS.name):.0f};"
+        f" truncated feeds: {delta(TRUNCATED_FEEDS.name):.0f};"
+        f" fetch cache: {', '.join(f'{k}={v:.0f}' for k, v in cache.items())};"
+        f" sent messages: {delta(SENT_MESSAGES.name):.0f}"
+        f" ({delta(SEND_ERRORS.name):.0f} failed);"
+        f" delivered entries: {delta(DELIVERED_ENTRIES.name):.0f};"
+        f" rate-limited: {total_delta(HOST_THROTTLED.name):.0f};"
+        f" removed feeds: {delta(REMOVED_FEEDS.name):.0f};"
+        f" time per stage (summed over workers): {', '.join(stages)}"
+    )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:  # noqa  # pylint: disable=W0622
+        pass
+
+    def do_GET(self) -> None:  # noqa  # pylint: disable=C0103
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics at http://host:port/metrics in a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
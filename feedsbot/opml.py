@@ -0,0 +1,41 @@
+"""Import and export the subscriptions of a chat as OPML"""
+
+from email.utils import formatdate
+from typing import Iterable
+from xml.etree import ElementTree
+
+
+def parse_opml(text: str) -> list:
+    """Get the (url, filter) pairs of the feeds in an OPML document.
+
+    The outlines can be nested in folders, the folders are ignored. The filter
+    is read from the non-standard "filter" attribute written by format_opml().
+    """
+    try:
+        root = ElementTree.fromstring(text)
+    except ElementTree.ParseError as ex:
+        raise ValueError(f"Invalid OPML file: {ex}") from ex
+    if root.tag != "opml":
+        raise ValueError("Invalid OPML file: the root element is not <opml>")
+    feeds = []
+    for outline in root.iter("outline"):
+        url = (outline.get("xmlUrl") or outline.get("xmlurl") or "").strip()
+        if url:
+            feeds.append((url, outline.get("filter") or ""))
+    return feeds
+
+
+def format_opml(title: str, feeds: Iterable[tuple]) -> str:
+    """Get an OPML document with the given (url, filter) pairs."""
+    root = ElementTree.Element("opml", version="2.0")
+    head = ElementTree.SubElement(root, "head")
+    ElementTree.SubElement(head, "title").text = title
+    ElementTree.SubElement(head, "dateCreated").text = formatdate(usegmt=True)
+    body = ElementTree.SubElement(root, "body")
+    for url, filter_ in feeds:
+        attrs = {"type": "rss", "text": url, "xmlUrl": url}
+        if filter_:
+            attrs["filter"] = filter_
+        ElementTree.SubElement(body, "outline", attrs)
+    ElementTree.indent(root)
+    return ElementTree.tostring(root, encoding="unicode", xml_declaration=True) + "\n"
@@ -1,12 +1,40 @@
 """database"""
 
-from contextlib import contextmanager
+import time
+from contextlib import contextmanager, nullcontext
 from threading import Lock
-from typing import Any, Generator
+from typing import Any, Callable, Generator, Iterable, Optional
 
-from sqlalchemy import Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    bindparam,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, declarative_base, relationship, sessionmaker
 
+from .metrics import DB_LOCK_SECONDS, DB_SECONDS
+
+# increase it when the tables change or the stored data needs to be migrated,
+# the setup and migrations run on start only if the database is older, with
+# SQLite; other databases are always checked
+SCHEMA_VERSION = 4
+# the syntax of Fchat.filter, filters without it are matched literally, see
+# filters.quote_filter()
+FILTER_SYNTAX = 1
 Base: Any = declarative_base()
 _Session = sessionmaker(expire_on_commit=False)
 _lock = Lock()
@@ -19,6 +47,12 @@ class Feed(Base):
     modified = Column(String)
     latest = Column(String)
     errors = Column(Integer, nullable=False)
+    interval = Column(Integer)  # current polling interval in seconds
+    next_check = Column(Float, index=True)  # UNIX timestamp when the feed is due
+    last_check = Column(Float)  # UNIX timestamp when the feed was last checked
+    body_hash = Column(String)  # hash of the last downloaded body
+    seen = Column(String)  # keys of the entries already seen, newest first
+    ttl = Column(Integer)  # update period in seconds announced by the feed
     fchats = relationship("Fchat", backref="feed", cascade="all, delete, delete-orphan")
 
     def __init__(self, **kwargs):
@@ -32,12 +66,156 @@ class Fchat(Base):
     gid = Column(Integer, primary_key=True)
     feed_url = Column(String, ForeignKey("feeds.url"), primary_key=True)
     filter = Column(String)
+    # NULL for the filters stored before they had a syntax, until they are quoted
+    filter_syntax = Column(Integer, default=FILTER_SYNTAX)
+    # the URL given to /sub if the feed is stored with another, ex. the feed
+    # linked by a web page, so /unsub accepts it too
+    requested_url = Column(String)
+
+
+class Outbox(Base):
+    """A message waiting to be sent, ex. the new entries of a feed for a chat."""
+
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    accid = Column(Integer, nullable=False)
+    gid = Column(Integer, nullable=False)
+    sender = Column(String)  # the feed title
+    html = Column(String)  # the new entries
+    text = Column(String)  # or a plain text notification
+    entries = Column(Integer, nullable=False, default=0)
+    created = Column(Float, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(Float, nullable=False, default=0)
+    __table_args__ = (Index("ix_outbox_chat", "accid", "gid"),)
+
+
+class Worker(Base):
+    """A process checking a share of the feeds, see shard.Shard."""
+
+    __tablename__ = "workers"
+    id = Column(String, primary_key=True)
+    started = Column(Float, nullable=False)
+    heartbeat = Column(Float, nullable=False)  # the worker is dead if not renewed
+
+
+class FeedUpdates:
+    """Collect changes to the state of feeds and write them in batched transactions.
+
+    Changes are flushed when `batch_size` feeds have pending changes, when the
+    oldest pending change is `max_delay` seconds old, when the pending messages
+    have `max_size` characters or when flush() is called, ex. at the end of a
+    check, so if the process dies in the middle of a long check only the last
+    few seconds of work are lost, and big messages aren't kept in memory. The
+    messages added with a change are written to the outbox in the same
+    transaction, so the new entries of a feed are either queued for delivery and
+    marked as seen, or neither.
+
+    If `listener` is given, it is called with the URL and the values of every
+    change as it is added, ex. to keep an in-memory copy of the feeds up to date.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        listener: Optional[Callable[[str, dict], None]] = None,
+        max_delay: float = 10.0,
+        max_size: int = 1024**2 * 10,
+    ) -> None:
+        self.batch_size = batch_size
+        self.listener = listener
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._oldest = 0.0  # when the oldest pending change was added
+        self._size = 0  # characters of the pending messages
+        self._values: dict[str, dict] = {}
+        self._messages: list[dict] = []
+        self._lock = Lock()
+
+    def add(self, url: str, messages: Iterable[dict] = (), **values) -> None:
+        if values and self.listener:
+            self.listener(url, values)
+        now = time.monotonic()
+        with self._lock:
+            if not self._values and not self._messages:
+                self._oldest = now
+            if values:
+                self._values.setdefault(url, {}).update(values)
+            for message in messages:
+                self._messages.append(message)
+                self._size += len(message.get("html") or message.get("text") or "")
+            full = len(self._values) >= self.batch_size
+            full = full or now - self._oldest >= self.max_delay
+            full = full or self._size >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            values, self._values = self._values, {}
+            messages, self._messages = self._messages, []
+            self._size = 0
+        groups: dict[tuple, list] = {}
+        for url, row in values.items():
+            groups.setdefault(tuple(sorted(row)), []).append({"url_": url, **row})
+        if not groups and not messages:
+            return
+        table = Feed.__table__
+        with session_scope() as session:
+            for keys, rows in groups.items():
+                stmt = update(table).where(table.c.url == bindparam("url_"))
+                stmt = stmt.values({key: bindparam(key) for key in keys})
+                session.execute(stmt, rows)
+            if messages:
+                session.execute(insert(Outbox.__table__), messages)
+
+
+def move_feed(session: Session, old_url: str, new_url: str) -> bool:
+    """Move a feed and its subscriptions to a new URL, merging them into the feed
+    already stored with that URL, if any, whose state is kept. The subscriptions
+    remember the old URL as the requested one, if they didn't have one.
+
+    Return True if the feed was moved, False if it was merged.
+    """
+    table = Feed.__table__
+    row = session.execute(select(table).where(table.c.url == old_url)).mappings()
+    values = row.first()
+    if values is None:
+        return False
+    moved = session.get(Feed, new_url) is None
+    if moved:
+        session.execute(insert(table).values({**values, "url": new_url}))
+    fchats = Fchat.__table__
+    stmt = select(fchats.c.accid, fchats.c.gid).where(fchats.c.feed_url == new_url)
+    subscribed = set(session.execute(stmt).all())
+    stmt = select(fchats.c.accid, fchats.c.gid).where(fchats.c.feed_url == old_url)
+    for accid, gid in session.execute(stmt).all():
+        where = (Fchat.accid == accid, Fchat.gid == gid, Fchat.feed_url == old_url)
+        if (accid, gid) in subscribed:  # the chat was subscribed to both
+            session.execute(delete(Fchat).where(*where))
+        else:
+            session.execute(
+                update(Fchat)
+                .where(*where)
+                .values(
+                    feed_url=new_url,
+                    requested_url=func.coalesce(Fchat.requested_url, old_url),
+                )
+            )
+    session.execute(delete(table).where(table.c.url == old_url))
+    return moved
 
 
 @contextmanager
-def session_scope() -> Generator[Session, None, None]:
-    """Provide a transactional scope around a series of operations."""
-    with _lock:
+def session_scope(readonly: bool = False) -> Generator[Session, None, None]:
+    """Provide a transactional scope around a series of operations.
+
+    Writes are serialized, read-only sessions don't wait for them.
+    """
+    start = time.perf_counter()
+    with nullcontext() if readonly else _lock:
+        if not readonly:
+            DB_LOCK_SECONDS.observe(time.perf_counter() - start)
         session: Session = _Session()
         try:
             yield session
@@ -47,10 +225,58 @@ def session_scope() -> Generator[Session, None, None]:
             raise
         finally:
             session.close()
+            DB_SECONDS.observe(time.perf_counter() - start)
 
 
-def init(path: str, debug: bool = False) -> None:
-    """Initialize engine."""
-    engine = create_engine(path, echo=debug)
-    Base.metadata.create_all(engine)
+def init(
+    path: str,
+    debug: bool = False,
+    pool_size: int = 5,
+    migrate: Optional[Callable[[], None]] = None,
+) -> None:
+    """Initialize engine.
+
+    If the database is older than SCHEMA_VERSION, the tables are created or
+    upgraded and then `migrate` is called to migrate the stored data.
+    """
+    engine = create_engine(path, echo=debug, pool_size=pool_size)
+    sqlite = engine.dialect.name == "sqlite"
+    version = 0
+    if sqlite:
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+        with engine.connect() as conn:
+            version = conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
     _Session.configure(bind=engine)
+    if version >= SCHEMA_VERSION:
+        return
+    Base.metadata.create_all(engine)
+    _upgrade(engine)
+    if migrate:
+        migrate()
+    if sqlite:  # stored last, so an interrupted upgrade is retried
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def _set_sqlite_pragmas(dbapi_conn, _record) -> None:
+    """Use the write-ahead log so reads don't block on writes and the other way around."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+def _upgrade(engine: Engine) -> None:
+    """Add the columns and indexes missing in tables created by older versions."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            columns = {col["name"] for col in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in columns:
+                    coltype = col.type.compile(dialect=engine.dialect)
+                    stmt = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {coltype}"
+                    conn.execute(text(stmt))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -0,0 +1,200 @@
+"""In-memory index of the feeds and their subscriptions, for the worker"""
+
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterable, Mapping, NamedTuple, Optional
+
+from sqlalchemy import Select, select
+
+from .orm import Fchat, Feed, session_scope
+
+# the columns kept in memory, the seen keys are loaded only while checking a feed
+_COLUMNS = (
+    "url",
+    "body_hash",
+    "etag",
+    "modified",
+    "latest",
+    "errors",
+    "interval",
+    "next_check",
+    "last_check",
+    "ttl",
+)
+
+
+@dataclass(slots=True)
+class FeedRecord:
+    """The state of a feed, with the same attributes as the Feed model."""
+
+    url: str
+    body_hash: Optional[str] = None
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+    latest: Optional[str] = None
+    errors: int = 0
+    interval: Optional[int] = None
+    next_check: Optional[float] = None
+    last_check: Optional[float] = None
+    ttl: Optional[int] = None
+    seen: Optional[str] = None
+
+    @classmethod
+    def from_row(cls, row: Mapping) -> "FeedRecord":
+        """Get the record of a feed from a mapping with the columns kept in memory."""
+        values = {column: row[column] for column in _COLUMNS}
+        values["errors"] = values["errors"] or 0
+        return cls(**values)
+
+
+class ChatRecord(NamedTuple):
+    """A chat subscribed to a feed, with the same attributes as the Fchat model."""
+
+    accid: int
+    gid: int
+    filter: str
+
+
+class FeedRegistry:
+    """Keep the feeds and the chats subscribed to each feed in memory, so the
+    worker doesn't need to query them from the database on every check.
+
+    The registry is loaded once and then kept up to date by the commands and
+    the worker as they change the database.
+    """
+
+    def __init__(self) -> None:
+        self._feeds: dict[str, FeedRecord] = {}
+        self._chats: dict[str, list[ChatRecord]] = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._feeds)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._feeds.values()))
+
+    def load(self, urls: Optional[Iterable[str]] = None) -> None:
+        """Load all the feeds from the database, or only the given ones."""
+        if urls is not None:
+            urls = list(urls)
+        feed_cols = [getattr(Feed, column) for column in _COLUMNS]
+        chat_cols = (Fchat.feed_url, Fchat.accid, Fchat.gid, Fchat.filter)
+        feeds: dict[str, FeedRecord] = {}
+        chats: dict[str, list[ChatRecord]] = {}
+        with session_scope(readonly=True) as session:
+            for batch in _batches(urls):
+                stmt: Select = select(*feed_cols)
+                if batch is not None:
+                    stmt = stmt.where(Feed.url.in_(batch))
+                for row in session.execute(stmt).mappings():
+                    feeds[row["url"]] = FeedRecord.from_row(row)
+                stmt = select(*chat_cols)
+                if batch is not None:
+                    stmt = stmt.where(Fchat.feed_url.in_(batch))
+                for url, accid, gid, filter_ in session.execute(stmt):
+                    record = ChatRecord(accid, gid, filter_ or "")
+                    chats.setdefault(url, []).append(record)
+        with self._lock:
+            if urls is None:
+                self._feeds, self._chats = feeds, chats
+                return
+            for url in urls:
+                self._feeds.pop(url, None)
+                self._chats.pop(url, None)
+            self._feeds.update(feeds)
+            self._chats.update((u, c) for u, c in chats.items() if u in feeds)
+
+    def load_chats(self) -> None:
+        """Reload the subscriptions of the feeds in the registry, ex. changed by
+        commands in another process.
+        """
+        chats = self._select_chats()
+        with self._lock:
+            self._chats = {url: val for url, val in chats.items() if url in self._feeds}
+
+    def load_feed_chats(self, url: str) -> list[ChatRecord]:
+        """Reload the subscriptions of the given feed and return them."""
+        chats = self._select_chats(url).get(url, [])
+        with self._lock:
+            if chats and url in self._feeds:
+                self._chats[url] = chats
+            else:
+                self._chats.pop(url, None)
+        return list(chats)
+
+    def _select_chats(self, url: Optional[str] = None) -> dict[str, list[ChatRecord]]:
+        chats: dict[str, list[ChatRecord]] = {}
+        stmt: Select = select(Fchat.feed_url, Fchat.accid, Fchat.gid, Fchat.filter)
+        if url:
+            stmt = stmt.where(Fchat.feed_url == url)
+        with session_scope(readonly=True) as session:
+            for feed_url, accid, gid, filter_ in session.execute(stmt):
+                record = ChatRecord(accid, gid, filter_ or "")
+                chats.setdefault(feed_url, []).append(record)
+        return chats
+
+    def load_seen(self, feeds: list[FeedRecord]) -> None:
+        """Load the seen keys of the feeds about to be checked."""
+        records = {feed.url: feed for feed in feeds}
+        with session_scope(readonly=True) as session:
+            for batch in _batches(list(records)):
+                stmt: Select = select(Feed.url, Feed.seen).where(Feed.url.in_(batch))
+                for url, seen in session.execute(stmt):
+                    records[url].seen = seen
+
+    def get(self, url: str) -> Optional[FeedRecord]:
+        with self._lock:
+            return self._feeds.get(url)
+
+    def chats(self, url: str) -> list[ChatRecord]:
+        with self._lock:
+            return list(self._chats.get(url, ()))
+
+    def add(self, feed) -> None:
+        """Add a feed, ex. a Feed just subscribed to."""
+        record = FeedRecord.from_row({c: getattr(feed, c) for c in _COLUMNS})
+        with self._lock:
+            self._feeds[feed.url] = record
+
+    def update(self, url: str, values: dict) -> None:
+        """Apply the changes of the feed's state, see orm.FeedUpdates."""
+        with self._lock:
+            feed = self._feeds.get(url)
+            if feed:
+                for key, value in values.items():
+                    setattr(feed, key, value)
+
+    def remove(self, url: str) -> None:
+        with self._lock:
+            self._feeds.pop(url, None)
+            self._chats.pop(url, None)
+
+    def subscribe(self, accid: int, gid: int, url: str, filter_: str) -> None:
+        with self._lock:
+            self._chats.setdefault(url, []).append(ChatRecord(accid, gid, filter_))
+
+    def unsubscribe(self, accid: int, gid: int, url: Optional[str] = None) -> None:
+        """Remove the chat's subscription to the feed, or to all the feeds."""
+        with self._lock:
+            for feed_url in [url] if url else list(self._chats):
+                chats = [
+                    chat
+                    for chat in self._chats.get(feed_url, ())
+                    if (chat.accid, chat.gid) != (accid, gid)
+                ]
+                if chats:
+                    self._chats[feed_url] = chats
+                else:
+                    self._chats.pop(feed_url, None)
+
+
+def _batches(urls: Optional[Iterable[str]], size: int = 500) -> Iterable:
+    """Split the URLs in batches small enough for an IN clause, None means all."""
+    if urls is None:
+        yield None
+        return
+    urls = list(urls)
+    for i in range(0, len(urls), size):
+        yield urls[i : i + size]
@@ -0,0 +1,157 @@
+"""Capture the downloaded feeds and replay them offline, ex. to profile them"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .util import (
+    FeedResponse,
+    format_entries,
+    get_new_entries,
+    parse_response,
+    render_entries,
+    update_seen_entries,
+)
+
+STAGES = ("parse", "select", "render", "format")
+
+
+def load_responses(path: Path) -> list:
+    """Load the responses saved by util.capture_response() in the given directory
+    or file. Other files are loaded as the body of a feed, ex. a feed saved
+    with a browser.
+    """
+    paths = (
+        sorted(p for p in path.iterdir() if p.is_file()) if path.is_dir() else [path]
+    )
+    responses = []
+    for path_ in paths:
+        text = path_.read_text(encoding="utf-8", errors="replace")
+        if path_.suffix == ".json":
+            try:
+                responses.append(FeedResponse(**json.loads(text)))
+                continue
+            except (ValueError, TypeError):
+                pass  # not a captured response
+        uri = path_.absolute().as_uri()
+        responses.append(FeedResponse(uri, 200, {}, text, None, None))
+    return responses
+
+
+def replay_response(
+    resp: FeedResponse, filters: Iterable[str], since: Optional[tuple] = None
+) -> tuple:
+    """Process a downloaded feed like the worker does, return the seconds
+    spent in each stage, the number of new entries, and the size of the HTML
+    rendered for each filter.
+
+    The entries published after `since` are new, or all of them if not given.
+    """
+    timings = {}
+    start = time.perf_counter()
+    d = parse_response(resp)
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = get_new_entries(d.entries, since) if since else d.entries
+    update_seen_entries(None, d.entries)
+    timings["select"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rendered = render_entries(entries[:100])
+    timings["render"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sizes = {filter_: len(format_entries(rendered, filter_)) for filter_ in filters}
+    timings["format"] = time.perf_counter() - start
+    return timings, len(entries), sizes
+
+
+@dataclass
+class ProfileOptions:
+    """How to replay the feeds in profile_responses().
+
+    The entries published after `since` are new, or all of them if not given.
+    The fastest time of each stage over `repeat` runs is reported, and the
+    `top` functions by cumulative time. `fetch_seconds` is the download time
+    of each feed URL, if they were downloaded.
+    """
+
+    filters: list = field(default_factory=lambda: [""])
+    since: Optional[tuple] = None
+    repeat: int = 1
+    top: int = 20
+    fetch_seconds: dict = field(default_factory=dict)
+
+
+def profile_responses(responses: list, options: ProfileOptions) -> str:
+    """Replay the responses and get a report with the fastest time of each
+    stage, the peak memory used to process each feed, and the slowest functions.
+    """
+    stages = (("fetch",) if options.fetch_seconds else ()) + STAGES
+    header = f"{'feed':<40} {'size':>9} {'new':>5}"
+    header += "".join(f" {stage:>9}" for stage in stages)
+    header += f" {'peak mem':>9} {'HTML':>9}"
+    lines = [header]
+    totals = dict.fromkeys(stages, 0.0)
+    for resp in responses:
+        best, line = _profile_response(resp, options, stages)
+        for stage in stages:
+            totals[stage] += best[stage]
+        lines.append(line)
+    if len(responses) > 1:
+        line = f"{'total':<40} {'':>9} {'':>5}"
+        line += "".join(f" {totals[stage] * 1000:>7.1f}ms" for stage in stages)
+        lines.append(line)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for resp in responses:
+        replay_response(resp, options.filters, options.since)
+    profiler.disable()
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(options.top)
+    lines.extend(["", stream.getvalue().strip()])
+    return "\n".join(lines)
+
+
+def _profile_response(
+    resp: FeedResponse, options: ProfileOptions, stages: tuple
+) -> tuple:
+    """Get the fastest time of each stage and the report line of a feed."""
+    best: dict = {}
+    for _ in range(max(options.repeat, 1)):
+        timings, new, sizes = replay_response(resp, options.filters, options.since)
+        for stage, seconds in timings.items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+    if options.fetch_seconds:
+        best["fetch"] = options.fetch_seconds.get(resp.url, 0.0)
+    tracemalloc.start()
+    try:
+        replay_response(resp, options.filters, options.since)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    line = f"{_shorten(resp.url, 40):<40} {_format_size(len(resp.text)):>9} {new:>5}"
+    line += "".join(f" {best[stage] * 1000:>7.1f}ms" for stage in stages)
+    line += f" {_format_size(peak):>9} {_format_size(max(sizes.values())):>9}"
+    return best, line
+
+
+def _shorten(text: str, width: int) -> str:
+    return text if len(text) <= width else "…" + text[-width + 1 :]
+
+
+def _format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size}B"
+    if size < 1024**2:
+        return f"{size / 1024:.1f}KB"
+    return f"{size / 1024**2:.1f}MB"
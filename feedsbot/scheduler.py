@@ -0,0 +1,193 @@
+"""Per-feed adaptive polling scheduler"""
+
+import heapq
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from threading import Condition
+from typing import Iterable, Mapping, Optional
+
+# how long (in seconds) to wait for more feeds to become due before starting a check
+BATCH_WINDOW = 30.0
+_UPDATE_PERIODS = {
+    "hourly": 60 * 60,
+    "daily": 60 * 60 * 24,
+    "weekly": 60 * 60 * 24 * 7,
+    "monthly": 60 * 60 * 24 * 30,
+    "yearly": 60 * 60 * 24 * 365,
+}
+
+
+class Scheduler:
+    """Priority queue of feed URLs sorted by the time they are due to be checked.
+
+    The polling interval of each feed adapts to how often the feed has new entries,
+    it is bounded by min_interval and max_interval.
+    """
+
+    def __init__(self, min_interval: int, max_interval: int) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._heap: list[tuple[float, str]] = []
+        self._due: dict[str, float] = {}
+        self._cond = Condition()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._due)
+
+    def schedule(self, url: str, due: float) -> None:
+        """Schedule the feed to be checked at the given UNIX timestamp.
+
+        If the feed was already scheduled, the old due time is replaced.
+        """
+        with self._cond:
+            self._due[url] = due
+            heapq.heappush(self._heap, (due, url))
+            if self._heap[0][1] == url:
+                self._cond.notify()
+
+    def schedule_many(self, feeds: Iterable[tuple[str, float]]) -> None:
+        """Schedule many (url, due) feeds at once, ex. all the feeds at startup."""
+        with self._cond:
+            for url, due in feeds:
+                self._due[url] = due
+                self._heap.append((due, url))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def unschedule(self, url: str) -> None:
+        with self._cond:
+            self._due.pop(url, None)
+
+    def next_due(self) -> Optional[float]:
+        """Get the due time of the first feed in the queue."""
+        with self._cond:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, window: float = 0) -> list:
+        """Block until some feed is due, then remove from the queue and return
+        the URLs of all the feeds that will be due in the next `window` seconds,
+        sorted by due time.
+        """
+        with self._cond:
+            while True:
+                self._discard_stale()
+                delay = self._heap[0][0] - time.time() if self._heap else None
+                if delay is not None and delay <= 0:
+                    break
+                self._cond.wait(delay)
+
+            limit = time.time() + window
+            urls = []
+            while self._heap and self._heap[0][0] <= limit:
+                due, url = heapq.heappop(self._heap)
+                if self._due.get(url) == due:
+                    del self._due[url]
+                    urls.append(url)
+            return urls
+
+    def _discard_stale(self) -> None:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def get_next_check(
+        self,
+        interval: Optional[int],
+        has_new_entries: bool,
+        headers: Mapping[str, str],
+        ttl: float = 0,
+    ) -> tuple:
+        """Get the new polling interval of a successfully checked feed and the
+        UNIX timestamp when it should be checked again.
+
+        The interval is halved when the feed had new entries and increased
+        otherwise (ex. 304 Not Modified responses). The server caching headers
+        and the update period announced by the feed, `ttl` seconds (see
+        get_feed_ttl()), are honored as lower bounds.
+        """
+        interval = interval or self.min_interval
+        if has_new_entries:
+            interval //= 2
+        else:
+            interval = int(interval * 1.5)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+
+        now = time.time()
+        hint = max(get_cache_delay(headers, now), ttl)
+        delay = min(max(interval, hint), self.max_interval)
+        return interval, now + _jitter(delay)
+
+    def get_error_check(self, errors: int, headers: Mapping[str, str]) -> float:
+        """Get the UNIX timestamp when a failing feed should be checked again.
+
+        The delay grows exponentially with the number of consecutive errors,
+        a Retry-After header sent by the server is honored.
+        """
+        now = time.time()
+        delay = self.min_interval * 2 ** min(errors, 16)
+        delay = min(max(delay, get_retry_delay(headers, now)), self.max_interval)
+        return now + _jitter(delay)
+
+    def get_throttled_check(self, delay: float) -> float:
+        """Get the UNIX timestamp when a feed should be checked again after its
+        server asked to wait `delay` seconds, the feed's errors don't increase.
+        """
+        delay = min(max(delay, self.min_interval), self.max_interval)
+        return time.time() + _jitter(delay)
+
+
+def _jitter(delay: float) -> float:
+    """Randomize the delay a bit so feeds checked together drift apart."""
+    return delay * random.uniform(0.9, 1.1)
+
+
+def _parse_http_date(value: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def get_cache_delay(headers: Mapping[str, str], now: float) -> float:
+    """Get for how many seconds the response is fresh according to the
+    Cache-Control, Expires and Retry-After headers.
+    """
+    delay = get_retry_delay(headers, now)
+    cache_control = headers.get("cache-control") or ""
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return delay
+    match = re.search(r"(?:^|[\s,])(?:s-)?max-age\s*=\s*\"?(\d+)", cache_control)
+    if match:
+        age = (headers.get("age") or "").strip()
+        return max(delay, int(match.group(1)) - (int(age) if age.isdigit() else 0))
+    expires = _parse_http_date(headers.get("expires") or "")
+    if expires is not None:
+        date = _parse_http_date(headers.get("date") or "") or now
+        delay = max(delay, expires - date)
+    return delay
+
+
+def get_retry_delay(headers: Mapping[str, str], now: float) -> float:
+    """Get how many seconds the server asked to wait with the Retry-After header."""
+    retry_after = (headers.get("retry-after") or "").strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    date = _parse_http_date(retry_after) if retry_after else None
+    return max(date - now, 0) if date is not None else 0
+
+
+def get_feed_ttl(feed_info: Mapping) -> float:
+    """Get the update period in seconds announced by the feed with the RSS <ttl>
+    or sy:updatePeriod/sy:updateFrequency elements.
+    """
+    ttl = str(feed_info.get("ttl") or "").strip()
+    if ttl.isdigit():
+        return int(ttl) * 60
+    period = _UPDATE_PERIODS.get(str(feed_info.get("sy_updateperiod") or "").strip())
+    if period:
+        frequency = str(feed_info.get("sy_updatefrequency") or "").strip()
+        return period / max(int(frequency), 1) if frequency.isdigit() else period
+    return 0
@@ -0,0 +1,155 @@
+"""Split the feeds among several worker processes sharing the database"""
+
+import hashlib
+import os
+import random
+import socket
+import time
+import uuid
+import zlib
+from threading import Lock, Thread
+from typing import Callable, Optional
+
+from sqlalchemy import Select, delete, select
+
+from .orm import Feed, Worker, session_scope
+from .registry import FeedRegistry
+from .scheduler import Scheduler
+
+# the feeds are split in this many partitions, the unit of work moved between workers
+PARTITIONS = 256
+# seconds between the heartbeats of a worker
+HEARTBEAT_INTERVAL = 15.0
+# seconds without heartbeats after which a worker is considered dead
+LEASE_TTL = 60.0
+
+
+def get_partition(url: str) -> int:
+    """Get the partition of a feed, the same in every process."""
+    return zlib.crc32(url.encode()) % PARTITIONS
+
+
+class Shard:
+    """Own a share of the feed partitions while the worker is alive.
+
+    Every worker renews its lease in the workers table each HEARTBEAT_INTERVAL
+    seconds and each partition is assigned to one of the live workers with
+    rendezvous hashing, so when a worker joins or dies only its partitions move.
+    A new worker takes its partitions two intervals after joining, when the others
+    gave them up, and a worker checks that it still owns a feed before and after
+    downloading it, so two workers never check the same feed at the same time, as
+    long as their clocks agree.
+    """
+
+    def __init__(self, logger, worker_id: str = "") -> None:
+        self.logger = logger
+        self.worker_id = (
+            worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        )
+        self.started = time.time()
+        self._partitions: frozenset = frozenset()
+        self._known: set[str] = set()  # the owned feeds, as seen in the last sync
+        self._lock = Lock()
+
+    def owns(self, url: str) -> bool:
+        with self._lock:
+            return get_partition(url) in self._partitions
+
+    def start(
+        self, scheduler: Scheduler, registry: Optional[FeedRegistry] = None
+    ) -> None:
+        """Join the workers and keep the scheduler, and the registry if given,
+        in sync with the owned feeds.
+        """
+        self.sync(scheduler, registry)
+        Thread(target=self._run, args=(scheduler, registry), daemon=True).start()
+
+    def stop(self) -> None:
+        """Leave the workers, the partitions are taken by the others at once."""
+        with session_scope() as session:
+            session.execute(delete(Worker).where(Worker.id == self.worker_id))
+
+    def _run(self, scheduler: Scheduler, registry: Optional[FeedRegistry]) -> None:
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.sync(scheduler, registry)
+            except Exception as ex:  # noqa
+                self.logger.exception(ex)
+
+    def sync(
+        self, scheduler: Scheduler, registry: Optional[FeedRegistry] = None
+    ) -> None:
+        """Renew the lease, update the owned partitions and schedule the owned
+        feeds not scheduled yet, ex. feeds added by /sub or taken from other
+        workers.
+
+        The registry gets the new feeds and, as the subscriptions are changed
+        by the bot process, all the subscriptions are reloaded.
+        """
+        partitions = self.heartbeat()
+        stmt: Select = select(Feed.url, Feed.next_check)
+        with session_scope(readonly=True) as session:
+            feeds = session.execute(stmt).all()
+        known = {}
+        for url, next_check in feeds:
+            if get_partition(url) in partitions:
+                known[url] = next_check
+        new = [url for url in known if url not in self._known]
+        if registry is not None:
+            # their state could have been changed meanwhile by another worker
+            registry.load(new)
+            for url in self._known - known.keys():
+                registry.remove(url)
+            registry.load_chats()
+        start = time.time()
+        scheduler.schedule_many(
+            (url, known[url] or start + random.uniform(0, scheduler.min_interval))
+            for url in new
+        )
+        for url in self._known - known.keys():
+            scheduler.unschedule(url)
+        self._known = set(known)
+
+    def heartbeat(self) -> frozenset:
+        """Renew the worker's lease and return the partitions it owns now."""
+        now = time.time()
+        table = Worker.__table__
+        stmt: Select = select(Worker.id, Worker.started)
+        with session_scope() as session:
+            session.execute(delete(table).where(table.c.heartbeat < now - LEASE_TTL))
+            session.merge(
+                Worker(id=self.worker_id, started=self.started, heartbeat=now)
+            )
+            workers = session.execute(stmt).all()
+
+        def assign(time_: float) -> Callable[[int], str]:
+            # workers that started recently don't own partitions yet
+            ids = [
+                wid for wid, started in workers if started + HEARTBEAT_INTERVAL <= time_
+            ]
+            return lambda part: max(ids, key=lambda wid: _weight(wid, part), default="")
+
+        # give up partitions at once but take them only if they were assigned
+        # already one interval ago, when their previous owner had given them up
+        owner_now, owner_before = assign(now), assign(now - HEARTBEAT_INTERVAL)
+        partitions = frozenset(
+            part
+            for part in range(PARTITIONS)
+            if owner_now(part) == self.worker_id
+            and owner_before(part) == self.worker_id
+        )
+        with self._lock:
+            changed = partitions != self._partitions
+            self._partitions = partitions
+        if changed:
+            self.logger.info(
+                f"[WORKER] Owning {len(partitions)} of {PARTITIONS} feed partitions,"
+                f" {len(workers)} workers alive"
+            )
+        return partitions
+
+
+def _weight(worker_id: str, partition: int) -> int:
+    digest = hashlib.blake2b(f"{worker_id}:{partition}".encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big")
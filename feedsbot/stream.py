@@ -0,0 +1,154 @@
+"""Incremental scanning of feeds while they are downloaded"""
+
+import hashlib
+from typing import Optional, Union
+from xml.parsers import expat
+
+# how many old entries in a row end the scan, so a pinned entry doesn't stop it
+STOP_AFTER = 3
+_ENTRY_TAGS = ("item", "entry")
+_DATE_TAGS = ("pubDate", "published", "updated", "date", "modified", "issued")
+
+
+class EntryScanner:
+    """Find where the old entries start in a feed being downloaded.
+
+    Most feeds list the newest entries first, so once STOP_AFTER entries in a row
+    are old, the rest of the feed doesn't need to be downloaded nor parsed.
+    Entries are old if their key is in `seen` or, for feeds without seen keys,
+    if they are not newer than the `latest` date. Entries without GUID nor link
+    are never old.
+
+    The scan stops early only if the feed is known to be newest first: a new
+    entry came before the old ones or the dates of the entries so far decrease.
+    If an entry is newer than the previous one the feed may be oldest first,
+    with the new entries at the end, so the scan is abandoned.
+
+    If the feed can't be parsed as it arrives, ex. it uses an encoding expat
+    doesn't support, the scan is abandoned and the whole feed is needed.
+    """
+
+    def __init__(self, seen: Optional[str], latest: Optional[str]) -> None:
+        self.cut: Optional[int] = None  # byte offset where the old entries start
+        self.failed = False
+        self._seen = set(seen.split()) if seen else None
+        self._latest = tuple(map(int, latest.split())) if latest else None
+        self._stack: list[str] = []  # the open elements
+        self._closing = b""  # the end tags needed after the cut
+        self._entry: Optional[dict] = None  # fields of the entry being scanned
+        self._entry_level = 0  # how many elements contain the entry
+        self._field: Optional[str] = None
+        self._text: list[str] = []
+        self._old_start = 0  # where the current run of old entries started
+        self._old_run = 0
+        self._new_found = False  # a new entry came before the current old ones
+        self._newest_first = False  # the dates of the entries so far decrease
+        self._last_date: Optional[tuple] = None
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    @property
+    def done(self) -> bool:
+        return self.cut is not None
+
+    def feed(self, chunk: bytes) -> None:
+        if self.done or self.failed:
+            return
+        if not self._stack and chunk[:2] in (b"\xff\xfe", b"\xfe\xff"):
+            self.failed = True  # UTF-16, the end tags couldn't be appended
+            return
+        try:
+            self._parser.Parse(bytes(chunk), False)
+        except expat.ExpatError:
+            self.failed = True
+
+    def truncate(self, content: Union[bytes, bytearray]) -> Union[bytes, bytearray]:
+        """Cut the downloaded content before the old entries, closing the open
+        elements so it is still a valid feed.
+        """
+        if self.cut is None:
+            return content
+        return bytes(content[: self.cut]) + self._closing
+
+    def _start(self, name: str, attrs: dict) -> None:
+        tag = name.rsplit(":", 1)[-1]
+        if self._entry is None:
+            if tag in _ENTRY_TAGS and not self.done:
+                self._entry = {"start": self._parser.CurrentByteIndex}
+                self._entry_level = len(self._stack)
+                self._closing = b"".join(
+                    f"</{parent}>".encode() for parent in reversed(self._stack)
+                )
+        elif len(self._stack) == self._entry_level + 1:
+            if tag == "link" and attrs.get("href"):  # Atom
+                if attrs.get("rel", "alternate") == "alternate":
+                    self._entry.setdefault("link", attrs["href"].strip())
+            elif tag in ("guid", "id", "link") or tag in _DATE_TAGS:
+                self._field = tag
+                self._text = []
+        self._stack.append(name)
+
+    def _end(self, _name: str) -> None:
+        self._stack.pop()
+        if self._entry is None:
+            return
+        depth = len(self._stack)
+        if self._field and depth == self._entry_level + 1:
+            text = "".join(self._text).strip()
+            field = "id" if self._field == "guid" else self._field
+            if text:
+                self._entry.setdefault(field, text)
+            self._field = None
+        elif depth == self._entry_level:
+            entry, self._entry = self._entry, None
+            self._check_entry(entry)
+
+    def _data(self, data: str) -> None:
+        if self._field:
+            self._text.append(data)
+
+    def _check_entry(self, entry: dict) -> None:
+        date = self._get_date(entry)
+        if date is not None:
+            if self._last_date is not None:
+                if date > self._last_date:
+                    self.failed = True  # maybe oldest first, the whole feed is needed
+                    return
+                self._newest_first = True
+            self._last_date = date
+        if not self._is_old(entry, date):
+            self._new_found = True
+            self._old_run = 0
+            return
+        if not self._old_run:
+            self._old_start = entry["start"]
+        self._old_run += 1
+        if self._old_run >= STOP_AFTER and (self._new_found or self._newest_first):
+            self.cut = self._old_start
+
+    def _is_old(self, entry: dict, date: Optional[tuple]) -> bool:
+        if self._seen is not None:
+            key = entry.get("id") or entry.get("link")
+            return key is not None and hash_key(key) in self._seen
+        if self._latest:
+            return date is not None and date <= self._latest
+        return False
+
+    @staticmethod
+    def _get_date(entry: dict) -> Optional[tuple]:
+        # feedparser is imported when first needed, it is slow to import
+        from feedparser.datetimes import _parse_date  # pylint: disable=C0415
+
+        for tag in _DATE_TAGS:
+            if entry.get(tag):
+                date = _parse_date(entry[tag])
+                return tuple(date) if date is not None else None
+        return None
+
+
+def hash_key(key: str) -> str:
+    """Get the short hash of an entry's GUID or link stored in the seen keys."""
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
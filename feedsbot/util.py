@@ -1,35 +1,305 @@
 """Utilities"""
 
-import datetime
 import functools
+import hashlib
+import json
 import mimetypes
+import os
+import random
 import re
 import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from html.parser import HTMLParser
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Optional
-
-import bs4
-import feedparser
-import requests
-from deltachat2 import Bot, JsonRpcError, MsgData
-from feedparser.datetimes import _parse_date
-from feedparser.exceptions import CharacterEncodingOverride
-from sqlalchemy import delete, select, update
-
-from .orm import Fchat, Feed, session_scope
-
-www = requests.Session()
-www.headers.update(
-    {
-        "user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0"
-    }
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Iterable, Mapping, Optional, Sequence, Union
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from deltachat2 import Bot, JsonRpcError
+from sqlalchemy import Select, delete, select
+
+from .cache import FetchCache
+from .delivery import DeliveryQueue
+from .filters import get_matcher, quote_filter
+from .hosts import HostLimiter, Throttled, get_error_headers, interleave_hosts
+from .images import ImageCache
+from .memory import MemoryBudget, get_sweep_report, start_sweep
+from .metrics import (
+    DOWNLOADED_BYTES,
+    FETCH_SECONDS,
+    MOVED_FEEDS,
+    PARSE_SECONDS,
+    REMOVED_FEEDS,
+    RENDER_SECONDS,
+    RESPONSES,
+    SWEEP_SECONDS,
+    TASKS,
+    TRUNCATED_FEEDS,
+    UNCHANGED_FEEDS,
+    format_summary,
+)
+from .orm import (
+    FILTER_SYNTAX,
+    Fchat,
+    Feed,
+    FeedUpdates,
+    Outbox,
+    move_feed,
+    session_scope,
+)
+from .registry import ChatRecord, FeedRecord, FeedRegistry
+from .scheduler import BATCH_WINDOW, Scheduler, get_feed_ttl
+from .shard import Shard
+from .stream import EntryScanner, hash_key
+
+if TYPE_CHECKING:
+    import feedparser
+    import requests
+
+    from .aio import AsyncFetcher
+
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0"
 )
-www.request = functools.partial(www.request, timeout=15)  # type: ignore
+MAX_FEED_SIZE = 1024**2 * 10  # 10MB
+_FEED_KEYS = ("title", "ttl", "sy_updateperiod", "sy_updatefrequency")
+_FEED_TYPES = (
+    "application/rss+xml",
+    "application/atom+xml",
+    "application/rdf+xml",
+    "application/xml",
+    "text/xml",
+)
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid", "igshid")
+# how many entry keys to remember per feed, the entries still in the feed are never evicted
+SEEN_ENTRIES_LIMIT = 500
+
+
+@dataclass
+class FeedResponse:
+    """The downloaded body of a feed and the metadata needed to process it."""
+
+    url: str
+    status: int
+    headers: dict
+    text: str
+    etag: Optional[str]
+    modified: Optional[str]
+    truncated: bool = False  # the old entries at the end were not downloaded
+    redirect: Optional[str] = None  # the new URL if the feed moved permanently
+
+
+@dataclass
+class ParsedFeed:
+    """The compact result of parsing a feed and rendering its new entries."""
+
+    feed: dict  # feed title and update period metadata
+    status: int
+    headers: dict
+    etag: Optional[str]
+    modified: Optional[str]
+    latest: Optional[str]
+    seen: str
+    new_entries: int
+    html: dict  # the rendered entries for each filter
+    entries: dict  # the number of rendered entries for each filter
+    timings: dict  # seconds spent parsing and rendering, for the metrics
+
+
+@dataclass(frozen=True)
+class RenderLimits:
+    """The limits of the new entries of a feed sent in a message, see
+    memory.MemoryBudget.
+    """
+
+    max_entries: int = 100
+    max_html_size: int = 0
+
+
+class TaskQueue:
+    """Run the slow work of the commands, ex. downloading feeds, in background
+    threads so the bot keeps answering other commands meanwhile.
+
+    At most `workers` tasks run at once and at most `max_pending` can be queued
+    or running, submit() rejects new tasks when the queue is full.
+    """
+
+    def __init__(self, bot: Bot, workers: int, max_pending: int) -> None:
+        self.bot = bot
+        self.max_pending = max_pending
+        self._pending = 0
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max(workers, 1), "command")
+
+    def submit(self, func: Callable, *args) -> bool:
+        """Queue func(*args), return False if there are too many pending tasks."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+        TASKS.inc()
+        self._executor.submit(self._run, func, *args)
+        return True
+
+    def _run(self, func: Callable, *args) -> None:
+        try:
+            func(*args)
+        except Exception as ex:  # noqa
+            self.bot.logger.exception(ex)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            TASKS.dec()
+
 
+@dataclass
+class CheckContext:
+    """The state and the engines shared by the checks of the feeds.
 
-def check_feeds(bot: Bot, interval: int, pool_size: int, app_dir: Path) -> None:
+    The feeds are taken from the registry, it must be loaded beforehand unless
+    a shard is given, then only the feeds of the partitions it owns are loaded
+    and checked, and the feeds it gives up to other workers during a check are
+    skipped, also if they were being downloaded, the new owner checks them.
+
+    If a cache is given, feeds downloaded recently, ex. by /sub, are not
+    downloaded again and the complete downloads are cached for the commands.
+    The feeds of the same host are spread out, and if a host limiter is given,
+    downloaded politely, with the async fetcher the limiter must be given to the
+    fetcher instead. The memory used by the downloaded feeds is limited by the
+    budget, with the async fetcher it must be given to the fetcher too. If a
+    parser is given, the feeds are parsed in its worker processes.
+
+    If a capture directory is given, the downloads, not the cached responses,
+    are saved there to replay them later, see replay.py.
+    """
+
+    scheduler: Scheduler
+    registry: FeedRegistry = field(default_factory=FeedRegistry)
+    budget: MemoryBudget = field(default_factory=MemoryBudget)
+    fetcher: Optional["AsyncFetcher"] = None
+    parser: Optional[Executor] = None
+    cache: Optional[FetchCache] = None
+    hosts: Optional[HostLimiter] = None
+    shard: Optional[Shard] = None
+    capture: Optional[Path] = None
+
+
+def check_feeds(
+    bot: Bot,
+    context: CheckContext,
+    pool_size: int,
+    app_dir: Path,
+    delivery: Optional[DeliveryQueue],
+) -> None:
+    """Check the feeds when they are due, forever."""
+    scheduler, shard = context.scheduler, context.shard
+    if shard:
+        shard.start(scheduler, context.registry)
+    else:
+        _load_schedule(bot, scheduler, app_dir, context.registry)
+    with ThreadPool(pool_size) as pool:
+        while True:
+            delay = (scheduler.next_due() or 0) - time.time()
+            if delay > 0:
+                bot.logger.info(f"[WORKER] Sleeping for {delay:.1f} seconds")
+            urls = scheduler.pop_due(BATCH_WINDOW)
+            if shard:  # drop the feeds given up to other workers meanwhile
+                urls = [url for url in urls if shard.owns(url)]
+            check_due_feeds(bot, context, pool, delivery, urls)
+
+
+def check_due_feeds(
+    bot: Bot,
+    context: CheckContext,
+    pool: ThreadPool,
+    delivery: Optional[DeliveryQueue],
+    urls: list,
+) -> None:
+    """Check the given feeds, popped from the scheduler, and reschedule them.
+
+    The new entries are written to the outbox, `delivery` sends them in the
+    background, or if it is None, the bot process polling the outbox.
+    """
+    start = time.time()
+    start_sweep()
+    bot.logger.info(f"[WORKER] Starting to check {len(urls)} feeds")
+    registry = context.registry
+    updates = FeedUpdates(listener=registry.update)
+    feeds = [feed for feed in map(registry.get, urls) if feed]
+    # the seen keys are the largest part of the feeds, keep them only while checking
+    registry.load_seen(feeds)
+    # so the pool isn't busy waiting for a single host while the others are idle
+    feeds = interleave_hosts(feeds, lambda f: f.url)
+    tasks = pool.imap_unordered(
+        lambda job: _check_feed_task(bot, context, updates, *job),
+        _get_jobs(context, feeds),
+    )
+    for _ in tasks:
+        pass
+    updates.flush()
+    for feed in feeds:
+        feed.seen = None
+    if delivery:
+        delivery.flush()
+    took = time.time() - start
+    SWEEP_SECONDS.observe(took)
+    bot.logger.info(
+        f"[WORKER] Done checking {len(feeds)} feeds after {took:.1f} seconds"
+    )
+    bot.logger.info(f"[WORKER] Summary: {format_summary()}")
+    report = get_sweep_report()
+    if report:
+        bot.logger.info(f"[WORKER] Memory: {report}")
+
+
+def _get_jobs(context: CheckContext, feeds: list) -> Iterable[tuple]:
+    """Get the (feed, fetch) pairs to check, downloading the feeds lazily."""
+    if context.fetcher:
+        jobs: Iterable[tuple] = context.fetcher.fetch_all(feeds)
+    else:
+        jobs = (
+            (
+                f,
+                functools.partial(
+                    fetch_feed, f.url, f.etag, f.modified, get_scanner(f)
+                ),
+            )
+            for f in feeds
+        )
+        if context.hosts:
+            hosts = context.hosts
+            jobs = (
+                (f, functools.partial(hosts.fetch, f.url, fetch)) for f, fetch in jobs
+            )
+        budget = context.budget
+        jobs = ((f, functools.partial(budget.fetch, f.url, fetch)) for f, fetch in jobs)
+    if context.capture:
+        capture = context.capture
+        jobs = (
+            (f, functools.partial(capture_response, capture, fetch))
+            for f, fetch in jobs
+        )
+    if context.cache:
+        cache = context.cache
+        jobs = ((f, functools.partial(cache.get, f.url, fetch)) for f, fetch in jobs)
+    return jobs
+
+
+def _load_schedule(
+    bot: Bot, scheduler: Scheduler, app_dir: Path, registry: FeedRegistry
+) -> None:
+    """Load the feeds' due times, the feeds that became due while the bot was
+    stopped, ex. in the middle of a check, are checked at once, the most
+    overdue first.
+
+    Feeds never scheduled before are due one polling interval after they were
+    last checked, or if they weren't checked by this version either, spread
+    over the next polling interval after the last global check done by older
+    versions.
+    """
     lastcheck_path = app_dir / "lastcheck.txt"
     lastcheck = 0.0
     if lastcheck_path.exists():
@@ -38,119 +308,394 @@ def check_feeds(bot: Bot, interval: int, pool_size: int, app_dir: Path) -> None:
                 lastcheck = float(lastcheck_file.read())
             except (ValueError, TypeError):
                 pass
-    took = max(time.time() - lastcheck, 0)
-
-    with ThreadPool(pool_size) as pool:
-        while True:
-            delay = interval - took
-            if delay > 0:
-                bot.logger.info(f"[WORKER] Sleeping for {delay:.1f} seconds")
-                time.sleep(delay)
-            bot.logger.info("[WORKER] Starting to check feeds")
-            lastcheck = time.time()
-            with lastcheck_path.open("w", encoding="utf-8") as lastcheck_file:
-                lastcheck_file.write(str(lastcheck))
-            with session_scope() as session:
-                feeds = session.execute(select(Feed)).scalars().all()
-            bot.logger.info(f"[WORKER] There are {len(feeds)} feeds to check")
-            for _ in pool.imap_unordered(lambda f: _check_feed_task(bot, f), feeds):
-                pass
-            took = time.time() - lastcheck
-            bot.logger.info(
-                f"[WORKER] Done checking {len(feeds)} feeds after {took:.1f} seconds"
-            )
+    now = time.time()
+    start = max(lastcheck, now - scheduler.min_interval)
+    feeds = []
+    for feed in registry:
+        next_check = feed.next_check
+        if next_check is None and feed.last_check:
+            next_check = feed.last_check + (feed.interval or scheduler.min_interval)
+        elif next_check is None:
+            next_check = start + random.uniform(0, scheduler.min_interval)
+        feeds.append((feed.url, next_check))
+    scheduler.schedule_many(feeds)
+    overdue = sum(next_check <= now for _, next_check in feeds)
+    if overdue:
+        bot.logger.info(f"[WORKER] Resuming {overdue} overdue feeds")
 
 
-def _check_feed_task(bot: Bot, feed: Feed):
+def _check_feed_task(
+    bot: Bot,
+    context: CheckContext,
+    updates: FeedUpdates,
+    feed: FeedRecord,
+    fetch: Callable[[], FeedResponse],
+) -> None:
+    scheduler, registry, budget = context.scheduler, context.registry, context.budget
+    if context.shard and not context.shard.owns(feed.url):
+        bot.logger.debug(f"Skipped feed given up to another worker: {feed.url}")
+        budget.release(feed.url)
+        return
     bot.logger.debug(f"Checking feed: {feed.url}")
     try:
-        _check_feed(bot, feed)
-        if feed.errors != 0:
-            with session_scope() as session:
-                stmt = update(Feed).where(Feed.url == feed.url).values(errors=0)
-                session.execute(stmt)
+        resp = _check_feed(bot, context, updates, feed, fetch)
+        if resp and resp.redirect:
+            _move_feed(bot, context, updates, feed.url, resp.redirect)
+    except Throttled as err:
+        # not the feed's fault, so it doesn't count as an error
+        bot.logger.warning(f"[WORKER] Postponing {feed.url}: {err}")
+        next_check = scheduler.get_throttled_check(err.delay)
+        updates.add(feed.url, next_check=next_check)
+        scheduler.schedule(feed.url, next_check)
     except Exception as err:
         bot.logger.exception(err)
         if feed.errors < 50:
-            with session_scope() as session:
-                stmt = update(Feed).where(Feed.url == feed.url)
-                session.execute(stmt.values(errors=feed.errors + 1))
+            headers = get_error_headers(err)
+            next_check = scheduler.get_error_check(feed.errors + 1, headers)
+            updates.add(feed.url, errors=feed.errors + 1, next_check=next_check)
+            scheduler.schedule(feed.url, next_check)
         else:
-            with session_scope() as session:
-                stmt = select(Fchat.accid, Fchat.gid).where(Fchat.feed_url == feed.url)
-                fchats = session.execute(stmt).all()
-                # this is needed because cascade delete doesn't work below
-                session.execute(delete(Fchat).where(Fchat.feed_url == feed.url))
-                session.execute(delete(Feed).where(Feed.url == feed.url))
-            reply = MsgData(
-                text=f"❌ Due to errors, this chat was unsubscribed from feed: {feed.url}"
-            )
-            for accid, gid in fchats:
-                try:
-                    bot.rpc.send_msg(accid, gid, reply)
-                except JsonRpcError:
-                    pass
+            _remove_failed_feed(registry, feed.url)
+    # also if the download was discarded, ex. the feed is no longer used
+    budget.release(feed.url)
+    # ignored if the feed was removed or moved meanwhile
+    updates.add(feed.url, last_check=time.time())
     bot.logger.debug(f"Done checking feed: {feed.url}")
 
 
-def _check_feed(bot: Bot, feed: Feed) -> None:
-    d = parse_feed(feed.url, etag=feed.etag, modified=feed.modified)
+def _remove_failed_feed(registry: FeedRegistry, url: str) -> None:
+    """Unsubscribe the chats from a feed that failed too many times in a row."""
+    REMOVED_FEEDS.inc()
+    text = f"❌ Due to errors, this chat was unsubscribed from feed: {url}"
+    with session_scope() as session:
+        stmt: Select = select(Fchat.accid, Fchat.gid).where(Fchat.feed_url == url)
+        for accid, gid in session.execute(stmt).all():
+            session.add(Outbox(accid=accid, gid=gid, text=text, created=time.time()))
+        # this is needed because cascade delete doesn't work below
+        session.execute(delete(Fchat).where(Fchat.feed_url == url))
+        session.execute(delete(Feed).where(Feed.url == url))
+    registry.remove(url)
+
+
+def _check_feed(
+    bot: Bot,
+    context: CheckContext,
+    updates: FeedUpdates,
+    feed: FeedRecord,
+    fetch: Callable[[], FeedResponse],
+) -> Optional[FeedResponse]:
+    registry = context.registry
+    # the registry can be behind if the chats subscribed from another process
+    fchats = registry.chats(feed.url) or registry.load_feed_chats(feed.url)
+    if not fchats:
+        with session_scope() as session:
+            session.execute(delete(Feed).where(Feed.url == feed.url))
+        registry.remove(feed.url)
+        bot.logger.debug(f"Removed unused feed {feed.url}")
+        return None
+
+    try:
+        resp = fetch()
+    except Throttled as ex:
+        RESPONSES.inc(status=str(ex.status) if ex.status else "throttled")
+        raise
+    except Exception:
+        RESPONSES.inc(status="error")
+        raise
+    RESPONSES.inc(status=str(resp.status))
+    if context.shard and not context.shard.owns(feed.url):
+        # given up while it was downloaded, ex. waiting for its host
+        bot.logger.debug(f"Discarded feed given up to another worker: {feed.url}")
+        return None
+    if resp.truncated:
+        TRUNCATED_FEEDS.inc()
+
+    body_hash = get_body_hash(resp.text) if resp.status != 304 else feed.body_hash
+    if resp.status == 304 or body_hash == feed.body_hash:
+        # servers ignoring ETag and If-Modified-Since usually resend the same body
+        UNCHANGED_FEEDS.inc()
+        interval, next_check = context.scheduler.get_next_check(
+            feed.interval, False, resp.headers, feed.ttl or 0
+        )
+        updates.add(
+            feed.url,
+            etag=resp.etag,
+            modified=resp.modified,
+            errors=0,
+            interval=interval,
+            next_check=next_check,
+        )
+        context.scheduler.schedule(feed.url, next_check)
+        return resp
 
-    if d.entries and feed.latest:
-        d.entries = get_new_entries(d.entries, tuple(map(int, feed.latest.split())))
+    parsed = _parse_feed(context, feed, fchats, resp)
+    # kept for the checks that don't parse the feed because it didn't change
+    values: dict = {"ttl": int(get_feed_ttl(parsed.feed)) or None}
+    interval, next_check = context.scheduler.get_next_check(
+        feed.interval, bool(parsed.new_entries), parsed.headers, values["ttl"] or 0
+    )
+    if parsed.seen != feed.seen:
+        values["seen"] = parsed.seen
+    updates.add(
+        feed.url,
+        messages=_get_messages(feed, parsed, fchats) if parsed.new_entries else (),
+        etag=parsed.etag,
+        modified=parsed.modified,
+        latest=parsed.latest,
+        body_hash=body_hash,
+        errors=0,
+        interval=interval,
+        next_check=next_check,
+        **values,
+    )
+    context.scheduler.schedule(feed.url, next_check)
+    return resp
+
+
+def _parse_feed(
+    context: CheckContext, feed: FeedRecord, fchats: list, resp: FeedResponse
+) -> ParsedFeed:
+    """Parse the feed and render its new entries, in a parse worker if any."""
+    filters = {fchat.filter or "" for fchat in fchats}
+    limits = RenderLimits(context.budget.max_entries, context.budget.max_html_size)
+    args = (resp, feed.latest, feed.seen, filters, limits)
+    if context.parser:
+        parsed = context.parser.submit(_process_response_in_pool, *args).result()
+    else:
+        parsed = process_response(*args)
+    # measured where the work was done, which can be another process
+    PARSE_SECONDS.observe(parsed.timings["parse"])
+    RENDER_SECONDS.observe(parsed.timings["render"])
+    return parsed
 
+
+def _move_feed(
+    bot: Bot, context: CheckContext, updates: FeedUpdates, url: str, new_url: str
+) -> None:
+    """Store the feed with the URL it was permanently redirected to, merging it
+    into the feed already stored with that URL if any.
+    """
+    updates.flush()  # the feed's new state was added with the old URL
     with session_scope() as session:
-        stmt = select(Fchat).where(Fchat.feed_url == feed.url)
-        fchats = session.execute(stmt).scalars().all()
-        if not fchats:
-            session.delete(feed)
-            bot.logger.debug(f"Removed unused feed {feed.url}")
-            return
+        moved = move_feed(session, url, new_url)
+        stmt: Select = select(Feed.next_check).where(Feed.url == new_url)
+        next_check = session.execute(stmt).scalar()
+    MOVED_FEEDS.inc()
+    scheduler, registry = context.scheduler, context.registry
+    scheduler.unschedule(url)
+    registry.remove(url)
+    if moved:
+        registry.load([new_url])
+        scheduler.schedule(new_url, next_check or time.time())
+    else:
+        registry.load_feed_chats(new_url)
+    action = "Moved" if moved else "Merged"
+    bot.logger.info(f"[WORKER] {action} feed {url} to {new_url}")
+
 
-    if not d.entries:
+def merge_duplicate_feeds(bot: Bot) -> None:
+    """Store all the feeds with their normalized URL, merging the duplicates,
+    ex. feeds subscribed by older versions with tracking parameters.
+    """
+    stmt: Select = select(Feed.url)
+    with session_scope(readonly=True) as session:
+        urls = session.execute(stmt).scalars().all()
+    moves = [(url, normalize_url(url)) for url in urls if normalize_url(url) != url]
+    if not moves:
         return
+    with session_scope() as session:
+        merged = sum(not move_feed(session, url, new_url) for url, new_url in moves)
+    bot.logger.info(
+        f"Normalized the URLs of {len(moves)} feeds, {merged} of them were duplicates"
+    )
 
-    full_html = format_entries(d.entries[:100], "")
-    for fchat in fchats:
-        if fchat.filter:
-            html = format_entries(d.entries[:100], fchat.filter)
-            if not html:
-                continue
-        else:
-            html = full_html
-        reply = MsgData(html=html, override_sender_name=d.feed.get("title") or feed.url)
-        try:
-            bot.rpc.send_msg(fchat.accid, fchat.gid, reply)
-        except JsonRpcError:
-            with session_scope() as session:
-                stmt = delete(Fchat).where(
-                    Fchat.accid == fchat.accid, Fchat.gid == fchat.gid
-                )
-                session.execute(stmt)
-
-    latest = get_latest_date(d.entries) or feed.latest
-    modified = d.get("modified") or d.get("updated")
+
+def quote_legacy_filters(bot: Bot) -> None:
+    """Quote the filters stored before the filters had a syntax, so they keep
+    matching the entries that contain the whole filter, ex. "-rc" doesn't
+    become "exclude rc".
+    """
     with session_scope() as session:
-        stmt = update(Feed).where(Feed.url == feed.url)
-        session.execute(
-            stmt.values(etag=d.get("etag"), modified=modified, latest=latest)
-        )
+        stmt = select(Fchat).where(Fchat.filter_syntax.is_(None))
+        fchats = session.execute(stmt).scalars().all()
+        for fchat in fchats:
+            fchat.filter = quote_filter(fchat.filter or "")
+            fchat.filter_syntax = FILTER_SYNTAX
+    if fchats:
+        bot.logger.info(f"Quoted the filters of {len(fchats)} subscriptions")
 
 
-def format_entries(entries: list, filter_: str) -> str:
-    entries_text = []
-    for e in entries:
-        pub_date, title, desc = _parse_entry(e)
-        if filter_ not in title and filter_ not in desc:
-            continue
-        text = title + pub_date + desc
-        if text:
-            entries_text.append(text)
+def _get_messages(
+    feed: FeedRecord, parsed: ParsedFeed, fchats: Sequence[ChatRecord]
+) -> list:
+    """Get the outbox rows to deliver the new entries to the subscribed chats."""
+    sender = parsed.feed.get("title") or feed.url
+    messages = []
+    for fchat in fchats:
+        html = parsed.html.get(fchat.filter or "")
+        if html:
+            messages.append(
+                {
+                    "accid": fchat.accid,
+                    "gid": fchat.gid,
+                    "sender": sender,
+                    "html": html,
+                    "entries": parsed.entries[fchat.filter or ""],
+                    "created": time.time(),
+                }
+            )
+    return messages
 
-    return "<br/><hr/>".join(entries_text)
 
+def process_response(
+    resp: FeedResponse,
+    latest: Optional[str],
+    seen: Optional[str],
+    filters: Iterable[str],
+    limits: RenderLimits = RenderLimits(),
+) -> ParsedFeed:
+    """Parse the downloaded feed and render the new entries for each of the
+    given filters.
+
+    Entries are new if their key is not in `seen`, for feeds checked before
+    the keys were remembered, the entries newer than `latest` are new. At most
+    `limits.max_entries` entries are rendered, and if `limits.max_html_size` is
+    given, the entries after the first that don't fit in it are dropped.
+
+    This is the CPU-bound part of checking a feed, it can run in a worker process.
+    """
+    start = time.perf_counter()
+    d = parse_response(resp)
+    parse_end = time.perf_counter()
+    entries = _get_unseen(resp, d.entries, latest, seen)
+    new_entries = len(entries)
+    entries = entries[: limits.max_entries]
+    parsed = ParsedFeed(
+        feed={key: d.feed.get(key) for key in _FEED_KEYS},
+        status=resp.status,
+        headers=resp.headers,
+        etag=d.get("etag"),
+        modified=d.get("modified") or d.get("updated"),
+        latest=get_latest_date(d.entries, latest),
+        seen=update_seen_entries(seen, d.entries),
+        new_entries=new_entries,
+        html={},
+        entries={},
+        timings={},
+    )
+    # the parsed feed is the largest object, release it before rendering
+    del d
+    if entries:
+        rendered = render_entries(entries)
+        del entries
+        _match_filters(parsed, rendered, filters, limits.max_html_size)
+    parsed.timings["parse"] = parse_end - start
+    parsed.timings["render"] = time.perf_counter() - parse_end
+    return parsed
+
+
+def _get_unseen(
+    resp: FeedResponse, entries: list, latest: Optional[str], seen: Optional[str]
+) -> list:
+    """Get the new entries of the feed, see process_response()."""
+    if entries and seen:
+        unseen = get_unseen_entries(entries, seen)
+        if len(unseen) == len(entries) and latest and not resp.truncated:
+            # all the keys changed, ex. the feed moved, don't resend everything
+            unseen = get_new_entries(unseen, tuple(map(int, latest.split())))
+        return unseen
+    if entries and latest and seen is None:
+        return get_new_entries(entries, tuple(map(int, latest.split())))
+    return entries
+
+
+def _match_filters(
+    parsed: ParsedFeed, rendered: list, filters: Iterable[str], max_html_size: int
+) -> None:
+    """Store the HTML of the rendered entries that match each filter."""
+    matches: dict = {filter_: [] for filter_ in filters}
+    if set(matches) == {""}:  # no filters, all the entries match
+        matches[""] = rendered
+    else:
+        matcher = get_matcher(frozenset(filters))
+        for entry in rendered:
+            for filter_ in matcher.match(entry.text):
+                matches[filter_].append(entry)
+    for filter_, entries_ in matches.items():
+        entries_ = _limit_html_size(entries_, max_html_size)
+        parsed.html[filter_] = "<br/><hr/>".join(e.html for e in entries_)
+        parsed.entries[filter_] = len(entries_)
+
+
+def _limit_html_size(entries: list, max_size: int) -> list:
+    """Get the first entries whose HTML fits in max_size, at least one."""
+    if not max_size:
+        return entries
+    size = 0
+    for index, entry in enumerate(entries):
+        size += len(entry.html)
+        if index and size > max_size:
+            return entries[:index]
+    return entries
+
+
+def _process_response_in_pool(
+    resp: FeedResponse,
+    latest: Optional[str],
+    seen: Optional[str],
+    filters: Iterable[str],
+    limits: RenderLimits = RenderLimits(),
+) -> ParsedFeed:
+    try:
+        return process_response(resp, latest, seen, filters, limits)
+    except Exception as ex:
+        # some exceptions, like SAXParseException, can't be sent back to the main process
+        raise ValueError(f"{type(ex).__name__}: {ex}") from None
 
-def _parse_entry(entry) -> tuple:
+
+@dataclass
+class RenderedEntry:
+    """A feed entry rendered once, to be shared by all the chats subscribed to the feed."""
+
+    title: str  # plain text of the title
+    desc_html: str
+    html: str
+
+    @functools.cached_property
+    def desc(self) -> str:
+        """The plain text of the description, extracted the first time it is needed."""
+        return _html_to_text(self.desc_html)
+
+    @property
+    def text(self) -> str:
+        """The plain text the filters are matched against."""
+        return f"{self.title}\n{self.desc}"
+
+
+def render_entries(entries: list) -> list:
+    """Render the given feed entries, skipping the empty ones."""
+    rendered = []
+    for entry in entries:
+        entry = render_entry(entry)
+        if entry.html:
+            rendered.append(entry)
+    return rendered
+
+
+def filter_entries(entries: list, filter_: str) -> list:
+    """Get the rendered entries that match the given filter, see filters.parse_filter()."""
+    if not filter_:
+        return entries
+    matcher = get_matcher(frozenset([filter_]))
+    return [e for e in entries if matcher.match(e.text)]
+
+
+def format_entries(entries: list, filter_: str) -> str:
+    """Join the HTML of the rendered entries that match the given filter."""
+    return "<br/><hr/>".join(e.html for e in filter_entries(entries, filter_))
+
+
+def render_entry(entry) -> RenderedEntry:
     title = entry.get("title") or ""
     pub_date = entry.get("published") or ""
     desc = ""
@@ -160,16 +705,11 @@ def _parse_entry(entry) -> tuple:
                 desc += c["value"]
     if not desc:
         desc = entry.get("description") or ""
+    desc_html = desc
 
-    if title:
-        desc_soup = bs4.BeautifulSoup(desc, "html5lib")
-        for tag in desc_soup("br"):
-            tag.replace_with("\n")
-        title_soup = bs4.BeautifulSoup(title.rstrip("."), "html5lib")
-        if " ".join(desc_soup.get_text().split()).startswith(
-            " ".join(title_soup.get_text().split())
-        ):
-            title = ""
+    if title and _text_startswith(desc, _html_to_text(title.rstrip("."), False)):
+        title = ""
+    title_text = _html_to_text(title, False)
 
     if title:
         title = f'<a href="{entry.get("link") or ""}"><h3>{title}</h3></a>'
@@ -181,7 +721,71 @@ def _parse_entry(entry) -> tuple:
     if pub_date:
         pub_date = f"<p>📆 <small><em>{pub_date}</em></small></p>"
 
-    return pub_date, title, desc
+    return RenderedEntry(title_text, desc_html, title + pub_date + desc)
+
+
+class _TextExtractor(HTMLParser):
+    """Collect the text of an HTML fragment like BeautifulSoup's get_text() does,
+    optionally converting <br> tags to new lines.
+    """
+
+    def __init__(self, breaks: bool = True) -> None:
+        super().__init__(convert_charrefs=True)
+        self.breaks = breaks
+        self.parts: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag == "br" and self.breaks:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "br" and self.breaks:  # </br> is parsed as <br> by browsers
+            self.parts.append("\n")
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self.handle_starttag(tag, attrs)
+
+    def handle_data(self, data: str) -> None:
+        self.parts.append(data.replace("\0", ""))
+
+    def close(self) -> None:
+        # like browsers, drop a tag left unfinished at the end of the fragment
+        if re.match("</?[a-zA-Z]", self.rawdata):
+            self.rawdata = ""
+        super().close()
+
+    def get_text(self) -> str:
+        return "".join(self.parts)
+
+
+def _html_to_text(html: str, breaks: bool = True) -> str:
+    """Get the text of the given HTML fragment."""
+    if "<" not in html and "&" not in html:
+        return html.replace("\0", "")
+    parser = _TextExtractor(breaks)
+    parser.feed(html)
+    parser.close()
+    return parser.get_text()
+
+
+def _text_startswith(html: str, prefix: str) -> bool:
+    """Check if the text of the HTML fragment starts with the given text,
+    ignoring whitespace differences.
+
+    The fragment is parsed only until enough text to decide was found.
+    """
+    prefix = " ".join(prefix.split())
+    if "<" not in html and "&" not in html:
+        return " ".join(html.replace("\0", "").split()).startswith(prefix)
+    parser = _TextExtractor()
+    for i in range(0, len(html), 4096):
+        parser.feed(html[i : i + 4096])
+        # text collected so far is always a prefix of the whole normalized text
+        text = " ".join(parser.get_text().split())
+        if len(text) >= len(prefix):
+            return text.startswith(prefix)
+    parser.close()
+    return " ".join(parser.get_text().split()).startswith(prefix)
 
 
 def get_new_entries(entries: list, date: tuple) -> list:
@@ -202,8 +806,38 @@ def get_old_entries(entries: list, date: tuple) -> list:
     return old_entries
 
 
-def get_latest_date(entries: list) -> Optional[str]:
-    dates = []
+def get_entry_key(entry) -> str:
+    """Get a short hash identifying the entry by its GUID, link or content."""
+    key = entry.get("id") or entry.get("link")
+    if not key:
+        key = "\0".join(
+            entry.get(field) or "" for field in ("title", "published", "description")
+        )
+    return hash_key(key)
+
+
+def get_unseen_entries(entries: list, seen: str) -> list:
+    seen_keys = set(seen.split())
+    return [e for e in entries if get_entry_key(e) not in seen_keys]
+
+
+def update_seen_entries(seen: Optional[str], entries: list) -> str:
+    """Add the keys of the given entries to the seen keys, evicting the oldest
+    keys of entries no longer in the feed if there are too many.
+    """
+    keys = dict.fromkeys(get_entry_key(e) for e in entries)
+    limit = max(SEEN_ENTRIES_LIMIT, len(keys))
+    keys.update(dict.fromkeys((seen or "").split()))
+    return " ".join(list(keys)[:limit])
+
+
+def get_body_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def get_latest_date(entries: list, latest: Optional[str] = None) -> Optional[str]:
+    """Get the date of the newest entry, or `latest` if it is newer."""
+    dates = [tuple(map(int, latest.split()))] if latest else []
     for e in entries:
         d = e.get("published_parsed") or e.get("updated_parsed")
         if d:
@@ -212,16 +846,195 @@ def get_latest_date(entries: list) -> Optional[str]:
 
 
 def parse_feed(
-    url: str, etag: Optional[str] = None, modified: Optional[tuple] = None
-) -> feedparser.FeedParserDict:
+    url: str,
+    etag: Optional[str] = None,
+    modified: Optional[str] = None,
+    cache: Optional[FetchCache] = None,
+) -> "feedparser.FeedParserDict":
+    if cache:
+        return parse_response(
+            cache.get(url, functools.partial(fetch_feed, url, etag, modified))
+        )
+    return parse_response(fetch_feed(url, etag, modified))
+
+
+def discover_feed(url: str, cache: Optional[FetchCache] = None) -> tuple:
+    """Download and parse the feed at the given URL or, if it is a web page,
+    the first feed it links with <link rel="alternate">.
+
+    Return the feed's URL, the one it was permanently redirected to if any,
+    and the parsed feed.
+    """
+
+    def fetch(url: str) -> FeedResponse:
+        if cache:
+            return cache.get(url, functools.partial(fetch_feed, url))
+        return fetch_feed(url)
+
+    resp = fetch(url)
+    try:
+        d = parse_response(resp)
+    except Exception:
+        d = None
+    if d is None or not d.get("version"):
+        links = find_feed_links(resp.text, resp.url)
+        if links:
+            url = links[0]
+            resp = fetch(url)
+            d = parse_response(resp)
+        elif d is None:
+            raise ValueError(f"No feed found at {url}")
+    return resp.redirect or url, d
+
+
+class _FeedLinkFinder(HTMLParser):
+    """Collect the URLs of the feeds linked by a web page."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.links: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag != "link":
+            return
+        attrs_ = dict(attrs)
+        rels = (attrs_.get("rel") or "").lower().split()
+        type_ = (attrs_.get("type") or "").split(";")[0].strip().lower()
+        if "alternate" in rels and type_ in _FEED_TYPES and attrs_.get("href"):
+            self.links.append(attrs_["href"])
+
+
+def find_feed_links(html: str, base_url: str) -> list:
+    """Get the normalized URLs of the feeds linked in the page's <head>."""
+    match = re.search("<body", html, re.IGNORECASE)
+    finder = _FeedLinkFinder()
+    finder.feed(html[: match.start()] if match else html)
+    finder.close()
+    links = [normalize_url(urljoin(base_url, link)) for link in finder.links]
+    return list(dict.fromkeys(links))
+
+
+@functools.lru_cache(maxsize=None)
+def get_session() -> "requests.Session":
+    """Get the HTTP session shared by all the downloads, it is created the
+    first time something is downloaded because importing requests is slow.
+    """
+    # pylint: disable=C0415
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.headers.update({"user-agent": USER_AGENT})
+    session.request = functools.partial(session.request, timeout=15)  # type: ignore
+    # keep idle connections to many hosts, not only to the 10 most recent ones
+    session.mount("http://", HTTPAdapter(pool_connections=256, pool_maxsize=20))
+    session.mount("https://", HTTPAdapter(pool_connections=256, pool_maxsize=20))
+    return session
+
+
+def fetch_feed(
+    url: str,
+    etag: Optional[str] = None,
+    modified: Optional[str] = None,
+    scanner: Optional[EntryScanner] = None,
+) -> FeedResponse:
+    """Download a feed, if a scanner is given the download stops at the old entries."""
+    headers = get_request_headers(etag, modified)
+    with get_session().get(url, headers=headers, stream=True) as resp:
+        # time until the headers were parsed, including connecting to the server
+        FETCH_SECONDS.observe(resp.elapsed.total_seconds(), stage="ttfb")
+        resp.raise_for_status()
+        with FETCH_SECONDS.time(stage="body"):
+            text = get_response_text(resp, MAX_FEED_SIZE, scanner)
+        feed_resp = make_feed_response(
+            resp.url, resp.status_code, resp.headers, text, headers
+        )
+        feed_resp.truncated = scanner is not None and scanner.done
+        statuses = [r.status_code for r in resp.history]
+        feed_resp.redirect = get_permanent_redirect(url, resp.url, statuses)
+        return feed_resp
+
+
+def capture_response(
+    directory: Path, fetch: Callable[[], FeedResponse]
+) -> FeedResponse:
+    """Download a feed with the given function and save the response in the
+    directory, the last download of each feed is kept.
+    """
+    resp = fetch()
+    if resp.status == 200 and resp.text:
+        path = directory / f"{hash_key(resp.url)}.json"
+        with NamedTemporaryFile(
+            "w", dir=directory, delete=False, encoding="utf-8"
+        ) as temp_file:
+            json.dump(asdict(resp), temp_file)
+        os.replace(temp_file.name, path)
+    return resp
+
+
+def get_scanner(feed: FeedRecord) -> Optional[EntryScanner]:
+    """Get a scanner to stop downloading the feed at the entries already seen."""
+    if feed.seen or feed.latest:
+        return EntryScanner(feed.seen, feed.latest)
+    return None
+
+
+def make_feed_response(
+    url: str,
+    status: int,
+    headers: Mapping[str, str],
+    text: str,
+    req_headers: dict,
+) -> FeedResponse:
+    headers = {key.lower(): value for key, value in headers.items()}
+    etag = headers.get("etag")
+    modified = headers.get("last-modified")
+    if status == 304:  # keep the validators if they weren't resent
+        etag = etag or req_headers.get("If-None-Match")
+        modified = modified or req_headers.get("If-Modified-Since")
+    return FeedResponse(url, status, headers, text, etag, modified)
+
+
+def get_permanent_redirect(url: str, final_url: str, statuses: list) -> Optional[str]:
+    """Get the normalized final URL if the request was redirected only with
+    301 Moved Permanently or 308 Permanent Redirect.
+    """
+    if statuses and all(status in (301, 308) for status in statuses):
+        final_url = normalize_url(final_url)
+        if final_url != normalize_url(url):
+            return final_url
+    return None
+
+
+def parse_response(resp: FeedResponse) -> "feedparser.FeedParserDict":
+    # pylint: disable=C0415
+    import feedparser
+    from feedparser.exceptions import CharacterEncodingOverride
+
+    dict_ = feedparser.parse(resp.text)
+    dict_["status"] = resp.status
+    dict_["headers"] = resp.headers
+    dict_["etag"] = resp.etag
+    dict_["modified"] = resp.modified
+    bozo_exception = dict_.get("bozo_exception", ValueError("Invalid feed"))
+    if (
+        dict_.get("bozo")
+        and not isinstance(bozo_exception, CharacterEncodingOverride)
+        and not dict_.get("entries")
+    ):
+        raise bozo_exception
+    return dict_
+
+
+def get_request_headers(etag: Optional[str], modified: Optional[str]) -> dict:
+    """Get the headers of a conditional GET request for a feed."""
+    from feedparser.datetimes import _parse_date  # pylint: disable=C0415
+
     headers = {"A-IM": "feed", "Accept-encoding": "gzip, deflate"}
     if etag:
         headers["If-None-Match"] = etag
-    if modified:
-        if isinstance(modified, str):
-            modified = _parse_date(modified)
-        elif isinstance(modified, datetime.datetime):
-            modified = modified.utctimetuple()
+    date = _parse_date(modified) if modified else None
+    if date:
         short_weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
         months = [
             "Jan",
@@ -238,37 +1051,31 @@ def parse_feed(
             "Dec",
         ]
         headers["If-Modified-Since"] = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (  # noqa
-            short_weekdays[modified[6]],
-            modified[2],
-            months[modified[1] - 1],
-            modified[0],
-            modified[3],
-            modified[4],
-            modified[5],
+            short_weekdays[date[6]],
+            date[2],
+            months[date[1] - 1],
+            date[0],
+            date[3],
+            date[4],
+            date[5],
         )
-    with www.get(url, headers=headers, stream=True) as resp:
-        resp.raise_for_status()
-        text = get_response_text(resp, 1024**2 * 10)  # 10MB
-        dict_ = feedparser.parse(text)
-    bozo_exception = dict_.get("bozo_exception", ValueError("Invalid feed"))
-    if (
-        dict_.get("bozo")
-        and not isinstance(bozo_exception, CharacterEncodingOverride)
-        and not dict_.get("entries")
-    ):
-        raise bozo_exception
-    return dict_
+    return headers
 
 
-def get_response_text(resp: requests.Response, max_size: int) -> str:
+def get_response_text(
+    resp: "requests.Response", max_size: int, scanner: Optional[EntryScanner] = None
+) -> str:
     """
     Return the response text only if the total payload size does not exceed max_size.
     If the size is unknown or exceeds the limit, an empty string is returned.
+
+    If a scanner is given, reading stops at the feed's old entries, so only
+    the part of the feed before them has to fit in max_size.
     """
     # Try to get the size from the headers
     content_length = int(resp.headers.get("content-length", -1))
 
-    if content_length > max_size:
+    if content_length > max_size and scanner is None:
         return ""  # skip reading the body
 
     # content_length might be -1/unknown or fake so check manually
@@ -276,18 +1083,27 @@ def get_response_text(resp: requests.Response, max_size: int) -> str:
     total = 0
     for chunk in resp.iter_content(chunk_size=102400):  # 100KB chunks
         total += len(chunk)
+        DOWNLOADED_BYTES.inc(len(chunk))
+        if scanner is not None:
+            scanner.feed(chunk)
+            if scanner.done:
+                content.extend(chunk)
+                return decode_content(scanner.truncate(content), resp.encoding)
         if total > max_size:
             return ""  # limit exceeded, discard
         content.extend(chunk)
 
-    encoding = resp.encoding or "utf-8"
+    return decode_content(content, resp.encoding)
+
+
+def decode_content(content: Union[bytes, bytearray], encoding: Optional[str]) -> str:
     try:
-        return content.decode(encoding, errors="replace")
+        return content.decode(encoding or "utf-8", errors="replace")
     except (LookupError, TypeError):
         return content.decode(errors="replace")
 
 
-def get_img_ext(resp: requests.Response) -> str:
+def get_img_ext(resp: "requests.Response") -> str:
     disp = resp.headers.get("content-disposition")
     if disp is not None and re.findall("filename=(.+)", disp):
         fname = re.findall("filename=(.+)", disp)[0].strip('"')
@@ -305,18 +1121,36 @@ def get_img_ext(resp: requests.Response) -> str:
 
 
 def normalize_url(url: str) -> str:
-    if not url.startswith("http"):
+    """Get the canonical form of a feed URL, so the same feed isn't stored twice.
+
+    The scheme and host are lowercased, and the default port, the fragment, the
+    tracking parameters (ex. utm_source) and the trailing slash are removed.
+    """
+    url = url.strip()
+    if not re.match("https?://", url, re.IGNORECASE):
         url = "http://" + url
-    return url.rstrip("/")
-
-
-def set_group_image(bot: Bot, url: str, accid: int, chatid: int) -> None:
-    with www.get(url) as resp:
-        if resp.status_code < 400 or resp.status_code >= 600:
-            with NamedTemporaryFile(suffix=get_img_ext(resp)) as temp_file:
-                with open(temp_file.name, "wb") as file:
-                    file.write(resp.content)
-                try:
-                    bot.rpc.set_chat_profile_image(accid, chatid, temp_file.name)
-                except JsonRpcError as ex:
-                    bot.logger.exception(ex)
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    userinfo, _, host = parts.netloc.rpartition("@")
+    host = host.lower()
+    if (scheme, host.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+        host = host.rpartition(":")[0]
+    netloc = f"{userinfo}@{host}" if userinfo else host
+    query = "&".join(
+        param
+        for param in parts.query.split("&")
+        if param and not param.split("=")[0].lower().startswith(_TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, netloc, parts.path, query, "")).rstrip("/")
+
+
+def set_group_image(
+    bot: Bot, images: ImageCache, url: str, accid: int, chatid: int
+) -> None:
+    """Set the group's avatar, the image is downloaded only if it isn't cached."""
+    path = images.get(url, get_session(), get_img_ext)
+    if path:
+        try:
+            bot.rpc.set_chat_profile_image(accid, chatid, str(path))
+        except JsonRpcError as ex:
+            bot.logger.exception(ex)
@@ -0,0 +1,20 @@
+"""Fixtures shared by the tests"""
+
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from feedsbot import orm
+
+
+@pytest.fixture
+def db(tmp_path):
+    """An empty database."""
+    orm.init(f"sqlite:///{tmp_path / 'sqlite.db'}")
+
+
+@pytest.fixture
+def bot():
+    """A bot without accounts, enough for the worker."""
+    return SimpleNamespace(logger=logging.getLogger("feedsbot.tests"))
@@ -0,0 +1,120 @@
+"""Tests of the cache of downloaded feeds"""
+
+import threading
+
+import pytest
+
+from feedsbot import cache
+from feedsbot.cache import FetchCache
+from feedsbot.util import FeedResponse
+
+
+class Clock:
+    """A clock that only moves when told to."""
+
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock moved forward by the tests."""
+    clock_ = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock_)
+    return clock_
+
+
+class Fetcher:
+    """Download fake feeds, counting the downloads of each URL."""
+
+    def __init__(self, size: int = 10, status: int = 200) -> None:
+        self.size = size
+        self.status = status
+        self.calls: dict = {}
+
+    def __call__(self, url: str):
+        def fetch() -> FeedResponse:
+            self.calls[url] = self.calls.get(url, 0) + 1
+            return FeedResponse(url, self.status, {}, "x" * self.size, None, None)
+
+        return fetch
+
+
+def test_ttl_expiry(clock):
+    """The downloads are reused until they are `ttl` seconds old."""
+    fetch = Fetcher()
+    fetch_cache = FetchCache(60, 1000)
+    url = "https://example.org/feed.xml"
+    resp = fetch_cache.get(url, fetch(url))
+    clock.now += 59
+    assert fetch_cache.get(url, fetch(url)) is resp
+    assert fetch.calls[url] == 1
+    clock.now += 2
+    assert fetch_cache.get(url, fetch(url)) is not resp
+    assert fetch.calls[url] == 2
+
+
+def test_size_eviction(clock):
+    """The least recently used downloads are dropped to keep at most `max_size`
+    characters, and bigger feeds aren't cached.
+    """
+    # pylint: disable=unused-argument
+    fetch = Fetcher(size=40)
+    fetch_cache = FetchCache(60, 100)
+    urls = [f"https://example.org/{number}.xml" for number in range(4)]
+    fetch_cache.get(urls[0], fetch(urls[0]))
+    fetch_cache.get(urls[1], fetch(urls[1]))
+    fetch_cache.get(urls[0], fetch(urls[0]))  # now the most recently used
+    fetch_cache.get(urls[2], fetch(urls[2]))  # evicts urls[1]
+    for url in (urls[0], urls[2], urls[1]):
+        fetch_cache.get(url, fetch(url))
+    assert [fetch.calls[url] for url in urls[:3]] == [1, 2, 1]
+
+    fetch.size = 101
+    fetch_cache.get(urls[3], fetch(urls[3]))
+    fetch_cache.get(urls[3], fetch(urls[3]))
+    assert fetch.calls[urls[3]] == 2
+
+
+@pytest.mark.parametrize("status", [304, 500])
+def test_partial_downloads_not_cached(clock, status):
+    # pylint: disable=unused-argument
+    fetch = Fetcher(status=status)
+    fetch_cache = FetchCache(60, 1000)
+    url = "https://example.org/feed.xml"
+    fetch_cache.get(url, fetch(url))
+    fetch_cache.get(url, fetch(url))
+    assert fetch.calls[url] == 2
+
+
+def test_concurrent_downloads_coalesced():
+    """Concurrent requests of the same URL share a single download."""
+    fetch_cache = FetchCache(60, 1000)
+    url = "https://example.org/feed.xml"
+    started, done = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_fetch() -> FeedResponse:
+        calls.append(url)
+        started.set()
+        done.wait(5)
+        return FeedResponse(url, 200, {}, "feed", None, None)
+
+    results = []
+    owner = threading.Thread(
+        target=lambda: results.append(fetch_cache.get(url, slow_fetch))
+    )
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(
+        target=lambda: results.append(fetch_cache.get(url, slow_fetch))
+    )
+    waiter.start()
+    done.set()
+    owner.join(5)
+    waiter.join(5)
+    assert len(calls) == 1
+    assert len(results) == 2 and results[0] is results[1]
@@ -0,0 +1,129 @@
+"""Tests of the delivery of the outbox messages"""
+
+import logging
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+from deltachat2 import JsonRpcError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from feedsbot.delivery import DeliveryOptions, DeliveryQueue, make_digests
+from feedsbot.orm import Fchat, Feed, FeedUpdates, Outbox, session_scope
+
+
+class FakeRpc:
+    """Record the sent messages, or fail to send them."""
+
+    def __init__(self, error: Optional[Exception] = None) -> None:
+        self.error = error
+        self.sent: list = []
+
+    def send_msg(self, accid, gid, msg):
+        if self.error:
+            raise self.error
+        self.sent.append((accid, gid, msg))
+
+
+def deliver(rpc: FakeRpc, max_attempts: int = 8) -> None:
+    bot = SimpleNamespace(logger=logging.getLogger("feedsbot.tests"), rpc=rpc)
+    options = DeliveryOptions(0, max_attempts=max_attempts, retry_delay=30)
+    queue = DeliveryQueue(bot, options)
+    queue.flush()
+    assert queue.join(5)
+
+
+def add_message(attempts: int = 0) -> None:
+    with session_scope() as session:
+        session.add(Feed(url="https://example.org/feed.xml"))
+        session.add(Fchat(accid=1, gid=10, feed_url="https://example.org/feed.xml"))
+        session.add(
+            Outbox(accid=1, gid=10, html="<p>1</p>", created=0, attempts=attempts)
+        )
+
+
+def get_outbox() -> list:
+    with session_scope(readonly=True) as session:
+        return list(session.execute(select(Outbox)).scalars())
+
+
+def test_send(db):
+    """Sent messages are removed from the outbox."""
+    # pylint: disable=unused-argument
+    add_message()
+    rpc = FakeRpc()
+    deliver(rpc)
+    assert [(accid, gid) for accid, gid, _ in rpc.sent] == [(1, 10)]
+    assert not get_outbox()
+
+
+def test_retry_with_backoff(db):
+    """Failed messages are retried later, doubling the delay after each attempt."""
+    # pylint: disable=unused-argument
+    add_message(attempts=2)
+    start = time.time()
+    deliver(FakeRpc(ValueError("offline")))
+    (row,) = get_outbox()
+    assert row.attempts == 3
+    assert start + 30 * 4 <= row.next_attempt <= time.time() + 30 * 4
+
+
+def test_give_up(db):
+    """Messages are given up after too many attempts, and on RPC errors the chat
+    is unsubscribed.
+    """
+    # pylint: disable=unused-argument
+    add_message(attempts=2)
+    deliver(FakeRpc(JsonRpcError("no such chat")), max_attempts=3)
+    assert not get_outbox()
+    with session_scope(readonly=True) as session:
+        assert not session.execute(select(Fchat)).all()
+
+
+def make_row(html: str, sender: str = "Feed", entries: int = 1) -> SimpleNamespace:
+    return SimpleNamespace(html=html, sender=sender, entries=entries)
+
+
+def test_make_digests():
+    """The entries of several feeds are merged into messages of at most max_size."""
+    rows = [make_row("a" * 40), make_row("b" * 40), make_row("c" * 40)]
+    digests = make_digests(rows, 100)
+    assert [group for _, _, group in digests] == [rows[:2], rows[2:]]
+    assert [entries for _, entries, _ in digests] == [2, 1]
+    assert "<h2>Feed</h2>" + "a" * 40 in digests[0][0].html
+    # a single feed keeps its title as the sender
+    assert digests[1][0].html == "c" * 40
+    assert digests[1][0].override_sender_name == "Feed"
+
+
+def test_digests_dont_split_feeds():
+    """The entries of a single feed are sent whole, even if they are too big."""
+    rows = [make_row("a" * 10), make_row("b" * 200), make_row("c" * 10)]
+    digests = make_digests(rows, 100)
+    assert [group for _, _, group in digests] == [rows[:1], rows[1:2], rows[2:]]
+
+
+def test_queue_and_mark_seen(db):
+    """The new entries are queued and marked as seen in the same transaction."""
+    # pylint: disable=unused-argument
+    url = "https://example.org/feed.xml"
+    with session_scope() as session:
+        session.add(Feed(url=url))
+    updates = FeedUpdates()
+    message = {"accid": 1, "gid": 10, "html": "<p>1</p>", "created": 0}
+    updates.add(url, messages=[message], seen="key1", latest="1")
+    assert not get_outbox()  # written when flushed
+    updates.flush()
+    assert [row.html for row in get_outbox()] == ["<p>1</p>"]
+    with session_scope(readonly=True) as session:
+        assert session.get(Feed, url).seen == "key1"
+
+    # if the messages can't be queued, the entries aren't marked as seen
+    updates.add(url, messages=[{"accid": 1, "html": "<p>2</p>"}], seen="key2")
+    with pytest.raises(IntegrityError):
+        updates.flush()
+    assert [row.html for row in get_outbox()] == ["<p>1</p>"]
+    with session_scope(readonly=True) as session:
+        assert session.get(Feed, url).seen == "key1"
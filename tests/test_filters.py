@@ -0,0 +1,94 @@
+"""Tests of the chat filters"""
+
+import pytest
+
+from feedsbot.filters import (
+    MAX_REGEX_LENGTH,
+    MAX_REGEX_TEXT,
+    TRIE_MIN_KEYWORDS,
+    get_matcher,
+    parse_filter,
+    quote_filter,
+)
+
+
+@pytest.mark.parametrize(
+    "text", ["-rc", "/v2/", "Item 2", 'say "hi"', "foo/bar", "C++ (beta)", "a\\"]
+)
+def test_quote_filter(text):
+    """A quoted filter matches the entries containing the whole text."""
+    matcher = get_matcher(frozenset([quote_filter(text)]))
+    assert matcher.match(f"Release {text} notes")
+    assert not matcher.match("Release v2.0 Item rc say hi foo bar C beta a")
+
+
+def test_quote_empty_filter():
+    assert quote_filter("") == ""
+
+
+@pytest.mark.parametrize(
+    "filter_,text,expected",
+    [
+        ("delta chat", "Delta Chat 1.0 released", True),
+        ("delta chat", "Delta 1.0 released", False),
+        ("delta -android", "Delta for Android", False),
+        ("delta -android", "Delta for iOS", True),
+        ('"delta chat"', "New delta chat release", True),
+        ('"delta chat"', "Chat with delta", False),
+        ('-"beta release"', "A beta of the new release", True),
+        ("/v[0-9]+/", "Release v12", True),
+        ("/v[0-9]+/", "Release vX", False),
+        ("release -/v[0-9]+/", "Release v12", False),
+        ("release -/v[0-9]+/", "Release notes", True),
+        ("", "Anything", True),
+    ],
+)
+def test_match_filter(filter_, text, expected):
+    """Words, phrases and regular expressions are all required, unless negated."""
+    assert bool(get_matcher(frozenset([filter_])).match(text)) is expected
+
+
+def test_match_many_filters():
+    """A matcher finds all the filters matching a text, with or without the trie."""
+    filters = ["delta", "chat -android", '"hello world"', "/v[0-9]/"]
+    text = "Delta Chat v2: hello world"
+    expected = {"delta", "chat -android", '"hello world"', "/v[0-9]/"}
+    assert get_matcher(frozenset(filters)).match(text) == expected
+    many = filters + [f"keyword{number}" for number in range(TRIE_MIN_KEYWORDS)]
+    assert get_matcher(frozenset(many)).match(text) == expected
+
+
+@pytest.mark.parametrize(
+    "filter_",
+    [
+        "/(a+)+$/",
+        "/(a|aa)+$/",
+        "/.*.*=/",
+        r"/(a)\1/",
+        "/(?=a)b/",
+        "/(?<!a)b/",
+        "/a?a?a?a?a?a?a?/",
+        "/" + "a" * (MAX_REGEX_LENGTH + 1) + "/",
+        "/[unclosed/",
+    ],
+)
+def test_reject_regex(filter_):
+    """Regular expressions that can backtrack for long are rejected."""
+    with pytest.raises(ValueError):
+        parse_filter(filter_)
+
+
+def test_regex_searches_start():
+    """Regular expressions only search the start of long texts."""
+    matcher = get_matcher(frozenset(["/v[0-9]+/"]))
+    assert matcher.match("v2 " + "a" * MAX_REGEX_TEXT)
+    assert not matcher.match("a" * MAX_REGEX_TEXT + " v2")
+
+
+def test_invalid_stored_filter():
+    """Stored filters that are now invalid match their whole text."""
+    matcher = get_matcher(frozenset(["/(a+)+$/"]))
+    assert matcher.match("Release /(a+)+$/")
+    assert not matcher.match(
+        "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa!"
+    )
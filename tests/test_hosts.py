@@ -0,0 +1,96 @@
+"""Tests of the politeness towards the feeds' hosts"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from feedsbot.hosts import HostLimiter, Throttled, interleave_hosts
+
+
+class HttpError(Exception):
+    """A failed request, like the requests errors."""
+
+    def __init__(self, status: int, headers: dict) -> None:
+        super().__init__(status)
+        self.response = SimpleNamespace(status_code=status, headers=headers)
+
+
+def test_connections_per_host():
+    """At most `connections` downloads of the same host run at once, other hosts
+    aren't blocked by them.
+    """
+    limiter = HostLimiter(2, 0)
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+
+    def fetch(host: str) -> None:
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+
+    threads = [
+        threading.Thread(
+            target=limiter.fetch, args=(f"https://{host}/{n}", lambda h=host: fetch(h))
+        )
+        for n in range(6)
+        for host in ("a.org", "b.org")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert peak == {"a.org": 2, "b.org": 2}
+
+
+def test_spacing():
+    """The downloads of the same host start at least `spacing` seconds apart."""
+    limiter = HostLimiter(10, 0.5)
+    assert limiter.reserve("https://a.org/1") == 0
+    assert limiter.reserve("https://a.org/2") == pytest.approx(0.5, abs=0.05)
+    assert limiter.reserve("https://a.org/3") == pytest.approx(1.0, abs=0.05)
+    assert limiter.reserve("https://b.org/1") == 0
+
+
+def test_retry_after_pauses_host():
+    """A 429 response pauses the host for as long as Retry-After asks."""
+    limiter = HostLimiter(1, 0)
+
+    def fetch():
+        raise HttpError(429, {"retry-after": "120"})
+
+    with pytest.raises(Throttled) as info:
+        limiter.fetch("https://a.org/1", fetch)
+    assert (info.value.status, info.value.delay) == (429, 120)
+    with pytest.raises(Throttled) as info:
+        limiter.fetch("https://a.org/2", lambda: "feed")
+    assert info.value.status == 0
+    assert 110 < info.value.delay <= 120
+    assert limiter.fetch("https://b.org/1", lambda: "feed") == "feed"
+
+
+def test_unavailable_without_retry_after():
+    """A 503 without Retry-After is an error of the feed, the host isn't paused."""
+    limiter = HostLimiter(1, 0)
+
+    def fetch():
+        raise HttpError(503, {})
+
+    with pytest.raises(HttpError):
+        limiter.fetch("https://a.org/1", fetch)
+    assert limiter.fetch("https://a.org/2", lambda: "feed") == "feed"
+
+
+def test_interleave_hosts():
+    urls = ["https://a.org/1", "https://a.org/2", "https://a.org/3", "https://b.org/1"]
+    assert interleave_hosts(urls, lambda url: url) == [
+        "https://a.org/1",
+        "https://b.org/1",
+        "https://a.org/2",
+        "https://a.org/3",
+    ]
@@ -0,0 +1,82 @@
+"""Tests of the memory budget of the worker"""
+
+import asyncio
+import threading
+
+from feedsbot.memory import DOWNLOAD_RESERVE, PROCESSING_FACTOR, MemoryBudget
+from feedsbot.util import FeedResponse
+
+MB = 1024**2
+
+
+def make_fetch(url: str, size: int):
+    return lambda: FeedResponse(url, 200, {}, "x" * size, None, None)
+
+
+def test_reserve_and_release():
+    """A download reserves DOWNLOAD_RESERVE, then holds PROCESSING_FACTOR times
+    the feed's size until it is released.
+    """
+    budget = MemoryBudget(10 * MB)
+    budget.fetch("a", make_fetch("a", 1000))
+    assert budget.held == 1000 * PROCESSING_FACTOR
+    asyncio.run(budget.wait("c"))
+    assert budget.held == 1000 * PROCESSING_FACTOR + DOWNLOAD_RESERVE
+    budget.release("a")
+    budget.release("c")
+    budget.release("unknown")
+    assert budget.held == 0
+
+
+def test_fetch_waits_for_room():
+    """Downloads wait while the budget is full, and start when it's released."""
+    budget = MemoryBudget(2 * MB)
+    budget.hold("big", MB // PROCESSING_FACTOR + 1)
+    started = threading.Event()
+
+    def fetch() -> FeedResponse:
+        started.set()
+        return make_fetch("small", 10)()
+
+    thread = threading.Thread(target=budget.fetch, args=("small", fetch))
+    thread.start()
+    assert not started.wait(0.2)
+    budget.release("big")
+    thread.join(5)
+    assert started.is_set()
+    assert budget.held == 10 * PROCESSING_FACTOR
+
+
+def test_big_feed_exceeds_budget():
+    """A download always starts when nothing is held, even if it doesn't fit."""
+    budget = MemoryBudget(DOWNLOAD_RESERVE // 2)
+    budget.fetch("big", make_fetch("big", MB))
+    assert budget.held == MB * PROCESSING_FACTOR
+    budget.release("big")
+    assert budget.held == 0
+
+
+def test_async_waiters_woken_in_order():
+    """The async downloads waiting for room get it in order, as it's released."""
+    budget = MemoryBudget(2 * DOWNLOAD_RESERVE)
+
+    async def main() -> list:
+        budget.hold("full", 2 * DOWNLOAD_RESERVE // PROCESSING_FACTOR)
+        order: list = []
+
+        async def download(url: str) -> None:
+            await budget.wait(url)
+            order.append(url)
+
+        tasks = [asyncio.create_task(download(url)) for url in ("a", "b", "c")]
+        await asyncio.sleep(0.05)
+        assert not order
+        budget.release("full")  # room for two downloads
+        await asyncio.sleep(0.05)
+        assert order == ["a", "b"]
+        budget.release("a")
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["a", "b", "c"]
+    assert budget.held == 2 * DOWNLOAD_RESERVE
@@ -0,0 +1,65 @@
+"""Tests of the OPML import and export"""
+
+# pylint: disable=protected-access
+
+from types import SimpleNamespace
+
+import feedparser
+import pytest
+
+from feedsbot import hooks
+from feedsbot.opml import format_opml, parse_opml
+from feedsbot.scheduler import Scheduler
+
+FEEDS = [
+    ("https://example.org/feed.xml", ""),
+    ("https://example.org/news?lang=en&page=1", '"delta chat" -android'),
+    ("https://example.com/atom.xml", "/v[0-9]+/ <ünïcode>"),
+]
+
+
+def test_round_trip():
+    """The exported feeds and filters are imported back unchanged."""
+    assert parse_opml(format_opml("Feeds of <Group>", FEEDS)) == FEEDS
+
+
+def test_parse_folders():
+    """Outlines nested in folders are found, and outlines without URL skipped."""
+    text = """<?xml version="1.0"?>
+    <opml version="1.0"><head><title>Feeds</title></head><body>
+      <outline text="News">
+        <outline text="A" type="rss" xmlUrl=" https://example.org/a.xml "/>
+        <outline text="B" type="rss" xmlurl="https://example.org/b.xml"/>
+      </outline>
+      <outline text="No URL"/>
+    </body></opml>"""
+    assert parse_opml(text) == [
+        ("https://example.org/a.xml", ""),
+        ("https://example.org/b.xml", ""),
+    ]
+
+
+@pytest.mark.parametrize("text", ["<opml><body>", "<rss></rss>", ""])
+def test_parse_invalid(text):
+    with pytest.raises(ValueError):
+        parse_opml(text)
+
+
+def test_import_export(db, monkeypatch):
+    """The feeds imported to a chat are exported with their filters."""
+    # pylint: disable=unused-argument
+    parsed = feedparser.parse("<rss><channel><title>Feed</title></channel></rss>")
+    monkeypatch.setattr(hooks, "discover_feed", lambda url, cache: (url, parsed))
+    context = hooks.CommandContext(Scheduler(60, 60), -1, 2)
+    feeds = FEEDS + [("https://example.org/feed.xml", "duplicated")]
+    summary = hooks._import_feeds(context, 1, 10, feeds)
+    assert summary == "✔️ Subscribed to 3 feeds"
+    summary = hooks._import_feeds(context, 1, 10, FEEDS)
+    assert "Already subscribed to 3 feeds" in summary
+
+    chat = SimpleNamespace(name="Group")
+    rpc = SimpleNamespace(get_basic_chat_info=lambda accid, chat_id: chat)
+    exported = hooks._export_opml(SimpleNamespace(rpc=rpc), 1, 10)
+    expected = dict(FEEDS)
+    expected["https://example.org/feed.xml"] = "duplicated"
+    assert parse_opml(exported) == sorted(expected.items())
@@ -0,0 +1,74 @@
+"""Tests of the database"""
+
+# pylint: disable=unused-argument
+
+from sqlalchemy import Select, select
+
+from feedsbot.orm import Fchat, Feed, move_feed, session_scope
+
+OLD_URL = "https://example.org/feed.xml?utm_source=rss"
+NEW_URL = "https://example.org/feed.xml"
+
+
+def get_chats() -> list:
+    with session_scope(readonly=True) as session:
+        stmt: Select = select(
+            Fchat.accid, Fchat.gid, Fchat.feed_url, Fchat.requested_url
+        )
+        return sorted(session.execute(stmt).all())
+
+
+def test_move_feed(db):
+    """The feed keeps its state and subscriptions, which remember the old URL
+    unless they were requested with another one.
+    """
+    with session_scope() as session:
+        session.add(Feed(url=OLD_URL, etag='"1"', latest="2024", seen="key"))
+        session.add(Fchat(accid=1, gid=10, feed_url=OLD_URL, filter="a"))
+        session.add(
+            Fchat(accid=1, gid=11, feed_url=OLD_URL, requested_url="https://a.org")
+        )
+    with session_scope() as session:
+        assert move_feed(session, OLD_URL, NEW_URL)
+
+    with session_scope(readonly=True) as session:
+        assert session.get(Feed, OLD_URL) is None
+        feed = session.get(Feed, NEW_URL)
+        assert (feed.etag, feed.latest, feed.seen) == ('"1"', "2024", "key")
+        assert session.get(Fchat, (1, 10, NEW_URL)).filter == "a"
+    assert get_chats() == [
+        (1, 10, NEW_URL, OLD_URL),
+        (1, 11, NEW_URL, "https://a.org"),
+    ]
+
+
+def test_merge_feed(db):
+    """The feed is merged into the feed already stored with the new URL, whose
+    state is kept, and the chats subscribed to both keep one subscription.
+    """
+    with session_scope() as session:
+        session.add(Feed(url=OLD_URL, etag='"old"'))
+        session.add(Feed(url=NEW_URL, etag='"new"'))
+        session.add(Fchat(accid=1, gid=10, feed_url=OLD_URL, filter="old"))
+        session.add(Fchat(accid=1, gid=10, feed_url=NEW_URL, filter="new"))
+        session.add(Fchat(accid=1, gid=11, feed_url=OLD_URL))
+        session.add(Fchat(accid=2, gid=10, feed_url=NEW_URL, requested_url=OLD_URL))
+    with session_scope() as session:
+        assert not move_feed(session, OLD_URL, NEW_URL)
+
+    with session_scope(readonly=True) as session:
+        assert session.execute(select(Feed.url, Feed.etag)).all() == [
+            (NEW_URL, '"new"')
+        ]
+        assert session.get(Fchat, (1, 10, NEW_URL)).filter == "new"
+    assert get_chats() == [
+        (1, 10, NEW_URL, None),
+        (1, 11, NEW_URL, OLD_URL),
+        (2, 10, NEW_URL, OLD_URL),
+    ]
+
+
+def test_move_missing_feed(db):
+    with session_scope() as session:
+        session.add(Feed(url=NEW_URL))
+        assert not move_feed(session, OLD_URL, NEW_URL)
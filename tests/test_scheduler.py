@@ -0,0 +1,88 @@
+"""Tests of the polling scheduler"""
+
+import pytest
+
+from feedsbot import scheduler
+from feedsbot.scheduler import Scheduler, get_cache_delay, get_feed_ttl
+
+NOW = 1_000_000.0
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    """Freeze the time and remove the jitter, unless a test sets its own."""
+    monkeypatch.setattr(scheduler.time, "time", lambda: NOW)
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: 1.0)
+
+
+def test_adaptive_interval():
+    """The interval is halved when there are new entries and grows otherwise,
+    within the bounds.
+    """
+    sched = Scheduler(60, 3600)
+    assert sched.get_next_check(None, False, {}) == (90, NOW + 90)
+    assert sched.get_next_check(600, True, {}) == (300, NOW + 300)
+    assert sched.get_next_check(600, False, {}) == (900, NOW + 900)
+    assert sched.get_next_check(100, True, {}) == (60, NOW + 60)
+    assert sched.get_next_check(3000, False, {}) == (3600, NOW + 3600)
+
+
+def test_hints_are_lower_bounds():
+    """The caching headers and the feed's update period delay the next check,
+    but don't change the interval and never exceed the maximum.
+    """
+    sched = Scheduler(60, 3600)
+    headers = {"cache-control": "public, max-age=1200"}
+    assert sched.get_next_check(600, True, headers) == (300, NOW + 1200)
+    assert sched.get_next_check(600, True, {}, 1800) == (300, NOW + 1800)
+    assert sched.get_next_check(600, True, {}, 60 * 60 * 24) == (300, NOW + 3600)
+
+
+def test_error_backoff():
+    """The delay doubles with each error, honoring Retry-After, up to the maximum."""
+    sched = Scheduler(60, 3600)
+    assert sched.get_error_check(1, {}) == NOW + 120
+    assert sched.get_error_check(3, {}) == NOW + 480
+    assert sched.get_error_check(50, {}) == NOW + 3600
+    assert sched.get_error_check(1, {"retry-after": "900"}) == NOW + 900
+    assert sched.get_throttled_check(10) == NOW + 60
+
+
+def test_jitter(monkeypatch):
+    """The delays are spread by up to 10% so feeds checked together drift apart."""
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: high)
+    sched = Scheduler(60, 3600)
+    assert sched.get_next_check(600, False, {}) == (900, pytest.approx(NOW + 990))
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: low)
+    assert sched.get_error_check(1, {}) == pytest.approx(NOW + 108)
+
+
+def test_cache_delay():
+    headers = {"cache-control": "max-age=600", "age": "100"}
+    assert get_cache_delay(headers, NOW) == 500
+    headers = {"cache-control": "no-cache", "expires": "Thu, 01 Jan 2099 00:00:00 GMT"}
+    assert get_cache_delay(headers, NOW) == 0
+    headers = {"date": "Sun, 11 Jan 1970 13:46:40 GMT"}
+    headers["expires"] = "Sun, 11 Jan 1970 14:46:40 GMT"
+    assert get_cache_delay(headers, NOW) == 3600
+
+
+def test_feed_ttl():
+    assert get_feed_ttl({"ttl": "30"}) == 1800
+    info = {"sy_updateperiod": "daily", "sy_updatefrequency": "4"}
+    assert get_feed_ttl(info) == 60 * 60 * 6
+    assert get_feed_ttl({"sy_updateperiod": "hourly"}) == 3600
+    assert get_feed_ttl({"ttl": "soon"}) == 0
+
+
+def test_pop_due():
+    """The feeds due within the window are popped in order, rescheduling a feed
+    replaces its old due time.
+    """
+    sched = Scheduler(60, 3600)
+    sched.schedule_many([("a", NOW - 10), ("b", NOW + 10), ("c", NOW + 100)])
+    sched.schedule("a", NOW - 5)
+    sched.schedule("d", NOW - 20)
+    sched.unschedule("c")
+    assert sched.pop_due(30) == ["d", "a", "b"]
+    assert len(sched) == 0
@@ -0,0 +1,87 @@
+"""Tests of the incremental scanning of feeds"""
+
+from typing import Optional
+
+import pytest
+
+from feedsbot.stream import EntryScanner, hash_key
+from feedsbot.util import FeedResponse, process_response
+
+RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>Test</title>{entries}</channel></rss>"""
+RSS_ENTRY = """<item><title>Entry {number}</title><guid>entry-{number}</guid>
+<link>https://example.org/{number}</link>{date}</item>"""
+RSS_DATE = "<pubDate>{day:02d} Jan 2024 10:00:00 GMT</pubDate>"
+
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Test</title>{entries}</feed>"""
+ATOM_ENTRY = """<entry><title>Entry {number}</title><id>entry-{number}</id>
+<link href="https://example.org/{number}"/>{date}</entry>"""
+ATOM_DATE = "<updated>2024-01-{day:02d}T10:00:00Z</updated>"
+
+FORMATS = {"rss": (RSS, RSS_ENTRY, RSS_DATE), "atom": (ATOM, ATOM_ENTRY, ATOM_DATE)}
+
+
+def make_feed(fmt: str, numbers: list, dated: bool = True) -> bytes:
+    template, entry, date = FORMATS[fmt]
+    entries = "".join(
+        entry.format(number=number, date=date.format(day=number) if dated else "")
+        for number in numbers
+    )
+    return template.format(entries=entries).encode()
+
+
+def scan(content: bytes, seen: Optional[list] = None, latest=None) -> EntryScanner:
+    keys = " ".join(hash_key(f"entry-{number}") for number in seen or [])
+    scanner = EntryScanner(keys or None, latest)
+    for start in range(0, len(content), 64):
+        scanner.feed(content[start : start + 64])
+    return scanner
+
+
+def count_new_entries(content: bytes, seen: list) -> int:
+    keys = " ".join(hash_key(f"entry-{number}") for number in seen)
+    resp = FeedResponse(
+        "https://example.org/feed", 200, {}, content.decode(), None, None
+    )
+    return process_response(resp, None, keys, [""]).new_entries
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("dated", [True, False])
+def test_oldest_first(fmt, dated):
+    """The new entries at the end of an oldest first feed are downloaded."""
+    content = make_feed(fmt, [1, 2, 3, 4, 5, 6, 7], dated)
+    scanner = scan(content, seen=[1, 2, 3, 4, 5])
+    assert not scanner.done
+    assert scanner.truncate(content) == content
+    assert count_new_entries(scanner.truncate(content), [1, 2, 3, 4, 5]) == 2
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("dated", [True, False])
+def test_newest_first(fmt, dated):
+    """The old entries at the end of a newest first feed are not downloaded."""
+    content = make_feed(fmt, [7, 6, 5, 4, 3, 2, 1], dated)
+    scanner = scan(content, seen=[1, 2, 3, 4, 5])
+    assert scanner.done
+    truncated = scanner.truncate(content)
+    assert len(truncated) < len(content)
+    assert count_new_entries(truncated, [1, 2, 3, 4, 5]) == 2
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_newest_first_unchanged(fmt):
+    """An unchanged newest first feed is cut if its dates show the order."""
+    content = make_feed(fmt, [5, 4, 3, 2, 1])
+    assert scan(content, seen=[1, 2, 3, 4, 5]).done
+    content = make_feed(fmt, [5, 4, 3, 2, 1], dated=False)
+    assert not scan(content, seen=[1, 2, 3, 4, 5]).done
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_latest_date(fmt):
+    """Feeds without seen keys are scanned by the date of the newest entry."""
+    latest = "2024 1 5 10 0 0 4 5 0"
+    assert scan(make_feed(fmt, [7, 6, 5, 4, 3, 2, 1]), latest=latest).done
+    assert not scan(make_feed(fmt, [1, 2, 3, 4, 5, 6, 7]), latest=latest).done
@@ -0,0 +1,38 @@
+"""Tests of the utilities"""
+
+import pytest
+
+from feedsbot.util import normalize_url
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("HTTPS://Example.ORG/Feed.xml", "https://example.org/Feed.xml"),
+        ("https://example.org:443/feed", "https://example.org/feed"),
+        ("http://example.org:80/feed", "http://example.org/feed"),
+        ("https://example.org:80/feed", "https://example.org:80/feed"),
+        ("https://example.org/feed/", "https://example.org/feed"),
+        ("https://example.org/", "https://example.org"),
+        ("https://example.org/feed#top", "https://example.org/feed"),
+        ("example.org/feed", "http://example.org/feed"),
+        (" https://example.org/feed\n", "https://example.org/feed"),
+        ("https://User@Example.org/feed", "https://User@example.org/feed"),
+    ],
+)
+def test_normalize_url(url, expected):
+    assert normalize_url(url) == expected
+
+
+def test_normalize_tracking_params():
+    """The tracking parameters are removed, the other ones are kept in order."""
+    url = "https://example.org/feed?utm_source=rss&lang=en&UTM_Medium=x&fbclid=1&page=2"
+    assert normalize_url(url) == "https://example.org/feed?lang=en&page=2"
+    url = "https://example.org/feed?utm_campaign=a&gclid=b"
+    assert normalize_url(url) == "https://example.org/feed"
+
+
+def test_normalize_url_is_idempotent():
+    url = normalize_url("HTTP://Example.org:80/feed?igshid=1&q=a#x")
+    assert url == "http://example.org/feed?q=a"
+    assert normalize_url(url) == url
@@ -0,0 +1,86 @@
+"""Tests of the feed worker"""
+
+# pylint: disable=protected-access
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from feedsbot import hooks, util
+from feedsbot.hosts import HostLimiter
+from feedsbot.orm import Fchat, Feed, session_scope
+from feedsbot.registry import FeedRegistry
+from feedsbot.scheduler import Scheduler
+
+URLS = [f"https://example.org/{number}.xml" for number in range(3)]
+URLS.append("https://example.com/feed.xml")
+
+
+class RecordingLimiter(HostLimiter):
+    """A host limiter remembering the URLs it downloaded."""
+
+    def __init__(self) -> None:
+        super().__init__(1, 0)
+        self.urls: list = []
+
+    def fetch(self, url, fetch):
+        self.urls.append(url)
+        return super().fetch(url, fetch)
+
+
+def add_feeds(urls: list) -> None:
+    with session_scope() as session:
+        for url in urls:
+            session.add(Feed(url=url))
+            session.add(Fchat(accid=1, gid=10, feed_url=url, filter=""))
+
+
+def fetch_unchanged(url, etag=None, modified=None, scanner=None):
+    # pylint: disable=unused-argument
+    return util.FeedResponse(url, 304, {}, "", etag, modified)
+
+
+def test_check_through_host_limiter(db, bot, monkeypatch):
+    """With the threads engine, the feeds are downloaded through the host limiter."""
+    # pylint: disable=unused-argument
+    add_feeds(URLS)
+    monkeypatch.setattr(util, "fetch_feed", fetch_unchanged)
+    registry = FeedRegistry()
+    registry.load()
+    hosts = RecordingLimiter()
+    context = util.CheckContext(Scheduler(60, 60), registry, hosts=hosts)
+    with ThreadPool(2) as pool:
+        util.check_due_feeds(bot, context, pool, None, URLS)
+    assert sorted(hosts.urls) == sorted(URLS)
+
+
+def test_unchanged_feed_keeps_ttl(db, bot, monkeypatch):
+    """The feed's update period is honored also when the feed doesn't change."""
+    # pylint: disable=unused-argument
+    url = URLS[0]
+    add_feeds([url])
+    body = "<rss><channel><title>Feed</title><ttl>120</ttl></channel></rss>"
+    responses = [util.FeedResponse(url, 200, {}, body, None, None)]
+    responses.append(util.FeedResponse(url, 304, {}, "", None, None))
+    monkeypatch.setattr(util, "fetch_feed", lambda *args, **kwargs: responses.pop(0))
+    registry = FeedRegistry()
+    registry.load()
+    context = util.CheckContext(Scheduler(60, 60 * 60 * 24), registry)
+    with ThreadPool(1) as pool:
+        for _ in range(2):
+            start = time.time()
+            util.check_due_feeds(bot, context, pool, None, [url])
+            with session_scope(readonly=True) as session:
+                feed = session.get(Feed, url)
+                assert feed.ttl == 120 * 60
+                assert feed.next_check >= start + 120 * 60 * 0.9
+    assert not responses
+
+
+def test_worker_limits_hosts(tmp_path, bot, monkeypatch):
+    """The worker subcommand gives the host limiter to the threads engine."""
+    contexts = []
+    monkeypatch.setattr(hooks, "check_feeds", lambda b, c, *args: contexts.append(c))
+    args = hooks.cli._parser.parse_args(["worker"])
+    args.config_dir = str(tmp_path)
+    hooks._worker_cmd(hooks.cli, bot, args)
+    assert isinstance(contexts[0].hosts, HostLimiter)